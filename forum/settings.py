@@ -1,4 +1,8 @@
+import atexit
 import os
+import shutil
+import sys
+import tempfile
 from pathlib import Path
 import dj_database_url
 
@@ -47,7 +51,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',  # Правильный импорт
+    'main.middleware.AsyncWhiteNoiseMiddleware',  # WhiteNoise без возврата async-вьюх в поток
+    'main.db_router.ReplicaRoutingMiddleware',  # чтение с реплик, запись и свежие записи — на primary
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -57,7 +62,25 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+# Media is served by main.media.serve. Set MEDIA_OFFLOAD to
+# "x-accel-redirect" (nginx, internal location MEDIA_ACCEL_REDIRECT_LOCATION
+# aliased to MEDIA_ROOT) or "x-sendfile" to let the front server send files.
+MEDIA_OFFLOAD = os.environ.get("MEDIA_OFFLOAD", "")
+MEDIA_ACCEL_REDIRECT_LOCATION = os.environ.get("MEDIA_ACCEL_REDIRECT_LOCATION", "/protected-media/")
+MEDIA_CACHE_MAX_AGE = 3600
+# Image derivatives (main/images.py) are built on a background thread after
+# the upload commits; set to 0 to build them inline.
+IMAGE_DERIVATIVES_IN_BACKGROUND = os.environ.get("IMAGE_DERIVATIVES_IN_BACKGROUND", "1") == "1"
+
+# Resumable chunked uploads (main/uploads.py): client chunk size and total limit.
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+
+# Uploads are stored once per unique content (see main/storage.py).
+STORAGES = {
+    "default": {"BACKEND": "main.storage.ContentAddressedStorage"},
+    "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+}
 
 
 ROOT_URLCONF = 'forum.urls'
@@ -82,26 +105,37 @@ TEMPLATES = [
 WSGI_APPLICATION = 'forum.wsgi.application'
 ASGI_APPLICATION = 'forum.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
-
-
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# PostgreSQL connections come from a per-process psycopg pool
+# (DATABASE_POOL=0 falls back to one persistent connection per thread);
+# see main/db_pool.py. Pool stats are part of the runtime metrics.
+DATABASE_POOL = os.environ.get("DATABASE_POOL", "1") != "0"
+DATABASE_POOL_OPTIONS = {
+    "min_size": int(os.environ.get("DATABASE_POOL_MIN_SIZE", "2")),
+    "max_size": int(os.environ.get("DATABASE_POOL_MAX_SIZE", "10")),
+    "timeout": float(os.environ.get("DATABASE_POOL_TIMEOUT", "10")),
+    "max_lifetime": float(os.environ.get("DATABASE_POOL_MAX_LIFETIME", "1800")),
+    "max_idle": float(os.environ.get("DATABASE_POOL_MAX_IDLE", "300")),
+}
+
+
+def _postgres_database(url, **kwargs):
+    config = dj_database_url.parse(url, conn_max_age=0 if DATABASE_POOL else 600, **kwargs)
+    if DATABASE_POOL and config["ENGINE"] == "django.db.backends.postgresql":
+        from main.db_pool import pool_options
+
+        config["OPTIONS"]["pool"] = pool_options(**DATABASE_POOL_OPTIONS)
+    return config
+
+
 if DATABASE_URL:
     # PostgreSQL (на Render / Neon / Supabase)
     DATABASES = {
-        "default": dj_database_url.parse(
-            DATABASE_URL,
-            conn_max_age=600,
-            ssl_require=True,
-        )
+        "default": _postgres_database(DATABASE_URL, ssl_require=True),
     }
 else:
     # Локально: SQLite
@@ -111,6 +145,187 @@ else:
             "NAME": BASE_DIR / "db.sqlite3",
         }
     }
+    # SQLITE_PROFILE=production (default): WAL, synchronous=NORMAL,
+    # busy_timeout, mmap and BEGIN IMMEDIATE on every connection; see
+    # main/sqlite.py and `manage.py benchmark_sqlite`. "legacy" keeps
+    # SQLite's rollback journal defaults.
+    SQLITE_PROFILE = os.environ.get("SQLITE_PROFILE", "production").lower()
+    if SQLITE_PROFILE == "production":
+        from main.sqlite import production_options
+
+        DATABASES["default"]["OPTIONS"] = production_options(
+            busy_timeout_ms=int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+            mmap_size=int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+            cache_kb=int(os.environ.get("SQLITE_CACHE_KB", str(64 * 1024))),
+        )
+
+
+# Read replicas: DATABASE_REPLICA_URLS="postgres://...,postgres://..." (or
+# "sqlite:///replica.sqlite3" locally). Reads during a request go to a
+# replica unless the request wrote recently; see main/db_router.py.
+DATABASE_REPLICAS = []
+for _index, _url in enumerate(filter(None, (u.strip() for u in os.environ.get("DATABASE_REPLICA_URLS", "").split(","))), 1):
+    _alias = f"replica{_index}"
+    DATABASES[_alias] = _postgres_database(_url, ssl_require=_url.startswith("postgres"))
+    # Tests read replicas through the primary's test database.
+    DATABASES[_alias]["TEST"] = {"MIRROR": "default"}
+    DATABASE_REPLICAS.append(_alias)
+DATABASE_ROUTERS = ["main.db_router.ReplicaRouter"]
+REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", "5"))
+
+# Channel layer: shared between ASGI workers without extra services.
+# Postgres LISTEN/NOTIFY in production, a local SQLite file otherwise.
+# Number of published realtime events kept for replay to reconnecting
+# sockets; older gaps make the client resync.
+REALTIME_EVENT_LOG_SIZE = int(os.environ.get("REALTIME_EVENT_LOG_SIZE", "2000"))
+
+# "manage.py test" keeps the shared cache directory and the channel layer
+# file in a temporary directory, away from the developer's own.
+TESTING = len(sys.argv) > 1 and sys.argv[1] == "test"
+if TESTING:
+    TEST_STATE_DIR = tempfile.mkdtemp(prefix="forum-tests-")
+    atexit.register(shutil.rmtree, TEST_STATE_DIR, True)
+    # The manifest only exists after collectstatic.
+    STORAGES["staticfiles"] = {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"}
+
+# CHANNEL_LAYER_BACKEND=memory keeps the old single-process behaviour.
+CHANNEL_LAYER_BACKEND = os.environ.get("CHANNEL_LAYER_BACKEND", "").lower()
+
+if CHANNEL_LAYER_BACKEND == "memory":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+elif DATABASE_URL and not TESTING:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "main.channel_layers.PostgresChannelLayer",
+            "CONFIG": {"url": DATABASE_URL, "event_log_size": REALTIME_EVENT_LOG_SIZE, "metrics_name": "channel_layer"},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "main.channel_layers.SQLiteChannelLayer",
+            "CONFIG": {
+                "path": (
+                    os.path.join(TEST_STATE_DIR, "channels.sqlite3") if TESTING
+                    else os.environ.get("CHANNEL_LAYER_PATH", BASE_DIR / "channels.sqlite3")
+                ),
+                "event_log_size": REALTIME_EVENT_LOG_SIZE,
+                "metrics_name": "channel_layer",
+            },
+        },
+    }
+
+# Binary WebSocket frame formats encoded once per publish (json is always
+# encoded) and the payload size from which a deflated variant is added.
+# Only these formats' subprotocols are accepted from clients.
+REALTIME_BINARY_FORMATS = ("msgpack", "cbor")
+REALTIME_COMPRESS_MIN_BYTES = 1024
+
+# Sync views hand realtime events to a background sender thread; a full
+# queue drops events (clients catch up from the event log on reconnect).
+REALTIME_PUBLISH_IN_BACKGROUND = os.environ.get("REALTIME_PUBLISH_IN_BACKGROUND", "1") != "0"
+REALTIME_PUBLISH_QUEUE_SIZE = int(os.environ.get("REALTIME_PUBLISH_QUEUE_SIZE", "1000"))
+REALTIME_PUBLISH_BATCH_SIZE = 100
+
+# Cache: a per-process LRU (L1) in front of the cache shared by all
+# workers (L2), see main/tiered_cache.py. L2 is a directory (CACHE_DIR) by
+# default, so caching adds no database queries; CACHE_BACKEND=db uses the
+# table CACHE_TABLE (created by "migrate" / "createcachetable") for
+# workers on several hosts, and a redis:// CACHE_URL uses Redis (needs the
+# redis package). Writes invalidate the other workers' L1 over the channel
+# layer; CACHE_BACKEND=locmem is the old per-process cache without tiers.
+CACHE_URL = os.environ.get("CACHE_URL", "")
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "redis" if CACHE_URL.startswith(("redis://", "rediss://")) else "file")
+CACHE_TABLE = "main_cache"
+CACHE_DIR = os.environ.get("CACHE_DIR", str(BASE_DIR / "cache"))
+if TESTING:
+    CACHE_BACKEND = "file"
+    CACHE_DIR = os.path.join(TEST_STATE_DIR, "cache")
+CACHE_L1_MAX_ENTRIES = int(os.environ.get("CACHE_L1_MAX_ENTRIES", "1000"))
+CACHE_L1_TIMEOUT = int(os.environ.get("CACHE_L1_TIMEOUT", "30"))
+
+if CACHE_BACKEND == "locmem":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "main.tiered_cache.TieredCache",
+            "LOCATION": "shared",
+            "OPTIONS": {
+                "L1_MAX_ENTRIES": CACHE_L1_MAX_ENTRIES,
+                "L1_TIMEOUT": CACHE_L1_TIMEOUT,
+                "CHANNEL_LAYER": "default",
+            },
+        },
+        "shared": {
+            "redis": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": CACHE_URL},
+            "db": {
+                "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                "LOCATION": CACHE_TABLE,
+                "OPTIONS": {"MAX_ENTRIES": 10000},
+            },
+        }.get(CACHE_BACKEND, {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": CACHE_DIR,
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }),
+    }
+
+# Token for scraping /internal/metrics/ (JSON) and
+# /internal/metrics/prometheus/ (Prometheus text) without a staff session.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Per-request latency, query and cache stats (main.instrumentation), off by
+# default. They appear under "requests" in /internal/metrics/ and, with
+# REQUEST_INSTRUMENTATION_SNAPSHOT_DIR set, in periodic JSON files.
+REQUEST_INSTRUMENTATION = os.environ.get("REQUEST_INSTRUMENTATION", "") == "1"
+REQUEST_INSTRUMENTATION_SNAPSHOT_DIR = os.environ.get("REQUEST_INSTRUMENTATION_SNAPSHOT_DIR", "")
+REQUEST_INSTRUMENTATION_SNAPSHOT_SECONDS = int(os.environ.get("REQUEST_INSTRUMENTATION_SNAPSHOT_SECONDS", "60"))
+if REQUEST_INSTRUMENTATION:
+    MIDDLEWARE.insert(0, "main.instrumentation.RequestInstrumentationMiddleware")
+
+# On-demand cProfile of single requests (main.profiling), off by default.
+# Staff get a signed token at /admin/profiles/ and send it as the
+# X-Profile-Token header or ?_profile=; the newest PROFILING_KEEP profiles
+# are kept in PROFILING_DIR.
+PROFILING = os.environ.get("PROFILING", "") == "1"
+PROFILING_DIR = os.environ.get("PROFILING_DIR", str(BASE_DIR / "profiles"))
+PROFILING_KEEP = int(os.environ.get("PROFILING_KEEP", "50"))
+PROFILING_TOKEN_MAX_AGE = int(os.environ.get("PROFILING_TOKEN_MAX_AGE", "3600"))
+if PROFILING:
+    MIDDLEWARE.insert(0, "main.profiling.ProfilingMiddleware")
+
+# Span tracing of requests (main.tracing), off by default: view, SQL,
+# cache, templates and realtime publishes, written as OTLP/JSON lines to
+# TRACING_FILE. TRACING_SAMPLE_RATE applies to requests without a sampled
+# traceparent header.
+TRACING = os.environ.get("TRACING", "") == "1"
+TRACING_FILE = os.environ.get("TRACING_FILE", str(BASE_DIR / "traces" / "spans.jsonl"))
+TRACING_FILE_MAX_BYTES = int(os.environ.get("TRACING_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", "1.0"))
+if TRACING:
+    MIDDLEWARE.insert(0, "main.tracing.TracingMiddleware")
+
+# Slow-query log and per-fingerprint SQL totals (main.slow_queries), off by
+# default. Queries over SLOW_QUERY_THRESHOLD_MS are logged with view and
+# call site; every worker writes its rolling totals to SLOW_QUERY_DIR, and
+# "manage.py slow_queries" prints the top fingerprints.
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG", "") == "1"
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", "100"))
+SLOW_QUERY_DIR = os.environ.get("SLOW_QUERY_DIR", str(BASE_DIR / "slow_queries"))
+SLOW_QUERY_SNAPSHOT_SECONDS = int(os.environ.get("SLOW_QUERY_SNAPSHOT_SECONDS", "60"))
+SLOW_QUERY_WINDOW_SECONDS = int(os.environ.get("SLOW_QUERY_WINDOW_SECONDS", "3600"))
+SLOW_QUERY_MAX_FINGERPRINTS = int(os.environ.get("SLOW_QUERY_MAX_FINGERPRINTS", "1000"))
+if SLOW_QUERY_LOG:
+    MIDDLEWARE.insert(0, "main.slow_queries.SlowQueryMiddleware")
 
 
 # Password validation
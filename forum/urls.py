@@ -1,12 +1,18 @@
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from main import media, profiling
 
 urlpatterns = [
+    path('admin/profiles/', admin.site.admin_view(profiling.profile_list), name='admin-profiles'),
+    path('admin/profiles/<slug:profile_id>/', admin.site.admin_view(profiling.profile_detail), name='admin-profile-detail'),
+    path(
+        'admin/profiles/<slug:profile_id>/download/',
+        admin.site.admin_view(profiling.profile_download),
+        name='admin-profile-download',
+    ),
     path('admin/', admin.site.urls),
     path('', include('main.urls')),
+    re_path(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), media.serve, name='media'),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
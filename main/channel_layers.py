@@ -0,0 +1,600 @@
+"""Channel layers that work across worker processes without Redis.
+
+Messages and group membership live in small tables, so every ASGI worker
+can deliver to sockets owned by any other worker:
+
+* ``PostgresChannelLayer`` keeps the tables in the app database and wakes
+  readers up with LISTEN/NOTIFY;
+* ``SQLiteChannelLayer`` keeps them in a local SQLite file (WAL mode) and
+  polls it with a short backoff.
+
+A group send stores the serialized message once and fans out light rows
+that point at it, so a large ``comment_created`` payload is not copied for
+every member.
+
+Both layers also provide the ``event_log`` extension: a bounded, shared
+log of published realtime events with a global sequence number, used to
+replay missed events to reconnecting sockets (see ``main.event_log``).
+"""
+import asyncio
+import logging
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+import msgpack
+from channels.layers import BaseChannelLayer
+
+from . import metrics as runtime_metrics
+from . import realtime
+
+logger = logging.getLogger(__name__)
+
+# Pause of the reader after a storage error (e.g. "database is locked").
+READ_RETRY_SECONDS = 1.0
+
+
+class LayerMetrics:
+    """Thread-safe delivery counters for one channel layer instance."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._group_send_seconds_total = 0.0
+        self._group_send_seconds_max = 0.0
+        self.group_send_seconds = runtime_metrics.Histogram(runtime_metrics.SECONDS_BUCKETS)
+        self.group_send_fanout = runtime_metrics.Histogram(runtime_metrics.FANOUT_BUCKETS)
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe_group_send(self, seconds: float, fanout: int):
+        with self._lock:
+            self._counters["group_sends"] += 1
+            self._counters["group_send_fanout_total"] += fanout
+            self._group_send_seconds_total += seconds
+            self._group_send_seconds_max = max(self._group_send_seconds_max, seconds)
+        self.group_send_seconds.observe(seconds)
+        self.group_send_fanout.observe(fanout)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self._counters)
+            sends = data.get("group_sends", 0)
+            data["group_send_seconds_total"] = round(self._group_send_seconds_total, 6)
+            data["group_send_seconds_max"] = round(self._group_send_seconds_max, 6)
+            data["group_send_seconds_avg"] = round(self._group_send_seconds_total / sends, 6) if sends else 0.0
+        data["group_send_seconds_histogram"] = self.group_send_seconds.snapshot()
+        data["group_send_fanout_histogram"] = self.group_send_fanout.snapshot()
+        return data
+
+
+def group_size_stats(rows) -> dict:
+    """Aggregate ``(group, members)`` rows by group kind (``topic_5`` -> ``topic``)."""
+    kinds = {}
+    for group, members in rows:
+        kind = kinds.setdefault(realtime.group_kind(group), {"groups": 0, "members": 0, "max_members": 0})
+        kind["groups"] += 1
+        kind["members"] += members
+        kind["max_members"] = max(kind["max_members"], members)
+    return kinds
+
+
+class _SharedChannelLayer(BaseChannelLayer):
+    """Table-backed layer; subclasses provide the connection and wake-up."""
+
+    extensions = ["groups", "flush", "event_log"]
+
+    serial_type = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    blob_type = "BLOB"
+    skip_locked = ""
+
+    def __init__(
+        self,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        batch_size=200,
+        cleanup_interval=30,
+        event_log_size=2000,
+        metrics_name=None,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.group_expiry = group_expiry
+        self.batch_size = batch_size
+        self.cleanup_interval = cleanup_interval
+        self.event_log_size = event_log_size
+        self.client_prefix = uuid.uuid4().hex[:12]
+        self.metrics = LayerMetrics()
+
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._last_cleanup = 0.0
+        self._inboxes = set()
+        self._queues = {}
+        self._reader = None
+
+        # Only the configured default alias passes a name (settings.py), so
+        # throwaway and private instances never take over its metrics.
+        self.metrics_name = metrics_name
+        if metrics_name:
+            runtime_metrics.register(metrics_name, self.metrics_snapshot)
+
+    # Storage helpers (run in worker threads)
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _sql(self, query: str) -> str:
+        return query
+
+    @contextmanager
+    def _transaction(self, conn):
+        raise NotImplementedError
+
+    def _notify(self, cursor, inboxes):
+        """Wake up the processes owning ``inboxes``; polling layers do nothing."""
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        if not self._schema_ready:
+            self._create_schema(conn)
+        return conn
+
+    def _create_schema(self, conn):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            with self._transaction(conn) as cursor:
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS channel_layer_payload ("
+                    f"id {self.serial_type}, body {self.blob_type} NOT NULL, "
+                    f"expires_at DOUBLE PRECISION NOT NULL)"
+                )
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS channel_layer_message ("
+                    f"id {self.serial_type}, inbox VARCHAR(100) NOT NULL, channel VARCHAR(100) NOT NULL, "
+                    f"payload_id BIGINT NOT NULL, expires_at DOUBLE PRECISION NOT NULL)"
+                )
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS channel_layer_message_inbox "
+                    "ON channel_layer_message (inbox, id)"
+                )
+                cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS channel_layer_group ("
+                    "group_name VARCHAR(100) NOT NULL, channel VARCHAR(100) NOT NULL, "
+                    "expires_at DOUBLE PRECISION NOT NULL, PRIMARY KEY (group_name, channel))"
+                )
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS channel_layer_event ("
+                    f"seq {self.serial_type}, group_names TEXT NOT NULL, body {self.blob_type} NOT NULL)"
+                )
+            self._schema_ready = True
+
+    def _inbox_for(self, channel: str) -> str:
+        return self.non_local_name(channel)
+
+    def _store(self, channels, body: bytes) -> int:
+        now = time.time()
+        expires_at = now + self.expiry
+        conn = self._connection()
+        with self._transaction(conn) as cursor:
+            cursor.execute(
+                self._sql("INSERT INTO channel_layer_payload (body, expires_at) VALUES (?, ?) RETURNING id"),
+                (body, expires_at),
+            )
+            payload_id = cursor.fetchone()[0]
+            rows = [(self._inbox_for(channel), channel, payload_id, expires_at) for channel in channels]
+            cursor.executemany(
+                self._sql(
+                    "INSERT INTO channel_layer_message (inbox, channel, payload_id, expires_at) VALUES (?, ?, ?, ?)"
+                ),
+                rows,
+            )
+            self._notify(cursor, {row[0] for row in rows})
+        self._maybe_cleanup(now)
+        return len(rows)
+
+    def _group_members(self, group: str) -> list[str]:
+        rows = self._connection().execute(
+            self._sql("SELECT channel FROM channel_layer_group WHERE group_name = ? AND expires_at > ?"),
+            (group, time.time()),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def _group_send(self, group: str, body: bytes) -> int:
+        members = self._group_members(group)
+        if not members:
+            return 0
+        return self._store(members, body)
+
+    def _pop(self, inboxes, limit: int) -> list[tuple]:
+        if not inboxes:
+            return []
+        inboxes = list(inboxes)
+        placeholders = ", ".join("?" for _ in inboxes)
+        conn = self._connection()
+        with self._transaction(conn) as cursor:
+            cursor.execute(
+                self._sql(
+                    f"DELETE FROM channel_layer_message WHERE id IN ("
+                    f"SELECT id FROM channel_layer_message WHERE inbox IN ({placeholders}) "
+                    f"ORDER BY id LIMIT ?{self.skip_locked}) "
+                    f"RETURNING id, channel, payload_id, expires_at"
+                ),
+                (*inboxes, limit),
+            )
+            rows = sorted(cursor.fetchall())
+            if not rows:
+                return []
+            payload_ids = sorted({row[2] for row in rows})
+            placeholders = ", ".join("?" for _ in payload_ids)
+            cursor.execute(
+                self._sql(f"SELECT id, body FROM channel_layer_payload WHERE id IN ({placeholders})"),
+                payload_ids,
+            )
+            bodies = {payload_id: bytes(body) for payload_id, body in cursor.fetchall()}
+        return [(channel, payload_id, bodies.get(payload_id), expires_at) for _, channel, payload_id, expires_at in rows]
+
+    def _group_add(self, group: str, channel: str):
+        conn = self._connection()
+        with self._transaction(conn) as cursor:
+            cursor.execute(
+                self._sql(
+                    "INSERT INTO channel_layer_group (group_name, channel, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (group_name, channel) DO UPDATE SET expires_at = excluded.expires_at"
+                ),
+                (group, channel, time.time() + self.group_expiry),
+            )
+
+    def _group_discard(self, group: str | None, channel: str):
+        conn = self._connection()
+        with self._transaction(conn) as cursor:
+            if group is None:
+                cursor.execute(self._sql("DELETE FROM channel_layer_group WHERE channel = ?"), (channel,))
+            else:
+                cursor.execute(
+                    self._sql("DELETE FROM channel_layer_group WHERE group_name = ? AND channel = ?"),
+                    (group, channel),
+                )
+
+    def _maybe_cleanup(self, now: float):
+        if now - self._last_cleanup < self.cleanup_interval:
+            return
+        self._last_cleanup = now
+        conn = self._connection()
+        with self._transaction(conn) as cursor:
+            cursor.execute(self._sql("DELETE FROM channel_layer_message WHERE expires_at < ?"), (now,))
+            expired_messages = max(cursor.rowcount, 0)
+            # Payloads outlive their messages by one expiry window, so a reader
+            # that popped a message just before it expired still finds the body.
+            cursor.execute(self._sql("DELETE FROM channel_layer_payload WHERE expires_at < ?"), (now - self.expiry,))
+            cursor.execute(self._sql("DELETE FROM channel_layer_group WHERE expires_at < ?"), (now,))
+            expired_memberships = max(cursor.rowcount, 0)
+        self.metrics.incr("messages_expired", expired_messages)
+        self.metrics.incr("group_memberships_expired", expired_memberships)
+
+    def _flush(self):
+        conn = self._connection()
+        with self._transaction(conn) as cursor:
+            cursor.execute("DELETE FROM channel_layer_message")
+            cursor.execute("DELETE FROM channel_layer_payload")
+            cursor.execute("DELETE FROM channel_layer_group")
+            cursor.execute("DELETE FROM channel_layer_event")
+
+    def _append_event(self, groups, body: bytes) -> int:
+        conn = self._connection()
+        with self._transaction(conn) as cursor:
+            cursor.execute(
+                self._sql("INSERT INTO channel_layer_event (group_names, body) VALUES (?, ?) RETURNING seq"),
+                (",".join(groups), body),
+            )
+            seq = cursor.fetchone()[0]
+            if seq % 100 == 0:
+                cursor.execute(
+                    self._sql("DELETE FROM channel_layer_event WHERE seq <= ?"), (seq - self.event_log_size,)
+                )
+        return seq
+
+    def _events_since(self, seq: int, overlap: int = 0):
+        conn = self._connection()
+        first, last = conn.execute("SELECT MIN(seq), MAX(seq) FROM channel_layer_event").fetchone()
+        last = last or 0
+        # Rows are trimmed every 100 appends, so the oldest retained row is
+        # the real replay horizon; anything older has to resync.
+        if seq > last or (first is not None and seq + 1 < first):
+            return None
+        rows = conn.execute(
+            self._sql("SELECT seq, group_names, body FROM channel_layer_event WHERE seq > ? ORDER BY seq"),
+            (seq - overlap,),
+        ).fetchall()
+        return [(row_seq, group_names.split(","), bytes(body)) for row_seq, group_names, body in rows]
+
+    def _last_event_seq(self) -> int:
+        row = self._connection().execute("SELECT MAX(seq) FROM channel_layer_event").fetchone()
+        return row[0] or 0
+
+    def _storage_stats(self) -> dict:
+        """Shared state across all workers: group sizes by kind and undelivered messages."""
+        conn = self._connection()
+        now = time.time()
+        rows = conn.execute(
+            self._sql(
+                "SELECT group_name, COUNT(*) FROM channel_layer_group WHERE expires_at > ? GROUP BY group_name"
+            ),
+            (now,),
+        ).fetchall()
+        pending = conn.execute(
+            self._sql("SELECT COUNT(*) FROM channel_layer_message WHERE expires_at > ?"), (now,)
+        ).fetchone()[0]
+        return {"groups": group_size_stats(rows), "pending_messages": pending}
+
+    # Serialization
+
+    def serialize(self, message: dict) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def deserialize(self, body: bytes) -> dict:
+        return msgpack.unpackb(body, raw=False)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        await asyncio.to_thread(self._store, [channel], self.serialize(message))
+        self.metrics.incr("messages_sent")
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        if "!" not in channel:
+            return await self._receive_general(channel)
+
+        self._inboxes.add(self._inbox_for(channel))
+        queue = self._queues.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        self._ensure_reader()
+        try:
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at >= time.time():
+                    break
+                self.metrics.incr("messages_expired")
+        finally:
+            if queue.empty():
+                self._queues.pop(channel, None)
+        self.metrics.incr("messages_received")
+        return message
+
+    async def new_channel(self, prefix="specific"):
+        return f"{prefix}.{self.client_prefix}!{uuid.uuid4().hex[:12]}"
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await asyncio.to_thread(self._group_add, group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await asyncio.to_thread(self._group_discard, group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        started = time.perf_counter()
+        fanout = await asyncio.to_thread(self._group_send, group, self.serialize(message))
+        self.metrics.observe_group_send(time.perf_counter() - started, fanout)
+        self.metrics.incr("messages_sent", fanout)
+
+    async def flush(self):
+        await asyncio.to_thread(self._flush)
+        self._queues = {}
+
+    async def close(self):
+        if self._reader and not self._reader.done():
+            self._reader.cancel()
+        self._reader = None
+        if self.metrics_name:
+            runtime_metrics.unregister(self.metrics_name, self.metrics_snapshot)
+
+    # Event log extension
+
+    async def append_event(self, groups, handler: str, frames: dict) -> int:
+        body = self.serialize({"type": handler, "frames": frames})
+        return await asyncio.to_thread(self._append_event, list(groups), body)
+
+    async def events_since(self, seq: int, groups, overlap: int = 0) -> list[dict] | None:
+        rows = await asyncio.to_thread(self._events_since, seq, overlap)
+        if rows is None:
+            return None
+        groups = set(groups)
+        events = []
+        for row_seq, group_names, body in rows:
+            matching = [group for group in group_names if group in groups]
+            if not matching:
+                continue
+            event = self.deserialize(body)
+            events.extend({**event, "seq": row_seq, "group": group} for group in matching)
+        return events
+
+    async def last_event_seq(self) -> int:
+        return await asyncio.to_thread(self._last_event_seq)
+
+    def metrics_snapshot(self) -> dict:
+        data = self.metrics.snapshot()
+        data["backend"] = type(self).__name__
+        data["local_channels"] = len(self._queues)
+        data["local_queue_depth"] = sum(queue.qsize() for queue in self._queues.values())
+        data.update(self._storage_stats())
+        return data
+
+    # Reading
+
+    def _ensure_reader(self):
+        loop = asyncio.get_running_loop()
+        if self._reader is None or self._reader.done() or self._reader.get_loop() is not loop:
+            self._reader = loop.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        idle_rounds = 0
+        while True:
+            try:
+                rows = await asyncio.to_thread(self._pop, set(self._inboxes), self.batch_size)
+                if rows:
+                    idle_rounds = 0
+                    self._dispatch(rows)
+                    continue
+                idle_rounds += 1
+                await asyncio.to_thread(self._maybe_cleanup, time.time())
+                for channel in self._clean_local_queues():
+                    await asyncio.to_thread(self._group_discard, None, channel)
+                await self._wait_for_messages(idle_rounds)
+            except Exception:
+                # The consumers waiting in receive() depend on this task.
+                logger.exception("Channel layer reader failed; retrying in %s s", READ_RETRY_SECONDS)
+                await asyncio.sleep(READ_RETRY_SECONDS)
+
+    def _dispatch(self, rows):
+        decoded = {}
+        for channel, payload_id, body, expires_at in rows:
+            if body is None:
+                self.metrics.incr("messages_expired")
+                continue
+            if payload_id not in decoded:
+                decoded[payload_id] = self.deserialize(body)
+            queue = self._queues.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+            try:
+                queue.put_nowait((expires_at, dict(decoded[payload_id])))
+            except asyncio.QueueFull:
+                self.metrics.incr("messages_dropped")
+
+    def _clean_local_queues(self) -> list[str]:
+        """Drop expired messages nobody received; return the channels that died."""
+        now = time.time()
+        dead = []
+        for channel, queue in list(self._queues.items()):
+            expired = False
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+                expired = True
+                self.metrics.incr("messages_expired")
+            if expired and queue.empty():
+                self._queues.pop(channel, None)
+                dead.append(channel)
+        return dead
+
+    async def _receive_general(self, channel):
+        idle_rounds = 0
+        while True:
+            rows = await asyncio.to_thread(self._pop, [channel], 1)
+            for _, _, body, expires_at in rows:
+                if body is not None and expires_at >= time.time():
+                    self.metrics.incr("messages_received")
+                    return self.deserialize(body)
+                self.metrics.incr("messages_expired")
+            idle_rounds += 1
+            await self._wait_for_messages(idle_rounds)
+
+    async def _wait_for_messages(self, idle_rounds: int):
+        raise NotImplementedError
+
+
+class SQLiteChannelLayer(_SharedChannelLayer):
+    """Shared layer on a local SQLite file for single-host deployments."""
+
+    def __init__(self, path="channels.sqlite3", poll_interval=0.02, max_poll_interval=0.25, busy_timeout=5, **kwargs):
+        self.path = str(path)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.busy_timeout = busy_timeout
+        super().__init__(**kwargs)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _transaction(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    async def _wait_for_messages(self, idle_rounds: int):
+        await asyncio.sleep(min(self.poll_interval * idle_rounds, self.max_poll_interval))
+
+
+class PostgresChannelLayer(_SharedChannelLayer):
+    """Shared layer on the app's Postgres database, woken up via LISTEN/NOTIFY."""
+
+    serial_type = "BIGSERIAL PRIMARY KEY"
+    blob_type = "BYTEA"
+    skip_locked = " FOR UPDATE SKIP LOCKED"
+
+    def __init__(self, url=None, listen_timeout=1.0, **kwargs):
+        if not url:
+            raise ValueError("PostgresChannelLayer requires a database url.")
+        self.url = url
+        self.listen_timeout = listen_timeout
+        self._listen_conn = None
+        self._listening = set()
+        super().__init__(**kwargs)
+
+    def _connect(self):
+        import psycopg
+
+        return psycopg.connect(self.url, autocommit=True)
+
+    def _sql(self, query: str) -> str:
+        return query.replace("?", "%s")
+
+    @contextmanager
+    def _transaction(self, conn):
+        with conn.transaction():
+            with conn.cursor() as cursor:
+                yield cursor
+
+    @staticmethod
+    def _notify_name(inbox: str) -> str:
+        return "chl_" + re.sub(r"[^a-z0-9]", "_", inbox.lower())[:58]
+
+    def _notify(self, cursor, inboxes):
+        for inbox in sorted(inboxes):
+            cursor.execute("SELECT pg_notify(%s, '')", (self._notify_name(inbox),))
+
+    def _wait_for_notify(self, timeout: float):
+        if self._listen_conn is None or self._listen_conn.closed:
+            self._listen_conn = self._connect()
+            self._listening = set()
+        for inbox in set(self._inboxes) - self._listening:
+            self._listen_conn.execute(f'LISTEN "{self._notify_name(inbox)}"')
+            self._listening.add(inbox)
+        for _ in self._listen_conn.notifies(timeout=timeout, stop_after=1):
+            break
+
+    async def _wait_for_messages(self, idle_rounds: int):
+        await asyncio.to_thread(self._wait_for_notify, self.listen_timeout)
+
+    async def close(self):
+        await super().close()
+        if self._listen_conn is not None:
+            self._listen_conn.close()
+            self._listen_conn = None
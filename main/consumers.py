@@ -1,12 +1,70 @@
 import json
+import threading
+from urllib.parse import parse_qs
 
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from . import metrics as runtime_metrics
+from . import realtime
+from .event_log import REPLAY_OVERLAP, get_event_log
+from .models import DialogParticipant
 
-class DialogConsumer(AsyncWebsocketConsumer):
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def _count_connection(consumer: str, opened: bool):
+    with _connections_lock:
+        counts = _connections.setdefault(consumer, {"active": 0, "accepted": 0})
+        counts["active"] += 1 if opened else -1
+        counts["accepted"] += opened
+
+
+def connection_stats() -> dict:
+    """Open and accepted sockets per consumer class in this process."""
+    with _connections_lock:
+        return {consumer: dict(counts) for consumer, counts in _connections.items()}
+
+
+runtime_metrics.register("websockets", connection_stats)
+
+
+class FramedWebsocketConsumer(AsyncWebsocketConsumer):
+    """Negotiates the wire format on accept and sends pre-encoded event frames."""
+
+    frame_format = "json"
+    _counted = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            subprotocol = realtime.negotiate_subprotocol(self.scope.get('subprotocols'))
+            self.frame_format = realtime.SUBPROTOCOL_FORMATS.get(subprotocol, "json")
+        await super().accept(subprotocol=subprotocol, headers=headers)
+        if not self._counted:
+            self._counted = True
+            _count_connection(type(self).__name__, True)
+
+    async def websocket_disconnect(self, message):
+        if self._counted:
+            self._counted = False
+            _count_connection(type(self).__name__, False)
+        await super().websocket_disconnect(message)
+
+    async def send_frame(self, event):
+        await self.send_raw_frame(realtime.frame_for(event, self.frame_format))
+
+    async def send_raw_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+
+class DialogConsumer(FramedWebsocketConsumer):
     async def connect(self):
         self.dialog_id = self.scope['url_route']['kwargs']['dialog_id']
-        self.group_name = f"dialog_{self.dialog_id}"
+        self.group_name = realtime.dialog_group(self.dialog_id)
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
 
@@ -21,22 +79,23 @@ class DialogConsumer(AsyncWebsocketConsumer):
             self.group_name,
             {
                 'type': 'dialog_event',
-                'payload': payload,
+                'group': self.group_name,
+                'frames': realtime.encode_frames(payload),
             }
         )
 
     async def dialog_event(self, event):
-        await self.send(text_data=json.dumps(event['payload']))
+        await self.send_frame(event)
 
 
-class NotificationsConsumer(AsyncWebsocketConsumer):
+class NotificationsConsumer(FramedWebsocketConsumer):
     async def connect(self):
         user = self.scope.get('user')
         if not user or user.is_anonymous:
             await self.close()
             return
 
-        self.group_name = f"notifications_{user.id}"
+        self.group_name = realtime.notifications_group(user.id)
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
 
@@ -46,24 +105,184 @@ class NotificationsConsumer(AsyncWebsocketConsumer):
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def notify(self, event):
-        await self.send(text_data=json.dumps(event['payload']))
+        await self.send_frame(event)
+
+
+class SiteRealtimeConsumer(FramedWebsocketConsumer):
+    """Site-wide events plus the page scopes the client subscribed to.
 
+    Scopes come from ``?scopes=topic_5,home`` on connect or later from
+    ``{"action": "subscribe" | "unsubscribe", "scopes": [...]}`` messages.
+    """
 
-class SiteRealtimeConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         user = self.scope.get('user')
+        self.joined_groups = set()
         if not user or user.is_anonymous:
             await self.close()
             return
 
-        self.group_name = 'site_global'
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self._join(realtime.SITE_GROUP)
         await self.accept()
 
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        await self._subscribe(realtime.parse_names(query.get('scopes', [''])[0]))
+
     async def disconnect(self, close_code):
-        user = self.scope.get('user')
-        if user and not user.is_anonymous:
-            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        for group in self.joined_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.joined_groups = set()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data:
+            return
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        scopes = [s for s in data.get('scopes') or [] if isinstance(s, str)]
+        if data.get('action') == 'subscribe':
+            await self._subscribe(scopes)
+        elif data.get('action') == 'unsubscribe':
+            for scope in scopes:
+                if scope in self.joined_groups and scope != realtime.SITE_GROUP:
+                    await self.channel_layer.group_discard(scope, self.channel_name)
+                    self.joined_groups.discard(scope)
+
+    async def _join(self, group):
+        await self.channel_layer.group_add(group, self.channel_name)
+        self.joined_groups.add(group)
+
+    async def _subscribe(self, scopes):
+        user = self.scope['user']
+        for scope in scopes:
+            if len(self.joined_groups) >= realtime.MAX_SCOPES_PER_SOCKET:
+                break
+            if scope not in self.joined_groups and realtime.scope_allowed(scope, user):
+                await self._join(scope)
 
     async def site_event(self, event):
-        await self.send(text_data=json.dumps(event['payload']))
+        await self.send_frame(event)
+
+
+@database_sync_to_async
+def _is_dialog_participant(dialog_id, user_id) -> bool:
+    return DialogParticipant.objects.filter(dialog_id=dialog_id, user_id=user_id).exists()
+
+
+class MultiplexConsumer(FramedWebsocketConsumer):
+    """One socket per tab carrying named streams.
+
+    Streams: ``notifications``, ``site``, ``home``, ``family_hq``,
+    ``dialog_list``, ``topic:<id>`` and ``dialog:<id>``. The client picks
+    them with ``?streams=`` on connect and later with
+    ``{"action": "subscribe" | "unsubscribe", "streams": [...]}``; it can
+    relay dialog events with ``{"action": "publish", "stream": "dialog:<id>", "data": {...}}``.
+
+    Unknown or malformed stream names are answered with an ``error``
+    control frame (``"error": "invalid_stream"``).
+
+    Every event frame carries its sequence number. A reconnecting client
+    passes the highest one it saw as ``?since=``. The events of its
+    streams after it are replayed first, together with the
+    ``REPLAY_OVERLAP`` seqs before it, which may have arrived out of order
+    (the client drops the ones it already has). A ``resync_required``
+    control frame is sent instead when the gap is no longer in the event log.
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        self.streams = {}
+        if not user or user.is_anonymous:
+            await self.close()
+            return
+
+        await self.accept()
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        await self._subscribe(realtime.parse_names(query.get('streams', ['notifications,site'])[0]))
+        await self._replay(query.get('since', [''])[0])
+
+    async def disconnect(self, close_code):
+        for group in self.streams:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.streams = {}
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data:
+            return
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+
+        action = data.get('action')
+        if action == 'subscribe':
+            await self._subscribe([s for s in data.get('streams') or [] if isinstance(s, str)])
+        elif action == 'unsubscribe':
+            await self._unsubscribe([s for s in data.get('streams') or [] if isinstance(s, str)])
+        elif action == 'publish':
+            await self._publish(data.get('stream'), data.get('data'))
+
+    async def _subscribe(self, streams):
+        user = self.scope['user']
+        for stream in streams:
+            if len(self.streams) >= realtime.MAX_SCOPES_PER_SOCKET:
+                break
+            group = realtime.stream_group(stream, user)
+            if group is None:
+                await self._send_control({'type': 'error', 'error': 'invalid_stream', 'stream': stream[:100]})
+                continue
+            if group in self.streams:
+                continue
+            if stream.startswith('dialog:') and not await _is_dialog_participant(stream.split(':', 1)[1], user.id):
+                continue
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.streams[group] = stream
+
+    async def _unsubscribe(self, streams):
+        for group, stream in list(self.streams.items()):
+            if stream in streams:
+                await self.channel_layer.group_discard(group, self.channel_name)
+                del self.streams[group]
+
+    async def _replay(self, since):
+        event_log = get_event_log(self.channel_layer)
+        current = await event_log.last_event_seq()
+        if not since.isdigit():
+            await self._send_control({'type': 'hello', 'seq': current})
+            return
+        events = await event_log.events_since(int(since), self.streams, REPLAY_OVERLAP)
+        if events is None:
+            await self._send_control({'type': 'resync_required', 'seq': current})
+            return
+        for event in events:
+            await self._forward(event)
+        await self._send_control({'type': 'hello', 'seq': current})
+
+    async def _send_control(self, payload):
+        frame = realtime.encode_frame(payload, self.frame_format)
+        await self.send_raw_frame(realtime.wrap_stream_frame(frame, realtime.CONTROL_STREAM))
+
+    async def _publish(self, stream, payload):
+        # Only dialog streams accept client events (typing, delivered messages).
+        if not isinstance(stream, str) or not stream.startswith('dialog:') or not isinstance(payload, dict):
+            return
+        group = realtime.stream_group(stream, self.scope['user'])
+        if group not in self.streams:
+            return
+        await realtime.apublish(group, 'dialog_event', payload)
+
+    async def _forward(self, event):
+        stream = self.streams.get(event.get('group'))
+        if stream is None:
+            return
+        frame = realtime.frame_for(event, self.frame_format)
+        await self.send_raw_frame(realtime.wrap_stream_frame(frame, stream, event.get('seq')))
+
+    site_event = _forward
+    notify = _forward
+    dialog_event = _forward
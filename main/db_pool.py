@@ -0,0 +1,72 @@
+"""PostgreSQL connection pooling (psycopg_pool through Django's ``OPTIONS["pool"]``).
+
+Instead of one persistent TLS connection per worker thread
+(``CONN_MAX_AGE``), each process keeps a small pool: connections are
+checked with a round trip when they are handed out, recycled after
+``max_lifetime`` and closed after ``max_idle``, and a request waits at most
+``timeout`` seconds for one before failing. ``pool_stats()`` is registered
+as the ``db_pool`` runtime metrics provider.
+"""
+from django.db import connections
+
+# Counters from psycopg_pool's get_stats() that are reported as is.
+REPORTED_STATS = (
+    "pool_min",
+    "pool_max",
+    "pool_size",
+    "pool_available",
+    "requests_waiting",
+    "requests_num",
+    "requests_queued",
+    "requests_wait_ms",
+    "requests_errors",
+    "returns_bad",
+    "connections_num",
+    "connections_errors",
+    "connections_lost",
+)
+
+
+def check_connection(conn):
+    """Health check run on every checkout; broken connections are replaced."""
+    from psycopg_pool import ConnectionPool
+
+    ConnectionPool.check_connection(conn)
+
+
+def pool_options(min_size=2, max_size=10, timeout=10.0, max_lifetime=1800.0, max_idle=300.0) -> dict:
+    return {
+        "min_size": min_size,
+        "max_size": max_size,
+        "timeout": timeout,
+        "max_lifetime": max_lifetime,
+        "max_idle": max_idle,
+        "check": check_connection,
+    }
+
+
+def summarize(stats: dict) -> dict:
+    data = {key: stats.get(key, 0) for key in REPORTED_STATS}
+    in_use = data["pool_size"] - data["pool_available"]
+    data["in_use"] = in_use
+    data["saturation"] = round(in_use / data["pool_max"], 3) if data["pool_max"] else 0.0
+    data["wait_ms_avg"] = round(data["requests_wait_ms"] / data["requests_queued"], 1) if data["requests_queued"] else 0.0
+    return data
+
+
+def pool_stats() -> dict:
+    data = {}
+    for alias in connections:
+        wrapper = connections[alias]
+        if wrapper.vendor != "postgresql" or not wrapper.settings_dict["OPTIONS"].get("pool"):
+            continue
+        # Only pools this process has opened; reading .pool would create one.
+        pool = type(wrapper)._connection_pools.get(alias)
+        data[alias] = summarize(pool.get_stats()) if pool is not None else {"opened": False}
+    return data
+
+
+def register_metrics():
+    from . import metrics as runtime_metrics
+
+    runtime_metrics.register("db_pool", pool_stats)
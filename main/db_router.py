@@ -0,0 +1,130 @@
+"""Read replicas with read-your-writes stickiness.
+
+``DATABASE_REPLICA_URLS`` (comma separated) adds ``replica1``,
+``replica2``, ... to ``DATABASES``; ``ReplicaRouter`` sends the reads made
+while handling a request to a random replica and every write to
+``default``. A request is pinned to the primary:
+
+* for unsafe methods (POST, PUT, ...), which usually read what they write;
+* once it has written anything, for the rest of the request;
+* for ``REPLICA_STICKY_SECONDS`` after a response that wrote, through the
+  ``REPLICA_PIN_COOKIE`` cookie, so the redirect after a form post shows
+  the new row even if the replica is behind;
+* inside ``transaction.atomic()`` on the primary.
+
+Code outside a request (management commands, the realtime publisher),
+sessions and the database cache always use the primary. Without
+replicas the router returns ``None`` and Django uses ``default`` as
+before.
+
+Locally: ``DATABASE_REPLICA_URLS=sqlite:///replica.sqlite3`` with a copy
+of ``db.sqlite3`` as the "replica".
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_PIN_COOKIE = "db_primary"
+# "django_cache" is DatabaseCache's table (the shared cache tier).
+PRIMARY_ONLY_APPS = {"sessions", "django_cache"}
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# One mutable dict per request, so writes recorded in a thread (sync ORM
+# under ASGI) are seen by the middleware afterwards.
+_routing_state = ContextVar("db_routing_state", default=None)
+
+
+def replica_aliases() -> list:
+    return [alias for alias in getattr(settings, "DATABASE_REPLICAS", []) if alias in connections.settings]
+
+
+def _pinned(state) -> bool:
+    return state is None or state["pinned"] or state["wrote"] or connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = replica_aliases()
+        if not replicas or model._meta.app_label in PRIMARY_ONLY_APPS:
+            return None
+        if _pinned(_routing_state.get()):
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _routing_state.get()
+        if state is not None and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            state["wrote"] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replica_aliases()
+
+
+@contextmanager
+def pin_to_primary():
+    """Send every read in the block to the primary."""
+    state = _routing_state.get()
+    if state is None:
+        yield
+        return
+    previous = state["pinned"]
+    state["pinned"] = True
+    try:
+        yield
+    finally:
+        state["pinned"] = previous
+
+
+class ReplicaRoutingMiddleware:
+    """Opens the routing state for a request and keeps recent writers on the primary."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = self._start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            state = _routing_state.get()
+            _routing_state.reset(token)
+        return self._finish(state, response)
+
+    async def __acall__(self, request):
+        token = self._start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            state = _routing_state.get()
+            _routing_state.reset(token)
+        return self._finish(state, response)
+
+    def _start(self, request):
+        pinned = request.method not in SAFE_METHODS or REPLICA_PIN_COOKIE in request.COOKIES
+        return _routing_state.set({"pinned": pinned, "wrote": False})
+
+    def _finish(self, state, response):
+        if state["wrote"] and replica_aliases():
+            response.set_cookie(
+                REPLICA_PIN_COOKIE, "1",
+                max_age=getattr(settings, "REPLICA_STICKY_SECONDS", 5),
+                httponly=True, samesite="Lax",
+            )
+        return response
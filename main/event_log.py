@@ -0,0 +1,76 @@
+"""Sequence numbers and replay for published realtime events.
+
+Every ``realtime.publish`` appends the event to a bounded log and gets a
+monotonically increasing sequence number back. Sockets carry the number
+with each frame; a client that reconnects sends the last number it saw
+and receives the events it missed, or a ``resync_required`` signal when
+the gap has already been evicted from the log.
+
+Seqs are taken before delivery and several workers publish concurrently,
+so a client can see seq N+1 before N, and on PostgreSQL a lower seq can
+commit after a higher one. Replays therefore start ``REPLAY_OVERLAP``
+seqs before the client's cursor, and clients deduplicate by seq.
+
+Channel layers shared between processes implement the ``event_log``
+extension themselves (see ``main.channel_layers``) so the numbering is
+global; other layers fall back to a process-local ring buffer.
+"""
+import collections
+import threading
+
+from django.conf import settings
+
+# Seqs before the client's cursor that a replay sends again (see above).
+REPLAY_OVERLAP = 100
+
+
+class LocalEventLog:
+    """Ring buffer of the last ``size`` events in this process."""
+
+    def __init__(self, size: int = 2000):
+        self._events = collections.deque(maxlen=size)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    async def append_event(self, groups, handler: str, frames: dict) -> int:
+        with self._lock:
+            self._seq += 1
+            self._events.append((self._seq, tuple(groups), {"type": handler, "frames": frames}))
+            return self._seq
+
+    async def events_since(self, seq: int, groups, overlap: int = 0) -> list[dict] | None:
+        """Events after ``seq - overlap`` for ``groups``, or ``None`` if the gap after ``seq`` was evicted."""
+        with self._lock:
+            if seq > self._seq:
+                # The log restarted (new process or flushed layer).
+                return None
+            if self._events and seq + 1 < self._events[0][0]:
+                return None
+            if not self._events and seq < self._seq:
+                return None
+            retained = [entry for entry in self._events if entry[0] > seq - overlap]
+        groups = set(groups)
+        return [
+            {**event, "seq": event_seq, "group": group}
+            for event_seq, event_groups, event in retained
+            for group in event_groups
+            if group in groups
+        ]
+
+    async def last_event_seq(self) -> int:
+        return self._seq
+
+
+_local_log = None
+_local_log_lock = threading.Lock()
+
+
+def get_event_log(channel_layer):
+    """Return the event log that goes with ``channel_layer``."""
+    if "event_log" in getattr(channel_layer, "extensions", ()):
+        return channel_layer
+    global _local_log
+    with _local_log_lock:
+        if _local_log is None:
+            _local_log = LocalEventLog(getattr(settings, "REALTIME_EVENT_LOG_SIZE", 2000))
+        return _local_log
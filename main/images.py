@@ -0,0 +1,202 @@
+"""Resized WebP derivatives of uploaded images.
+
+Each uploaded image gets a few smaller WebP copies under
+``MEDIA_ROOT/derived/``: square crops for avatars and width-limited
+versions for content images (never upscaled, so small originals get
+copies no wider than themselves). Names follow from the original's name
+(``derived/<name without extension>/<size>.webp``) so templates find
+them without a database lookup; the ``srcset`` tag in ``media_tags``
+emits them with their real widths and falls back to the original when
+none were generated.
+
+Uploads schedule their derivatives on a background thread
+(``schedule_derivatives``) so the request that saved the file does not
+wait for the resizing; ``manage.py build_image_derivatives`` covers
+anything the queue dropped.
+"""
+import io
+import logging
+import os
+import posixpath
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+DERIVED_PREFIX = "derived/"
+AVATAR_SIZES = (48, 96, 192)
+CONTENT_WIDTHS = (320, 640, 1280)
+WEBP_QUALITY = 80
+READY_CACHE_SECONDS = 600
+QUEUE_SIZE = 1000
+
+
+def sizes_for(kind: str) -> tuple:
+    return AVATAR_SIZES if kind == "avatar" else CONTENT_WIDTHS
+
+
+def derivative_name(name: str, size: int) -> str:
+    stem, _ = posixpath.splitext(name)
+    return f"{DERIVED_PREFIX}{stem}/{size}.webp"
+
+
+def _ready_key(name: str) -> str:
+    return f"img-derived:v2:{name}"
+
+
+def _render(image: Image.Image, kind: str, size: int) -> bytes:
+    if kind == "avatar":
+        resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    else:
+        resized = image.copy()
+        resized.thumbnail((size, size * 10), Image.LANCZOS)
+    out = io.BytesIO()
+    resized.save(out, "WEBP", quality=WEBP_QUALITY, method=4)
+    return out.getvalue()
+
+
+def generate_derivatives(name: str, kind: str, storage=None, force=False) -> list[int]:
+    """Write the derivatives of the stored image ``name``; returns their sizes."""
+    storage = storage or default_storage
+    try:
+        with storage.open(name, "rb") as source:
+            image = Image.open(source)
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (OSError, UnidentifiedImageError) as exc:
+        logger.warning("Cannot build derivatives for %s: %s", name, exc)
+        return []
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "P") else "RGB")
+
+    widths = {}
+    for size in sizes_for(kind):
+        target = derivative_name(name, size)
+        if storage.exists(target):
+            if not force:
+                width = _stored_width(storage, target)
+                if width:
+                    widths[size] = width
+                continue
+            storage.delete(target)
+        data = _render(image, kind, size)
+        storage.save(target, ContentFile(data))
+        widths[size] = Image.open(io.BytesIO(data)).width
+    cache.set(_ready_key(name), widths, READY_CACHE_SECONDS)
+    return list(widths)
+
+
+def _stored_width(storage, name: str) -> int:
+    try:
+        with storage.open(name, "rb") as derived:
+            return Image.open(derived).width
+    except (OSError, UnidentifiedImageError):
+        return 0
+
+
+def derivative_widths(name: str, kind: str, storage=None) -> dict:
+    """``{size: real width}`` of the derivatives of ``name``; empty until the
+    largest one (written last) exists. Small originals are never upscaled,
+    so several sizes may share the original's width."""
+    key = _ready_key(name)
+    widths = cache.get(key)
+    if widths is None:
+        storage = storage or default_storage
+        widths = {}
+        if storage.exists(derivative_name(name, sizes_for(kind)[-1])):
+            for size in sizes_for(kind):
+                width = _stored_width(storage, derivative_name(name, size))
+                if width:
+                    widths[size] = width
+        cache.set(key, widths, READY_CACHE_SECONDS)
+    return widths
+
+
+def delete_derivatives(name: str, storage=None):
+    storage = storage or default_storage
+    for size in set(AVATAR_SIZES) | set(CONTENT_WIDTHS):
+        target = derivative_name(name, size)
+        if storage.exists(target):
+            storage.delete(target)
+    cache.delete(_ready_key(name))
+
+
+def original_name(derived: str) -> str | None:
+    """Stem of the original for a derivative path (without extension), or None."""
+    if not derived.startswith(DERIVED_PREFIX):
+        return None
+    return posixpath.dirname(derived[len(DERIVED_PREFIX):]) or None
+
+
+def iter_image_fields():
+    """Yield ``(model, field_name, kind)`` for every image field with derivatives."""
+    from .models import IMAGE_DERIVATIVE_FIELDS
+
+    for model, fields in IMAGE_DERIVATIVE_FIELDS.items():
+        for field_name, kind in fields:
+            yield model, field_name, kind
+
+
+_lock = threading.Lock()
+_pid = None
+_queue = None
+
+
+def schedule_derivatives(name: str, kind: str) -> bool:
+    """Build the derivatives of ``name`` on the background thread; returns
+    False when the queue was full (the backfill command catches up)."""
+    if not getattr(settings, "IMAGE_DERIVATIVES_IN_BACKGROUND", True):
+        generate_derivatives(name, kind)
+        return True
+    try:
+        _ensure_worker().put_nowait((name, kind))
+    except queue.Full:
+        logger.warning("Derivative queue is full, skipping %s", name)
+        return False
+    return True
+
+
+def flush(timeout: float = 10.0) -> bool:
+    """Wait until every scheduled image has been handled (tests, shutdown)."""
+    if _queue is None or _pid != os.getpid():
+        return True
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def _ensure_worker() -> queue.Queue:
+    global _pid, _queue
+    pid = os.getpid()
+    with _lock:
+        # A forked worker inherits the queue but not the thread.
+        if _pid != pid:
+            _queue = queue.Queue(QUEUE_SIZE)
+            threading.Thread(target=_run, args=(_queue,), name="image-derivatives", daemon=True).start()
+            _pid = pid
+        return _queue
+
+
+def _run(jobs):
+    while True:
+        name, kind = jobs.get()
+        try:
+            generate_derivatives(name, kind)
+        except Exception:
+            logger.exception("Building derivatives for %s failed", name)
+        finally:
+            # The cache or storage may have opened a connection on this thread.
+            close_old_connections()
+            jobs.task_done()
@@ -0,0 +1,196 @@
+"""Opt-in per-request instrumentation (``REQUEST_INSTRUMENTATION=1``).
+
+``RequestInstrumentationMiddleware`` aggregates, per resolved URL name,
+the request count, a latency histogram, SQL query count and time, and
+cache hits and misses. Each response gets a ``Server-Timing`` header.
+The totals are part of the runtime metrics (``/internal/metrics/``,
+staff or ``METRICS_TOKEN`` only) and, with
+``REQUEST_INSTRUMENTATION_SNAPSHOT_DIR`` set, are written as JSON every
+``REQUEST_INSTRUMENTATION_SNAPSHOT_SECONDS``.
+
+Queries are counted by an observer of the shared execute wrapper
+(``observability.observe_queries``), and cache reads by wrapping the
+configured cache backends' ``get``/``get_many``. Both read the current
+request's counters from a context variable, which asgiref carries into
+``sync_to_async`` threads, so async views are counted too.
+"""
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics as runtime_metrics
+from .observability import RequestHookMiddleware, observe_queries, write_json_snapshot
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+UNRESOLVED = "<unresolved>"
+
+_current = ContextVar("request_instrumentation", default=None)
+_MISSING = object()
+
+
+class RequestStats:
+    """Per URL name totals for this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        self.started_at = time.time()
+
+    def record(self, view_name, status, duration_ms, counters):
+        with self._lock:
+            view = self._views.get(view_name)
+            if view is None:
+                view = self._views[view_name] = {
+                    "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                    "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                    "queries": 0, "query_ms": 0.0, "cache_hits": 0, "cache_misses": 0,
+                }
+            view["count"] += 1
+            view["errors"] += status >= 500
+            view["total_ms"] += duration_ms
+            view["max_ms"] = max(view["max_ms"], duration_ms)
+            view["buckets"][_bucket(duration_ms)] += 1
+            view["queries"] += counters["queries"]
+            view["query_ms"] += counters["query_ms"]
+            view["cache_hits"] += counters["cache_hits"]
+            view["cache_misses"] += counters["cache_misses"]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            views = {name: dict(view, buckets=list(view["buckets"])) for name, view in self._views.items()}
+        for view in views.values():
+            view["avg_ms"] = round(view["total_ms"] / view["count"], 2)
+            view["queries_avg"] = round(view["queries"] / view["count"], 2)
+            view["total_ms"] = round(view["total_ms"], 2)
+            view["query_ms"] = round(view["query_ms"], 2)
+            view["max_ms"] = round(view["max_ms"], 2)
+        return {
+            "since": self.started_at,
+            "buckets_ms": list(LATENCY_BUCKETS_MS) + ["+Inf"],
+            "views": views,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+            self.started_at = time.time()
+
+
+def _bucket(duration_ms) -> int:
+    for index, bound in enumerate(LATENCY_BUCKETS_MS):
+        if duration_ms <= bound:
+            return index
+    return len(LATENCY_BUCKETS_MS)
+
+
+stats = RequestStats()
+
+
+def _count_query(sql, many, context, duration_ms, error):
+    counters = _current.get()
+    if counters is not None:
+        counters["queries"] += 1
+        counters["query_ms"] += duration_ms
+
+
+def _count_cache_read(hits, misses):
+    counters = _current.get()
+    if counters is not None:
+        counters["cache_hits"] += hits
+        counters["cache_misses"] += misses
+
+
+def _wrap_cache_class(cls):
+    if getattr(cls, "_request_instrumented", False):
+        return
+    original_get, original_get_many = cls.get, cls.get_many
+
+    def get(self, key, default=None, version=None):
+        counters = _current.get()
+        if counters is None or counters["_in_cache"]:
+            return original_get(self, key, default, version)
+        counters["_in_cache"] = True
+        try:
+            value = original_get(self, key, _MISSING, version)
+        finally:
+            counters["_in_cache"] = False
+        _count_cache_read(value is not _MISSING, value is _MISSING)
+        return default if value is _MISSING else value
+
+    def get_many(self, keys, version=None):
+        counters = _current.get()
+        if counters is None or counters["_in_cache"]:
+            return original_get_many(self, keys, version)
+        keys = list(keys)
+        # BaseCache.get_many() calls get(); count the batch once.
+        counters["_in_cache"] = True
+        try:
+            found = original_get_many(self, keys, version)
+        finally:
+            counters["_in_cache"] = False
+        _count_cache_read(len(found), len(keys) - len(found))
+        return found
+
+    cls.get, cls.get_many = get, get_many
+    cls._request_instrumented = True
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def install():
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        observe_queries(_count_query)
+        for alias in settings.CACHES:
+            _wrap_cache_class(type(caches[alias]))
+        runtime_metrics.register("requests", stats.snapshot)
+        _installed = True
+
+
+def server_timing(counters, duration_ms) -> str:
+    return ", ".join((
+        f'db;dur={counters["query_ms"]:.1f};desc="{counters["queries"]} queries"',
+        f'cache;desc="{counters["cache_hits"]} hits, {counters["cache_misses"]} misses"',
+        f"total;dur={duration_ms:.1f}",
+    ))
+
+
+class RequestInstrumentationMiddleware(RequestHookMiddleware):
+    @property
+    def snapshot_interval(self):
+        return getattr(settings, "REQUEST_INSTRUMENTATION_SNAPSHOT_SECONDS", 60)
+
+    def install(self):
+        install()
+
+    def around(self, request):
+        counters = {"queries": 0, "query_ms": 0.0, "cache_hits": 0, "cache_misses": 0, "_in_cache": False}
+        token = _current.set(counters)
+        started = time.perf_counter()
+        try:
+            response = yield
+        finally:
+            _current.reset(token)
+        duration_ms = (time.perf_counter() - started) * 1000
+        match = getattr(request, "resolver_match", None)
+        view_name = (match.view_name if match else "") or UNRESOLVED
+        stats.record(view_name, response.status_code, duration_ms, counters)
+        response["Server-Timing"] = server_timing(counters, duration_ms)
+        snapshot_dir = getattr(settings, "REQUEST_INSTRUMENTATION_SNAPSHOT_DIR", "")
+        if snapshot_dir and self.snapshot_due():
+            write_snapshot(snapshot_dir)
+        return response
+
+
+def write_snapshot(directory) -> str:
+    data = dict(stats.snapshot(), pid=os.getpid(), written_at=time.time())
+    return write_json_snapshot(directory, f"requests-{os.getpid()}.json", data)
@@ -0,0 +1,320 @@
+"""Load benchmark against a running server (``manage.py benchmark_load``).
+
+Simulated clients are threads. HTTP clients log in as generated users
+(``generate_forum_data``) and loop over weighted view scenarios on a
+keep-alive connection; WebSocket clients open ``/ws/stream/`` and time
+dialog events travelling through the channel layer and back. Only the
+standard library is used, so the harness runs wherever the server does.
+"""
+import base64
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+
+def percentile(sorted_values, q) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LatencyStats:
+    """Latencies and errors per endpoint, shared by all client threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._errors = {}
+
+    def record(self, endpoint, seconds, ok=True):
+        with self._lock:
+            if ok:
+                self._samples.setdefault(endpoint, []).append(seconds)
+            else:
+                self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+
+    def summary(self, duration) -> list:
+        with self._lock:
+            endpoints = sorted(set(self._samples) | set(self._errors))
+            rows = []
+            for endpoint in endpoints:
+                samples = sorted(self._samples.get(endpoint, []))
+                rows.append({
+                    "endpoint": endpoint,
+                    "requests": len(samples),
+                    "errors": self._errors.get(endpoint, 0),
+                    "rps": round(len(samples) / duration, 1) if duration else 0.0,
+                    "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                    "p95_ms": round(percentile(samples, 95) * 1000, 1),
+                    "p99_ms": round(percentile(samples, 99) * 1000, 1),
+                })
+        return rows
+
+
+class HttpClient:
+    """One browser: a keep-alive connection plus session and CSRF cookies."""
+
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.cookies = {}
+        self._conn = None
+
+    def request(self, method, path, data=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if method == "POST" and "csrftoken" in self.cookies:
+            headers["X-CSRFToken"] = self.cookies["csrftoken"]
+        for attempt in (1, 2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self._conn.request(method, path, body=body, headers=headers)
+                response = self._conn.getresponse()
+                content = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # The server closed an idle keep-alive connection; retry once.
+                self.close()
+                if attempt == 2:
+                    raise
+        for header in response.msg.get_all("Set-Cookie") or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return response.status, content
+
+    def login(self, username, password) -> bool:
+        self.request("GET", "/login/")
+        status, _ = self.request("POST", "/login/", {
+            "username": username,
+            "password": password,
+            "csrfmiddlewaretoken": self.cookies.get("csrftoken", ""),
+        })
+        return status == 302 and "sessionid" in self.cookies
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class WebSocketClient:
+    """Minimal RFC 6455 client (text frames, client-side masking)."""
+
+    def __init__(self, base_url, path, cookies=None, timeout=30):
+        parts = urlsplit(base_url)
+        self.sock = socket.create_connection((parts.hostname, parts.port or 80), timeout=timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {parts.netloc}",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            f"Sec-WebSocket-Key: {key}",
+            "Sec-WebSocket-Version: 13",
+            f"Origin: {base_url}",
+        ]
+        if cookies:
+            request.append("Cookie: " + "; ".join(f"{k}={v}" for k, v in cookies.items()))
+        self.sock.sendall(("\r\n".join(request) + "\r\n\r\n").encode())
+        self._buffer = b""
+        head = self._read_until(b"\r\n\r\n")
+        if not head.startswith(b"HTTP/1.1 101"):
+            self.sock.close()
+            raise ConnectionError(head.split(b"\r\n", 1)[0].decode(errors="replace"))
+
+    def _read_until(self, marker):
+        while marker not in self._buffer:
+            self._fill()
+        head, self._buffer = self._buffer.split(marker, 1)
+        return head
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed")
+        self._buffer += chunk
+
+    def _read_exact(self, n):
+        while len(self._buffer) < n:
+            self._fill()
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def send_text(self, text):
+        self.sock.sendall(encode_frame(text.encode(), opcode=0x1, mask=True))
+
+    def recv(self):
+        """Next data frame payload (str for text, bytes for binary); answers pings."""
+        while True:
+            opcode, payload = decode_frame(self._read_exact)
+            if opcode == 0x9:
+                self.sock.sendall(encode_frame(payload, opcode=0xA, mask=True))
+            elif opcode == 0x8:
+                raise ConnectionError("closed by server")
+            elif opcode == 0x1:
+                return payload.decode()
+            elif opcode == 0x2:
+                return payload
+
+    def close(self):
+        try:
+            self.sock.sendall(encode_frame(struct.pack("!H", 1000), opcode=0x8, mask=True))
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def encode_frame(payload: bytes, opcode=0x1, mask=True) -> bytes:
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header += bytes([mask_bit | length])
+    elif length < 1 << 16:
+        header += bytes([mask_bit | 126]) + struct.pack("!H", length)
+    else:
+        header += bytes([mask_bit | 127]) + struct.pack("!Q", length)
+    if not mask:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+
+
+def decode_frame(read) -> tuple:
+    """Read one frame with ``read(n)``; returns (opcode, payload). Fragments are not expected."""
+    first, second = read(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", read(8))[0]
+    key = read(4) if second & 0x80 else None
+    payload = read(length)
+    if key:
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+    return first & 0x0F, payload
+
+
+class Fixture:
+    """Ids the scenarios pick from, read from the database the server uses."""
+
+    def __init__(self, usernames, topic_ids, dialogs_by_user, password):
+        self.usernames = usernames
+        self.topic_ids = topic_ids
+        self.dialogs_by_user = dialogs_by_user
+        self.password = password
+
+
+# (name, weight, method, path(fixture, client_state, rng), data, extra headers)
+HTTP_SCENARIOS = (
+    ("home", 20, "GET", lambda f, s, rng: "/", None, None),
+    ("home_search", 5, "GET", lambda f, s, rng: "/?" + urlencode({"q": rng.choice(("семья", "склад", "гайд")), "sort": "popular"}), None, None),
+    ("topic_detail", 30, "GET", lambda f, s, rng: f"/topic/{rng.choice(f.topic_ids)}/", None, None),
+    ("dialogs", 8, "GET", lambda f, s, rng: "/dialogs/", None, None),
+    ("dialog_detail", 8, "GET", lambda f, s, rng: f"/dialogs/{rng.choice(s['dialogs'])}/" if s["dialogs"] else "/dialogs/", None, None),
+    ("notifications", 6, "GET", lambda f, s, rng: "/notifications/", None, None),
+    ("profile", 5, "GET", lambda f, s, rng: "/profile/", None, None),
+    ("family_hq", 5, "GET", lambda f, s, rng: "/family/hq/", None, None),
+    ("comment", 8, "POST", lambda f, s, rng: f"/topic/{rng.choice(f.topic_ids)}/", {"content": "нагрузочный комментарий"}, {"X-Requested-With": "XMLHttpRequest"}),
+    ("topic_like", 5, "POST", lambda f, s, rng: f"/toggle_topic_like/{rng.choice(f.topic_ids)}/", {}, None),
+)
+
+
+def run_http_client(base_url, fixture, stats, deadline, index, scenarios=HTTP_SCENARIOS):
+    rng = random.Random(index)
+    username = fixture.usernames[index % len(fixture.usernames)]
+    client = HttpClient(base_url)
+    try:
+        if not client.login(username, fixture.password):
+            stats.record("login", 0, ok=False)
+            return
+        state = {"dialogs": fixture.dialogs_by_user.get(username, [])}
+        weights = [scenario[1] for scenario in scenarios]
+        while time.monotonic() < deadline:
+            name, _, method, path, data, headers = rng.choices(scenarios, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, _ = client.request(method, path(fixture, state, rng), data, headers)
+                stats.record(name, time.perf_counter() - started, ok=status < 400)
+            except (OSError, http.client.HTTPException):
+                stats.record(name, 0, ok=False)
+    finally:
+        client.close()
+
+
+def run_ws_client(base_url, fixture, stats, deadline, index, round_trips=20):
+    rng = random.Random(10_000 + index)
+    candidates = [u for u in fixture.usernames if fixture.dialogs_by_user.get(u)] or fixture.usernames
+    username = candidates[index % len(candidates)]
+    http_client = HttpClient(base_url)
+    try:
+        if not http_client.login(username, fixture.password):
+            stats.record("ws_login", 0, ok=False)
+            return
+    finally:
+        http_client.close()
+    dialogs = fixture.dialogs_by_user.get(username) or []
+    while time.monotonic() < deadline:
+        stream = f"dialog:{rng.choice(dialogs)}" if dialogs else "site"
+        started = time.perf_counter()
+        try:
+            ws = WebSocketClient(base_url, f"/ws/stream/?streams={stream}", http_client.cookies)
+            ws.recv()  # the "hello" control frame
+        except (OSError, ConnectionError):
+            stats.record("ws_connect", 0, ok=False)
+            time.sleep(0.1)
+            continue
+        stats.record("ws_connect", time.perf_counter() - started)
+        try:
+            for n in range(round_trips if dialogs else 0):
+                if time.monotonic() >= deadline:
+                    break
+                token = f"bench-{index}-{n}"
+                started = time.perf_counter()
+                ws.send_text(json.dumps({"action": "publish", "stream": stream, "data": {"type": "typing", "token": token}}))
+                # Other clients share the dialog; wait for our own event.
+                while token not in str(ws.recv()):
+                    pass
+                stats.record("ws_dialog_echo", time.perf_counter() - started)
+        except (OSError, ConnectionError):
+            stats.record("ws_dialog_echo", 0, ok=False)
+        finally:
+            ws.close()
+
+
+def run(base_url, fixture, clients=10, ws_clients=0, seconds=30.0) -> tuple:
+    """Drive the server for ``seconds``; returns (summary rows, elapsed seconds)."""
+    stats = LatencyStats()
+    deadline = time.monotonic() + seconds
+    threads = [
+        threading.Thread(target=run_http_client, args=(base_url, fixture, stats, deadline, i), daemon=True)
+        for i in range(clients)
+    ]
+    threads += [
+        threading.Thread(target=run_ws_client, args=(base_url, fixture, stats, deadline, i), daemon=True)
+        for i in range(ws_clients)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return stats.summary(elapsed), elapsed
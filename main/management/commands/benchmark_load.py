@@ -0,0 +1,62 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import loadtest
+from main.models import CustomUser, DialogParticipant, Topic
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест запущенного сервера: параллельные HTTP-клиенты ходят по основным страницам '
+        'и пишут комментарии, WebSocket-клиенты меряют доставку событий диалога. Пользователи берутся '
+        'из generate_forum_data. Выводит p50/p95/p99 и пропускную способность по каждому эндпоинту'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Адрес запущенного сервера')
+        parser.add_argument('--clients', type=int, default=20, help='HTTP-клиентов')
+        parser.add_argument('--ws-clients', type=int, default=10, help='WebSocket-клиентов')
+        parser.add_argument('--seconds', type=float, default=30.0)
+        parser.add_argument('--prefix', default='load', help='Префикс пользователей generate_forum_data')
+        parser.add_argument('--password', default='loadtest12345')
+        parser.add_argument('--topics', type=int, default=2000, help='Сколько тем участвует в выборке')
+        parser.add_argument('--json', dest='json_path', help='Записать результаты в JSON-файл')
+
+    def handle(self, *args, **options):
+        fixture = self._fixture(options)
+        self.stdout.write(
+            f"{options['clients']} HTTP и {options['ws_clients']} WebSocket клиентов, "
+            f"{options['seconds']:.0f} с на {options['url']}…"
+        )
+        rows, elapsed = loadtest.run(
+            options['url'], fixture,
+            clients=options['clients'], ws_clients=options['ws_clients'], seconds=options['seconds'],
+        )
+        self.stdout.write(f"{'эндпоинт':<16}{'запросов':>10}{'ошибок':>8}{'в с':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}")
+        for row in rows:
+            self.stdout.write(
+                f"{row['endpoint']:<16}{row['requests']:>10}{row['errors']:>8}{row['rps']:>8.1f}"
+                f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}"
+            )
+        total = sum(row['requests'] for row in rows)
+        self.stdout.write(self.style.SUCCESS(f'Всего {total} запросов, {total / elapsed:.1f} в секунду'))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump({'url': options['url'], 'seconds': elapsed, 'endpoints': rows}, f, ensure_ascii=False, indent=2)
+
+    def _fixture(self, options):
+        users_needed = max(options['clients'], options['ws_clients'], 1)
+        usernames = list(
+            CustomUser.objects.filter(username__startswith=f"{options['prefix']}_")
+            .order_by('id').values_list('username', flat=True)[:users_needed]
+        )
+        if not usernames:
+            raise CommandError(f"Нет пользователей с префиксом \"{options['prefix']}_\": сначала выполните generate_forum_data")
+        topic_ids = list(Topic.objects.order_by('id').values_list('id', flat=True)[:options['topics']])
+        if not topic_ids:
+            raise CommandError('В базе нет тем')
+        dialogs_by_user = {}
+        for username, dialog_id in DialogParticipant.objects.filter(user__username__in=usernames).values_list('user__username', 'dialog_id'):
+            dialogs_by_user.setdefault(username, []).append(dialog_id)
+        return loadtest.Fixture(usernames, topic_ids, dialogs_by_user, options['password'])
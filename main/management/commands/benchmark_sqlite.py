@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.sqlite import BUSY_MESSAGES, pragmas
+
+SCHEMA = (
+    "CREATE TABLE topic (id INTEGER PRIMARY KEY, likes INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE topic_like (id INTEGER PRIMARY KEY, topic_id INTEGER NOT NULL, user_id INTEGER NOT NULL, created_at REAL NOT NULL)",
+    "CREATE INDEX topic_like_topic ON topic_like (topic_id)",
+)
+TOPICS = 200
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает производительность SQLite в режиме по умолчанию (rollback journal, BEGIN DEFERRED) '
+        'и в production-профиле (WAL, synchronous=NORMAL, busy_timeout, mmap, BEGIN IMMEDIATE) '
+        'на временных файлах с параллельными писателями и читателями'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=10.0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'профиль':<12}{'записей/с':>11}{'чтений/с':>10}{'p95 записи':>12}{'ошибок locked':>15}")
+        for profile in ('default', 'production'):
+            with tempfile.TemporaryDirectory() as tmp:
+                result = self._run(os.path.join(tmp, 'bench.sqlite3'), profile, options)
+            self.stdout.write(
+                f"{profile:<12}{result['writes'] / options['seconds']:>11.0f}{result['reads'] / options['seconds']:>10.0f}"
+                f"{result['p95_ms']:>9.1f} ms{result['locked']:>15}"
+            )
+
+    def _connect(self, path, profile):
+        # 5 s is what Django passes to sqlite3 by default.
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        if profile == 'production':
+            for pragma in pragmas():
+                conn.execute(pragma)
+        return conn
+
+    def _run(self, path, profile, options):
+        conn = self._connect(path, profile)
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.executemany("INSERT INTO topic (id) VALUES (?)", [(i,) for i in range(1, TOPICS + 1)])
+        conn.close()
+
+        begin = 'BEGIN IMMEDIATE' if profile == 'production' else 'BEGIN'
+        deadline = time.monotonic() + options['seconds']
+        lock = threading.Lock()
+        result = {'writes': 0, 'reads': 0, 'locked': 0, 'latencies': []}
+
+        def writer(worker):
+            conn = self._connect(path, profile)
+            latencies, writes, locked, n = [], 0, 0, 0
+            while time.monotonic() < deadline:
+                n += 1
+                topic_id = (worker * 7919 + n) % TOPICS + 1
+                started = time.perf_counter()
+                try:
+                    # The shape of a like toggle: check, insert, bump the counter.
+                    conn.execute(begin)
+                    conn.execute("SELECT likes FROM topic WHERE id = ?", (topic_id,)).fetchone()
+                    conn.execute(
+                        "INSERT INTO topic_like (topic_id, user_id, created_at) VALUES (?, ?, ?)",
+                        (topic_id, worker, time.time()),
+                    )
+                    conn.execute("UPDATE topic SET likes = likes + 1 WHERE id = ?", (topic_id,))
+                    conn.execute("COMMIT")
+                    writes += 1
+                    latencies.append(time.perf_counter() - started)
+                except sqlite3.OperationalError as exc:
+                    if not any(text in str(exc) for text in BUSY_MESSAGES):
+                        raise
+                    locked += 1
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+            conn.close()
+            with lock:
+                result['writes'] += writes
+                result['locked'] += locked
+                result['latencies'].extend(latencies)
+
+        def reader(worker):
+            conn = self._connect(path, profile)
+            reads, n = 0, 0
+            while time.monotonic() < deadline:
+                n += 1
+                topic_id = (worker * 104729 + n) % TOPICS + 1
+                try:
+                    conn.execute("SELECT likes FROM topic WHERE id = ?", (topic_id,)).fetchone()
+                    conn.execute("SELECT COUNT(*) FROM topic_like WHERE topic_id = ?", (topic_id,)).fetchone()
+                    reads += 1
+                except sqlite3.OperationalError as exc:
+                    if not any(text in str(exc) for text in BUSY_MESSAGES):
+                        raise
+            conn.close()
+            with lock:
+                result['reads'] += reads
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(options['writers'])]
+        threads += [threading.Thread(target=reader, args=(i,)) for i in range(options['readers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        latencies = sorted(result['latencies'])
+        result['p95_ms'] = statistics.quantiles(latencies, n=20)[-1] * 1000 if len(latencies) > 1 else 0.0
+        return result
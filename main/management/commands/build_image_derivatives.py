@@ -0,0 +1,27 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from main import images
+
+
+class Command(BaseCommand):
+    help = 'Создаёт уменьшенные WebP-копии для уже загруженных аватаров и изображений (media/avatars, posts, comments, topics ...)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Пересоздать уже существующие копии')
+
+    def handle(self, *args, **options):
+        built = missing = 0
+        for model, field_name, kind in images.iter_image_fields():
+            names = (
+                model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                .order_by().values_list(field_name, flat=True).distinct()
+            )
+            for name in names.iterator():
+                if not default_storage.exists(name):
+                    missing += 1
+                    continue
+                if images.generate_derivatives(name, kind, force=options['force']):
+                    built += 1
+            self.stdout.write(f'{model.__name__}.{field_name}: готово')
+        self.stdout.write(self.style.SUCCESS(f'Обработано изображений: {built}, отсутствуют на диске: {missing}'))
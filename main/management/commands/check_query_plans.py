@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.query_plans import check_plans
+
+
+class Command(BaseCommand):
+    help = 'Проверяет планы (EXPLAIN) горячих запросов и падает, если какой-то из них читает таблицу целиком'
+
+    def handle(self, *args, **options):
+        failed = []
+        for report in check_plans():
+            if report.ok:
+                note = ' (сортировка без индекса)' if report.sorts else ''
+                self.stdout.write(f'OK    {report.label}{note}')
+            else:
+                failed.append(report.label)
+                self.stdout.write(self.style.ERROR(f"SCAN  {report.label}: {', '.join(report.full_scans)}"))
+            if options['verbosity'] > 1 or not report.ok:
+                for line in report.plan.splitlines():
+                    self.stdout.write(f'      {line}')
+        if failed:
+            raise CommandError(f"Полный просмотр таблицы в запросах: {', '.join(failed)}")
+        self.stdout.write(self.style.SUCCESS('Все горячие запросы используют индексы.'))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from main.media_gc import DEFAULT_GRACE_SECONDS, collect_orphaned_media
+
+
+class Command(BaseCommand):
+    help = 'Удаляет из MEDIA_ROOT файлы, на которые больше не ссылается ни одна запись (запускать по cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет удалено')
+        parser.add_argument('--grace', type=int, default=DEFAULT_GRACE_SECONDS, help='Не трогать файлы моложе N секунд')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        log = self.stdout.write if options['verbosity'] > 1 or options['dry_run'] else None
+        stats = collect_orphaned_media(
+            grace_seconds=options['grace'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            log=log,
+        )
+        verb = 'Будет удалено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f"Проверено файлов: {stats['scanned']}, без ссылок: {stats['orphaned']} "
+            f"(моложе периода ожидания: {stats['too_new']}). {verb}: {stats['deleted']} ({stats['bytes']} байт), "
+            f"брошенных загрузок: {stats['stale_uploads']}"
+        ))
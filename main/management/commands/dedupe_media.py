@@ -0,0 +1,77 @@
+import hashlib
+from collections import defaultdict
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from main import images
+from main.models import IMAGE_DERIVATIVE_FIELDS, MEDIA_FILE_FIELDS, MediaBlob
+from main.storage import ContentAddressedStorage, is_content_addressed
+
+
+class Command(BaseCommand):
+    help = 'Переносит загруженные файлы в контентно-адресуемое хранилище, схлопывая дубликаты, и пересчитывает ссылки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать дубликаты и экономию места')
+        parser.add_argument('--keep-originals', action='store_true', help='Не удалять старые файлы после переноса')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError('STORAGES["default"] должен быть main.storage.ContentAddressedStorage')
+
+        legacy_names = set()
+        for model, field_names in MEDIA_FILE_FIELDS.items():
+            for field_name in field_names:
+                names = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                legacy_names.update(
+                    name for name in names.order_by().values_list(field_name, flat=True).distinct()
+                    if not is_content_addressed(name)
+                )
+
+        missing = sorted(name for name in legacy_names if not default_storage.exists(name))
+        legacy_names -= set(missing)
+        for name in missing:
+            self.stderr.write(f'Нет файла на диске: {name}')
+
+        if options['dry_run']:
+            self._report_duplicates(legacy_names)
+            return
+
+        moved = {}
+        for name in sorted(legacy_names):
+            moved[name] = default_storage.store_existing(name)
+
+        for model, field_names in MEDIA_FILE_FIELDS.items():
+            kinds = dict(IMAGE_DERIVATIVE_FIELDS.get(model, ()))
+            for field_name in field_names:
+                for old_name, blob in moved.items():
+                    # queryset.update() skips the refcount signals; recount() below settles them.
+                    updated = model.objects.filter(**{field_name: old_name}).update(**{field_name: blob})
+                    if updated and field_name in kinds:
+                        images.generate_derivatives(blob, kinds[field_name])
+
+        if not options['keep_originals']:
+            for old_name in moved:
+                default_storage.delete(old_name)
+                images.delete_derivatives(old_name)
+
+        blobs = MediaBlob.recount()
+        self.stdout.write(self.style.SUCCESS(
+            f'Перенесено файлов: {len(moved)}, уникальных: {len(set(moved.values()))}, всего блобов: {blobs}'
+        ))
+
+    def _report_duplicates(self, names):
+        groups = defaultdict(list)
+        for name in names:
+            sha = hashlib.sha256()
+            with default_storage.open(name, 'rb') as f:
+                for chunk in f.chunks():
+                    sha.update(chunk)
+            groups[sha.hexdigest()].append(name)
+        reclaimable = 0
+        for group in groups.values():
+            if len(group) > 1:
+                reclaimable += default_storage.size(group[0]) * (len(group) - 1)
+                self.stdout.write(' = '.join(sorted(group)))
+        self.stdout.write(f'Файлов: {len(names)}, уникальных: {len(groups)}, можно освободить: {reclaimable} байт')
@@ -0,0 +1,345 @@
+import itertools
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from main.models import (
+    DEFAULT_AVATARS,
+    Activity,
+    Category,
+    Comment,
+    CommentReaction,
+    CustomUser,
+    Dialog,
+    DialogParticipant,
+    FactionDossier,
+    FamilyOperation,
+    FamilyTask,
+    Message,
+    MessageRead,
+    Notification,
+    Post,
+    Profile,
+    Tag,
+    Topic,
+    TopicSubscription,
+    UserStats,
+)
+
+# Default volumes; --scale multiplies all of them.
+DEFAULTS = {
+    'users': 5000,
+    'categories': 12,
+    'tags': 300,
+    'topics': 100_000,
+    'posts': 200_000,
+    'comments': 1_000_000,
+    'topic_likes': 500_000,
+    'comment_likes': 1_000_000,
+    'subscriptions': 200_000,
+    'dialogs': 5000,
+    'messages': 1_000_000,
+    'notifications': 300_000,
+    'tasks': 20_000,
+    'operations': 2000,
+    'dossiers': 1000,
+}
+RANK_WEIGHTS = (
+    (CustomUser.RANK_ASSOCIATE, 60),
+    (CustomUser.RANK_SOLDIER, 25),
+    (CustomUser.RANK_CAPO, 10),
+    (CustomUser.RANK_CONSIGLIERE, 4),
+    (CustomUser.RANK_DON, 1),
+)
+WORDS = (
+    'семья', 'район', 'сходка', 'склад', 'порт', 'казино', 'отчёт', 'долг', 'поставка', 'капо',
+    'маршрут', 'встреча', 'ивент', 'правила', 'гайд', 'вопрос', 'машина', 'оружие', 'доки', 'бар',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Заполняет базу синтетическим форумом для нагрузочных тестов: пользователи с рангами, категории, теги, '
+        'темы, посты, комментарии с глубокими ветками ответов, лайки, подписки, диалоги с длинной историей, '
+        'уведомления, задачи и операции семьи. Все пользователи получают пароль --password'
+    )
+
+    def add_arguments(self, parser):
+        for name, default in DEFAULTS.items():
+            parser.add_argument(f'--{name.replace("_", "-")}', type=int, default=default)
+        parser.add_argument('--scale', type=float, default=1.0, help='Множитель для всех объёмов (0.01 — быстрый прогон)')
+        parser.add_argument('--max-depth', type=int, default=12, help='Максимальная глубина ветки ответов')
+        parser.add_argument('--prefix', default='load', help='Префикс имён пользователей, категорий и тегов')
+        parser.add_argument('--password', default='loadtest12345')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.prefix = options['prefix']
+        self.now = timezone.now()
+        counts = {name: max(1, int(options[name] * options['scale'])) for name in DEFAULTS}
+        counts['users'] = max(2, counts['users'])
+        if CustomUser.objects.filter(username__startswith=f'{self.prefix}_').exists():
+            raise CommandError(f'Пользователи с префиксом "{self.prefix}_" уже есть, укажите другой --prefix')
+
+        steps = (
+            ('Пользователи', lambda: self._users(counts['users'], options['password'])),
+            ('Категории и теги', lambda: self._categories(counts['categories'], counts['tags'])),
+            ('Темы', lambda: self._topics(counts['topics'])),
+            ('Посты', lambda: self._posts(counts['posts'])),
+            ('Комментарии', lambda: self._comments(counts['comments'], options['max_depth'])),
+            ('Лайки', lambda: self._likes(counts['topic_likes'], counts['comment_likes'])),
+            ('Подписки', lambda: self._subscriptions(counts['subscriptions'])),
+            ('Диалоги', lambda: self._dialogs(counts['dialogs'], counts['messages'])),
+            ('Уведомления', lambda: self._notifications(counts['notifications'])),
+            ('Семья', lambda: self._family(counts['tasks'], counts['operations'], counts['dossiers'])),
+            ('Статистика пользователей', lambda: UserStats.rebuild(self.user_ids)),
+        )
+        for title, step in steps:
+            started = time.monotonic()
+            with transaction.atomic():
+                created = step()
+            self.stdout.write(f'{title}: {created} ({time.monotonic() - started:.1f} с)')
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово. Вход: {self.prefix}_0 … {self.prefix}_{counts["users"] - 1}, пароль "{options["password"]}"'
+        ))
+
+    def _bulk(self, model, objs, **kwargs):
+        """Insert an iterable in chunks so millions of rows never sit in memory; returns the new ids."""
+        ids, objs = [], iter(objs)
+        while chunk := list(itertools.islice(objs, self.batch_size * 10)):
+            saved = model.objects.bulk_create(chunk, batch_size=self.batch_size, **kwargs)
+            ids += [obj.pk for obj in saved]
+        return ids
+
+    def _text(self, words=8):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(words)).capitalize()
+
+    def _pick_user(self):
+        return self.rng.choice(self.user_ids)
+
+    def _users(self, count, password):
+        # One hash for everybody: hashing a million passwords is not the point.
+        password_hash = make_password(password)
+        ranks, weights = zip(*RANK_WEIGHTS)
+        self.user_ids = self._bulk(CustomUser, (
+            CustomUser(
+                username=f'{self.prefix}_{i}',
+                password=password_hash,
+                family_rank=self.rng.choices(ranks, weights)[0],
+                last_login=self.now,
+            )
+            for i in range(count)
+        ))
+        # bulk_create() skips the post_save receiver that creates profiles.
+        self._bulk(Profile, (Profile(user_id=pk, default_avatar=self.rng.choice(DEFAULT_AVATARS)) for pk in self.user_ids))
+        return count
+
+    def _categories(self, categories, tags):
+        self.category_ids = self._bulk(Category, (
+            Category(name=f'{self.prefix} категория {i}', slug=f'{self.prefix}-category-{i}') for i in range(categories)
+        ))
+        self.tag_ids = self._bulk(Tag, (
+            Tag(name=f'{self.prefix}-{i}', slug=f'{self.prefix}-tag-{i}') for i in range(tags)
+        ))
+        return categories + tags
+
+    def _topics(self, count):
+        prefixes = [value for value, _ in Topic.PREFIX_CHOICES]
+        statuses = [value for value, _ in Topic.STATUS_CHOICES]
+        self.topic_ids = self._bulk(Topic, (
+            Topic(
+                author_id=self._pick_user(),
+                category_id=self.rng.choice(self.category_ids),
+                title=self._text(5),
+                description=self._text(30),
+                prefix=self.rng.choice(prefixes),
+                status=self.rng.choice(statuses),
+                is_pinned=self.rng.random() < 0.002,
+            )
+            for _ in range(count)
+        ))
+        through = Topic.tags.through
+        self._bulk(through, (
+            through(topic_id=topic_id, tag_id=tag_id)
+            for topic_id in self.topic_ids
+            for tag_id in self.rng.sample(self.tag_ids, min(len(self.tag_ids), self.rng.randint(0, 3)))
+        ), ignore_conflicts=True)
+        Activity.objects.bulk_create([
+            Activity(actor_id=self._pick_user(), verb='создал(а) тему', topic_id=topic_id)
+            for topic_id in self.topic_ids[-100:]
+        ])
+        return count
+
+    def _posts(self, count):
+        topic_ids = [self.rng.choice(self.topic_ids) for _ in range(count)]
+        post_ids = self._bulk(Post, (
+            Post(topic_id=topic_id, author_id=self._pick_user(), content=self._text(40)) for topic_id in topic_ids
+        ))
+        self.post_ids_by_topic = {}
+        for post_id, topic_id in zip(post_ids, topic_ids):
+            self.post_ids_by_topic.setdefault(topic_id, []).append(post_id)
+        return count
+
+    def _comments(self, count, max_depth):
+        """Reply trees per topic, inserted level by level so parents have ids."""
+        # Skewed towards a few hot topics, like a real forum.
+        topic_weights = [1.0 / (rank + 1) for rank in range(len(self.topic_ids))]
+        per_topic = {}
+        for topic_id in self.rng.choices(self.topic_ids, topic_weights, k=count):
+            per_topic[topic_id] = per_topic.get(topic_id, 0) + 1
+
+        self.comment_ids = []
+        deepest = 0
+        topics = list(per_topic.items())
+        for start in range(0, len(topics), 1000):
+            # Per level: (topic, index within the topic, post, parent index).
+            levels = [[] for _ in range(max_depth + 1)]
+            for topic_id, n in topics[start:start + 1000]:
+                depths, posts = [], []
+                for i in range(n):
+                    # Most comments answer a recent one, which makes long chains.
+                    parent = max(0, i - 1 - int(self.rng.expovariate(0.5))) if i and self.rng.random() < 0.7 else None
+                    if parent is not None and depths[parent] < max_depth:
+                        depths.append(depths[parent] + 1)
+                        posts.append(posts[parent])
+                    else:
+                        parent = None
+                        post_ids = self.post_ids_by_topic.get(topic_id)
+                        depths.append(0)
+                        posts.append(self.rng.choice(post_ids) if post_ids and self.rng.random() < 0.3 else None)
+                    levels[depths[-1]].append((topic_id, i, posts[-1], parent))
+
+            ids = {}
+            for depth, level in enumerate(levels):
+                if not level:
+                    break
+                deepest = max(deepest, depth)
+                saved = self._bulk(Comment, (
+                    Comment(
+                        topic_id=topic_id,
+                        post_id=post_id,
+                        parent_id=ids[(topic_id, parent)] if parent is not None else None,
+                        author_id=self._pick_user(),
+                        content=self._text(15),
+                    )
+                    for topic_id, _, post_id, parent in level
+                ))
+                for (topic_id, index, _, _), comment_id in zip(level, saved):
+                    ids[(topic_id, index)] = comment_id
+                self.comment_ids += saved
+        self.stdout.write(f'  самая глубокая ветка: {deepest + 1} уровней')
+        return count
+
+    def _likes(self, topic_likes, comment_likes):
+        through = Topic.likes.through
+        self._bulk(through, (
+            through(topic_id=self.rng.choice(self.topic_ids), customuser_id=self._pick_user())
+            for _ in range(topic_likes)
+        ), ignore_conflicts=True)
+        if self.comment_ids:
+            self._bulk(CommentReaction, (
+                CommentReaction(comment_id=self.rng.choice(self.comment_ids), user_id=self._pick_user(), reaction_type='like')
+                for _ in range(comment_likes)
+            ), ignore_conflicts=True)
+        return topic_likes + comment_likes
+
+    def _subscriptions(self, count):
+        self._bulk(TopicSubscription, (
+            TopicSubscription(user_id=self._pick_user(), topic_id=self.rng.choice(self.topic_ids))
+            for _ in range(count)
+        ), ignore_conflicts=True)
+        return count
+
+    def _dialogs(self, dialogs, messages):
+        dialog_ids = self._bulk(Dialog, (Dialog() for _ in range(dialogs)))
+        members = {dialog_id: self.rng.sample(self.user_ids, 2) for dialog_id in dialog_ids}
+        self._bulk(DialogParticipant, (
+            DialogParticipant(dialog_id=dialog_id, user_id=user_id)
+            for dialog_id, pair in members.items()
+            for user_id in pair
+        ))
+
+        # Long histories: a few dialogs carry most of the messages.
+        weights = [1.0 / (rank + 1) for rank in range(len(dialog_ids))]
+        for start in range(0, messages, self.batch_size * 10):
+            rows = []
+            for dialog_id in self.rng.choices(dialog_ids, weights, k=min(self.batch_size * 10, messages - start)):
+                author, reader = self.rng.sample(members[dialog_id], 2)
+                rows.append((dialog_id, author, reader))
+            message_ids = self._bulk(Message, (
+                Message(dialog_id=dialog_id, author_id=author, content=self._text(10)) for dialog_id, author, _ in rows
+            ))
+            # Most messages have been read by the other side.
+            self._bulk(MessageRead, (
+                MessageRead(message_id=message_id, user_id=reader)
+                for message_id, (_, _, reader) in zip(message_ids, rows)
+                if self.rng.random() < 0.9
+            ), ignore_conflicts=True)
+        return dialogs + messages
+
+    def _notifications(self, count):
+        types = [Notification.TYPE_COMMENT, Notification.TYPE_LIKE, Notification.TYPE_MENTION, Notification.TYPE_TOPIC]
+        self._bulk(Notification, (
+            Notification(
+                recipient_id=self._pick_user(),
+                actor_id=self._pick_user(),
+                topic_id=self.rng.choice(self.topic_ids),
+                notification_type=self.rng.choice(types),
+                message=self._text(6),
+                is_read=self.rng.random() < 0.7,
+            )
+            for _ in range(count)
+        ))
+        return count
+
+    def _family(self, tasks, operations, dossiers):
+        task_statuses = [value for value, _ in FamilyTask.STATUS_CHOICES]
+        self._bulk(FamilyTask, (
+            FamilyTask(
+                title=self._text(4),
+                description=self._text(20),
+                assignee_id=self._pick_user() if self.rng.random() < 0.8 else None,
+                created_by_id=self._pick_user(),
+                due_at=self.now + timezone.timedelta(hours=self.rng.randint(-240, 240)),
+                status=self.rng.choice(task_statuses),
+                reward_points=self.rng.randint(0, 500),
+            )
+            for _ in range(tasks)
+        ))
+        operation_statuses = [value for value, _ in FamilyOperation.STATUS_CHOICES]
+        operation_ids = self._bulk(FamilyOperation, (
+            FamilyOperation(
+                title=self._text(4),
+                objective=self._text(20),
+                scheduled_for=self.now + timezone.timedelta(hours=self.rng.randint(-240, 240)),
+                status=self.rng.choice(operation_statuses),
+                coordinator_id=self._pick_user(),
+            )
+            for _ in range(operations)
+        ))
+        through = FamilyOperation.participants.through
+        self._bulk(through, (
+            through(familyoperation_id=operation_id, customuser_id=user_id)
+            for operation_id in operation_ids
+            for user_id in self.rng.sample(self.user_ids, min(len(self.user_ids), self.rng.randint(1, 8)))
+        ), ignore_conflicts=True)
+        sides = [value for value, _ in FactionDossier.SIDE_CHOICES]
+        threats = [value for value, _ in FactionDossier.THREAT_CHOICES]
+        self._bulk(FactionDossier, (
+            FactionDossier(
+                target_name=self._text(2),
+                side=self.rng.choice(sides),
+                threat_level=self.rng.choice(threats),
+                notes=self._text(30),
+                author_id=self._pick_user(),
+            )
+            for _ in range(dossiers)
+        ))
+        return tasks + operations + dossiers
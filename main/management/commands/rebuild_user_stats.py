@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from main.models import UserStats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает статистику пользователей (темы, посты, лайки, задачи) с нуля'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids', help='ID пользователя (можно несколько)')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = UserStats.rebuild(options['user_ids'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитана статистика для {count} пользователей'))
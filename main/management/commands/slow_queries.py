@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.slow_queries import SORT_KEYS, read_snapshots, snapshot_dir, top
+
+
+class Command(BaseCommand):
+    help = (
+        'Показывает самые дорогие формы SQL-запросов (отпечатки) по снимкам всех воркеров '
+        'из SLOW_QUERY_DIR: число, суммарное и максимальное время, медленные запуски, вьюхи и место вызова'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--sort', choices=SORT_KEYS, default='total_ms')
+        parser.add_argument('--dir', default=None, help='Каталог снимков (по умолчанию SLOW_QUERY_DIR)')
+        parser.add_argument('--max-age', type=float, default=None, help='Пропускать снимки старше N секунд')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or snapshot_dir()
+        entries, files = read_snapshots(directory, options['max_age'])
+        if not files:
+            raise CommandError(f'Нет снимков в {directory}. Включите SLOW_QUERY_LOG=1.')
+        self.stdout.write(f'Снимков: {files}, отпечатков: {len(entries)}')
+        self.stdout.write(f"{'#':>3} {'id':<12}{'запросов':>10}{'всего, мс':>12}{'средн.':>9}{'макс.':>9}{'медл.':>7}")
+        full = options['verbosity'] > 1
+        for rank, row in enumerate(top(entries, options['sort'], options['limit']), 1):
+            self.stdout.write(
+                f"{rank:>3} {row['id']:<12}{row['count']:>10}{row['total_ms']:>12.1f}"
+                f"{row['avg_ms']:>9.2f}{row['max_ms']:>9.1f}{row['slow']:>7}"
+            )
+            sql = row['fingerprint'] if full or len(row['fingerprint']) <= 200 else row['fingerprint'][:200] + '…'
+            self.stdout.write(f'    {sql}')
+            views = sorted(row['views'].items(), key=lambda item: item[1], reverse=True)
+            self.stdout.write('    вьюхи: ' + ', '.join(f'{view} ×{count}' for view, count in views[:5]))
+            if row['slow']:
+                self.stdout.write(
+                    f"    последний медленный: {row['last_slow_ms']:.1f} мс в {row['last_slow_view']}"
+                    f" ({row['last_slow_location'] or '?'})"
+                )
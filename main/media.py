@@ -0,0 +1,209 @@
+"""Serving uploaded media in production.
+
+``serve`` replaces ``django.views.static.serve`` for ``MEDIA_URL``:
+
+* content-addressed blobs (``cas/``) and their derivatives never change,
+  so they get ``Cache-Control: public, max-age=31536000, immutable``;
+  other files get ``MEDIA_CACHE_MAX_AGE`` and are revalidated;
+* ``ETag``/``Last-Modified`` with ``If-None-Match``/``If-Modified-Since``
+  answered by ``304``;
+* single byte ranges (``Range``/``If-Range``) so large message
+  attachments can be resumed and media can be seeked;
+* with ``MEDIA_OFFLOAD = "x-accel-redirect"`` (nginx) or ``"x-sendfile"``
+  (Apache/lighttpd) the file body is left to the front server and Django
+  only sets the headers.
+
+Uploads are not trusted: anything but a raster image is sent as a
+download in a sandbox (no stored HTML/SVG running on our origin), chunked
+upload parts and the CAS spool are never served. Whether a file is
+private follows from the field that references it, not from its name
+(blobs are shared): message attachments are linked through
+``serve_attachment`` (``dialogs/<id>/messages/<id>/attachment/``), which
+checks that the user takes part in the dialog, and legacy
+``messages/files/`` names are not served under ``MEDIA_URL`` at all.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+from .images import DERIVED_PREFIX
+from .models import Message
+from .storage import CAS_PREFIX
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STREAM_CHUNK = 64 * 1024
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# Work areas of chunked uploads, the CAS spool and legacy (non-CAS)
+# message attachments, which only serve_attachment may send.
+PRIVATE_PREFIXES = ("uploads/", f"{CAS_PREFIX}tmp/", "messages/files/")
+# Types a browser renders as a picture and never as a document.
+INLINE_TYPES = frozenset({"image/png", "image/jpeg", "image/gif", "image/webp", "image/avif", "image/bmp"})
+# Like FileResponse: a compressed file is served as what it is, not
+# decoded by the browser.
+_ENCODED_TYPES = {
+    "br": "application/x-brotli",
+    "bzip2": "application/x-bzip",
+    "compress": "application/x-compress",
+    "gzip": "application/gzip",
+    "xz": "application/x-xz",
+}
+
+
+def is_immutable(name: str) -> bool:
+    return name.startswith(CAS_PREFIX) or name.startswith(f"{DERIVED_PREFIX}{CAS_PREFIX}")
+
+
+def _etag(name: str, stat) -> str:
+    if name.startswith(CAS_PREFIX):
+        # The file name is the sha256 of its content.
+        return quote_etag(os.path.splitext(os.path.basename(name))[0])
+    return quote_etag(f"{int(stat.st_mtime):x}-{stat.st_size:x}")
+
+
+def _cache_headers(response, name, etag, stat, private=False):
+    scope = "private" if private else "public"
+    if is_immutable(name):
+        response["Cache-Control"] = f"{scope}, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        response["Cache-Control"] = f"{scope}, max-age={getattr(settings, 'MEDIA_CACHE_MAX_AGE', 3600)}"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _safety_headers(response, name, content_type):
+    response["X-Content-Type-Options"] = "nosniff"
+    if content_type not in INLINE_TYPES:
+        response["Content-Disposition"] = content_disposition_header(True, posixpath.basename(name))
+        response["Content-Security-Policy"] = "sandbox"
+    return response
+
+
+def _not_modified(request, etag, stat) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+    since = parse_http_date_safe(request.headers.get("If-Modified-Since") or "")
+    return since is not None and int(stat.st_mtime) <= since
+
+
+def parse_range(header: str | None, size: int):
+    """Return ``(start, end)`` for a single satisfiable range, ``None`` for
+    no/unsupported range, or ``False`` when it cannot be satisfied."""
+    match = _RANGE_RE.match((header or "").strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _offload(response, name, path):
+    offload = getattr(settings, "MEDIA_OFFLOAD", "")
+    if offload == "x-accel-redirect":
+        location = getattr(settings, "MEDIA_ACCEL_REDIRECT_LOCATION", "/protected-media/")
+        response["X-Accel-Redirect"] = f"{location.rstrip('/')}/{name}"
+        return True
+    if offload == "x-sendfile":
+        response["X-Sendfile"] = path
+        return True
+    return False
+
+
+def _resolve(path):
+    """Normalized storage name, full path and stat of an existing file."""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except Exception:
+        raise Http404("Файл не найден.")
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404("Файл не найден.")
+    if not os.path.isfile(full_path):
+        raise Http404("Файл не найден.")
+    name = os.path.relpath(full_path, os.path.abspath(settings.MEDIA_ROOT)).replace(os.sep, "/")
+    return name, full_path, stat
+
+
+def serve(request, path):
+    name, full_path, stat = _resolve(path)
+    if name.startswith(PRIVATE_PREFIXES):
+        raise Http404("Файл не найден.")
+    return _serve_file(request, name, full_path, stat)
+
+
+def serve_attachment(request, dialog_id, message_id):
+    """A message attachment, for participants of the message's dialog only."""
+    if not request.user.is_authenticated:
+        raise Http404("Файл не найден.")
+    message = (
+        Message.objects.filter(pk=message_id, dialog_id=dialog_id, dialog__dialog_participants__user=request.user)
+        .exclude(attachment="").exclude(attachment__isnull=True)
+        .only("attachment").first()
+    )
+    if message is None:
+        raise Http404("Файл не найден.")
+    return _serve_file(request, *_resolve(message.attachment.name), private=True)
+
+
+def _serve_file(request, name, full_path, stat, private=False):
+    etag = _etag(name, stat)
+    if _not_modified(request, etag, stat):
+        return _cache_headers(HttpResponseNotModified(), name, etag, stat, private)
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = _ENCODED_TYPES.get(encoding, content_type) or "application/octet-stream"
+
+    offloaded = _safety_headers(HttpResponse(content_type=content_type), name, content_type)
+    if _offload(offloaded, name, full_path):
+        # The front server handles ranges and the body itself.
+        return _cache_headers(offloaded, name, etag, stat, private)
+
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if if_range is None or if_range.strip() in (etag, http_date(stat.st_mtime)):
+        byte_range = parse_range(request.headers.get("Range"), stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{stat.st_size}"
+        return _cache_headers(response, name, etag, stat, private)
+
+    if byte_range is None:
+        response = FileResponse(open(full_path, "rb"), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read_range(full_path, start, end - start + 1), status=206, content_type=content_type)
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        response["Content-Length"] = str(end - start + 1)
+    _safety_headers(response, name, content_type)
+    return _cache_headers(response, name, etag, stat, private)
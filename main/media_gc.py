@@ -0,0 +1,101 @@
+"""Garbage collection of uploaded files nothing references any more.
+
+Deleting a topic, post, comment, message or task, or replacing an avatar,
+leaves its files behind. ``collect_orphaned_media`` streams the names
+referenced by every upload field, walks ``MEDIA_ROOT`` and deletes the
+files that are neither referenced nor derivatives of a referenced image.
+Files younger than the grace period are kept: an upload is written before
+the row that references it is committed. Chunked upload sessions idle for
+longer than the grace period are dropped, and their part files with them.
+"""
+import logging
+import os
+import posixpath
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from . import images, uploads
+from .models import MEDIA_FILE_FIELDS, MediaBlob, UploadSession
+from .storage import is_content_addressed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GRACE_SECONDS = 24 * 3600
+
+
+def referenced_names(chunk_size=2000) -> set[str]:
+    names = set()
+    for model, field_names in MEDIA_FILE_FIELDS.items():
+        for field_name in field_names:
+            rows = (
+                model.objects.exclude(**{field_name: ""}).exclude(**{f"{field_name}__isnull": True})
+                .order_by().values_list(field_name, flat=True)
+            )
+            names.update(rows.iterator(chunk_size=chunk_size))
+    return names
+
+
+def iter_media_files(root=None):
+    """Yield ``(name, path)`` for every file under ``MEDIA_ROOT``."""
+    root = str(root or settings.MEDIA_ROOT)
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, root).replace(os.sep, "/"), path
+
+
+def collect_orphaned_media(grace_seconds=DEFAULT_GRACE_SECONDS, batch_size=500, dry_run=False, log=None) -> dict:
+    referenced = referenced_names()
+    referenced_stems = {posixpath.splitext(name)[0] for name in referenced}
+    cutoff = time.time() - grace_seconds
+    stats = {"scanned": 0, "orphaned": 0, "deleted": 0, "bytes": 0, "too_new": 0, "stale_uploads": 0}
+
+    stale_uploads = UploadSession.objects.filter(updated_at__lt=datetime.fromtimestamp(cutoff, tz=timezone.utc))
+    stale_ids = list(stale_uploads.values_list("id", flat=True))
+    stats["stale_uploads"] = len(stale_ids)
+    if not dry_run:
+        UploadSession.objects.filter(id__in=stale_ids).delete()
+        for upload_id in stale_ids:
+            uploads.discard_parts(upload_id)
+
+    # Content-addressed storage ignores delete() for shared blobs.
+    remove = getattr(default_storage, "purge", default_storage.delete)
+    batch = []
+
+    def flush():
+        for name, size in batch:
+            if not dry_run:
+                remove(name)
+            if log:
+                log(f"{'[dry-run] ' if dry_run else ''}{name} ({size} B)")
+            stats["deleted"] += 1
+            stats["bytes"] += size
+        if not dry_run:
+            blobs = [name for name, _ in batch if is_content_addressed(name)]
+            MediaBlob.objects.filter(name__in=blobs, refcount__lte=0).delete()
+        batch.clear()
+
+    for name, path in iter_media_files():
+        stats["scanned"] += 1
+        if name in referenced:
+            continue
+        original = images.original_name(name)
+        if original is not None and original in referenced_stems:
+            continue
+        stats["orphaned"] += 1
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime > cutoff:
+            stats["too_new"] += 1
+            continue
+        batch.append((name, stat.st_size))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    logger.info("Media GC%s: %s", " (dry run)" if dry_run else "", stats)
+    return stats
@@ -0,0 +1,66 @@
+"""Process-local registry of runtime metrics.
+
+Components register a provider callable under a name; ``collect()`` calls
+every provider and returns one dict for the staff metrics endpoints (JSON
+and the Prometheus text rendering in ``main.prometheus``).
+"""
+import bisect
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Default histogram bounds: durations in seconds and fan-out sizes.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+_providers = {}
+_lock = threading.Lock()
+
+
+def register(name: str, provider):
+    with _lock:
+        _providers[name] = provider
+
+
+def unregister(name: str, provider=None):
+    """Remove ``name``; with ``provider``, only while it is still the one registered."""
+    with _lock:
+        if provider is None or _providers.get(name) == provider:
+            _providers.pop(name, None)
+
+
+def collect() -> dict:
+    with _lock:
+        providers = dict(_providers)
+    data = {"pid": os.getpid()}
+    for name, provider in sorted(providers.items()):
+        try:
+            data[name] = provider()
+        except Exception as exc:
+            # A broken provider must not hide the others.
+            logger.warning("Metrics provider %s failed: %s", name, exc)
+            data[name] = {"error": str(exc)}
+    return data
+
+
+class Histogram:
+    """Thread-safe fixed-bucket histogram; a value lands in the first bucket >= it."""
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        return {"buckets": list(self.buckets), "counts": counts, "sum": round(total, 6), "count": sum(counts)}
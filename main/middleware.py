@@ -1,18 +1,73 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.contrib.auth import get_user
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.contrib.auth import aget_user, get_user
 from django.utils import timezone
+from whitenoise.middleware import WhiteNoiseMiddleware
 
-from .online_presence import mark_user_online
+from . import publisher, realtime
+from .online_presence import amark_user_online, mark_user_online
+
+LAST_ACTIVITY_SESSION_KEY = "last_activity_write"
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise that stays in async mode under ASGI.
+
+    Stock WhiteNoise is sync-only, which makes Django run every async view
+    below it through a thread again.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+
+def _activity_write_due(last_write, now) -> bool:
+    if not last_write:
+        return True
+    try:
+        prev_ts = timezone.datetime.fromisoformat(last_write)
+        if timezone.is_naive(prev_ts):
+            prev_ts = timezone.make_aware(prev_ts, timezone.get_current_timezone())
+        return (now - prev_ts).total_seconds() >= 45
+    except ValueError:
+        return True
 
 
 class LastActivityMiddleware:
     """Keeps lightweight online presence state for authenticated users."""
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
         response = self.get_response(request)
 
         # Resolve user through auth helper to avoid lazy-wrapper edge cases.
@@ -21,41 +76,41 @@ class LastActivityMiddleware:
             return response
 
         now = timezone.now()
-        session_key = "last_activity_write"
-        last_write = request.session.get(session_key)
-        should_write = True
-        if last_write:
+        if _activity_write_due(request.session.get(LAST_ACTIVITY_SESSION_KEY), now):
+            request.session[LAST_ACTIVITY_SESSION_KEY] = now.isoformat()
             try:
-                prev_ts = timezone.datetime.fromisoformat(last_write)
-                if timezone.is_naive(prev_ts):
-                    prev_ts = timezone.make_aware(prev_ts, timezone.get_current_timezone())
-                should_write = (now - prev_ts).total_seconds() >= 45
-            except ValueError:
-                should_write = True
-
-        if should_write:
-            request.session[session_key] = now.isoformat()
-            try:
-                self._broadcast_online_users(user)
+                self._broadcast_online_users(mark_user_online(user))
             except Exception:
                 # Presence must never crash page rendering.
                 pass
 
         return response
 
-    def _broadcast_online_users(self, user):
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            return
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+
+        user = await aget_user(request)
+        if not user or not user.is_authenticated:
+            return response
+
+        now = timezone.now()
+        if _activity_write_due(await request.session.aget(LAST_ACTIVITY_SESSION_KEY), now):
+            await request.session.aset(LAST_ACTIVITY_SESSION_KEY, now.isoformat())
+            try:
+                self._broadcast_online_users(await amark_user_online(user))
+            except Exception:
+                # Presence must never crash page rendering.
+                pass
+
+        return response
 
-        users = mark_user_online(user)
-        async_to_sync(channel_layer.group_send)(
-            "site_global",
+    def _broadcast_online_users(self, users):
+        publisher.enqueue(
+            realtime.SITE_GROUP,
+            "site_event",
             {
-                "type": "site_event",
-                "payload": {
-                    "type": "online_users",
-                    "users": users,
-                },
+                "type": "online_users",
+                "users": users,
             },
+            coalesce="online_users",
         )
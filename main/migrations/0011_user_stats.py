@@ -0,0 +1,37 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0010_familytask_completion_proof"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserStats",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("topics_count", models.IntegerField(default=0)),
+                ("posts_count", models.IntegerField(default=0)),
+                ("comments_count", models.IntegerField(default=0)),
+                ("topic_likes_received", models.IntegerField(default=0)),
+                ("post_likes_received", models.IntegerField(default=0)),
+                ("comment_likes_received", models.IntegerField(default=0)),
+                ("tasks_completed", models.IntegerField(default=0)),
+                ("reward_points", models.IntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0013_uploadsession"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="topic",
+            index=models.Index(fields=["-is_pinned", "-created_at"], name="topic_listing_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="topic",
+            index=models.Index(fields=["category", "-is_pinned", "-created_at"], name="topic_category_listing_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(fields=["topic", "created_at"], name="post_topic_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(fields=["topic", "post", "parent", "created_at"], name="comment_thread_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(fields=["recipient", "is_read", "-created_at"], name="notif_recipient_unread_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(fields=["recipient", "-created_at"], name="notif_recipient_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["dialog", "created_at"], name="message_dialog_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="activity",
+            index=models.Index(fields=["-created_at"], name="activity_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="familytask",
+            index=models.Index(fields=["status", "due_at", "-created_at"], name="familytask_board_idx"),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0015_cache_table"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="attachment",
+            field=models.FileField(blank=True, db_index=True, null=True, upload_to="messages/files/"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Attachment access is checked through the message (media.serve_attachment),
+    # not by looking the file name up.
+
+    dependencies = [
+        ("main", "0016_message_attachment_index"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="attachment",
+            field=models.FileField(blank=True, null=True, upload_to="messages/files/"),
+        ),
+    ]
@@ -1,11 +1,18 @@
-import os
 import random
+import uuid
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, Group, Permission
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
 from django.dispatch import receiver
+from django.urls import reverse
+
+from . import images
+from .sqlite import retry_on_busy
+from .storage import CAS_PREFIX, is_content_addressed
 
 
 class CustomUser(AbstractUser):
@@ -68,15 +75,7 @@ class Profile(models.Model):
     )
 
     def save(self, *args, **kwargs):
-        try:
-            this = Profile.objects.get(id=self.id)
-            if this.avatar != self.avatar and this.avatar:
-                old_avatar_path = os.path.join(settings.MEDIA_ROOT, this.avatar.name)
-                if os.path.isfile(old_avatar_path):
-                    os.remove(old_avatar_path)
-        except Profile.DoesNotExist:
-            pass
-
+        # A replaced avatar file is left to the media garbage collector.
         if not self.avatar and not self.default_avatar:
             self.default_avatar = random.choice(DEFAULT_AVATARS)
 
@@ -172,6 +171,10 @@ class Topic(models.Model):
 
     class Meta:
         ordering = ["-is_pinned", "-created_at"]
+        indexes = [
+            models.Index(fields=["-is_pinned", "-created_at"], name="topic_listing_idx"),
+            models.Index(fields=["category", "-is_pinned", "-created_at"], name="topic_category_listing_idx"),
+        ]
 
     def __str__(self):
         return self.title
@@ -188,6 +191,9 @@ class Post(models.Model):
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["topic", "created_at"], name="post_topic_created_idx"),
+        ]
 
     def __str__(self):
         return f"Post #{self.id}"
@@ -213,6 +219,9 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["topic", "post", "parent", "created_at"], name="comment_thread_idx"),
+        ]
 
     def __str__(self):
         return f"Comment #{self.id}"
@@ -280,6 +289,10 @@ class Notification(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["recipient", "is_read", "-created_at"], name="notif_recipient_unread_idx"),
+            models.Index(fields=["recipient", "-created_at"], name="notif_recipient_created_idx"),
+        ]
 
     def __str__(self):
         return f"Notification({self.recipient}, {self.notification_type})"
@@ -320,10 +333,20 @@ class Message(models.Model):
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["dialog", "created_at"], name="message_dialog_created_idx"),
+        ]
 
     def __str__(self):
         return f"Message #{self.id} in dialog#{self.dialog_id}"
 
+    @property
+    def attachment_url(self) -> str:
+        """Link to the attachment through the participants-only view (media.serve_attachment)."""
+        if not self.attachment:
+            return ""
+        return reverse("message-attachment", args=[self.dialog_id, self.pk])
+
 
 class MessageRead(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="read_by")
@@ -344,6 +367,9 @@ class Activity(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["-created_at"], name="activity_created_idx"),
+        ]
 
 
 class FamilyOperation(models.Model):
@@ -434,6 +460,352 @@ class FamilyTask(models.Model):
 
     class Meta:
         ordering = ["status", "due_at", "-created_at"]
+        indexes = [
+            models.Index(fields=["status", "due_at", "-created_at"], name="familytask_board_idx"),
+        ]
 
     def __str__(self):
         return self.title
+
+
+class UserStats(models.Model):
+    """Per-user counters for the profile page, kept up to date by signals below."""
+
+    user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, primary_key=True, related_name="stats")
+    topics_count = models.IntegerField(default=0)
+    posts_count = models.IntegerField(default=0)
+    comments_count = models.IntegerField(default=0)
+    topic_likes_received = models.IntegerField(default=0)
+    post_likes_received = models.IntegerField(default=0)
+    comment_likes_received = models.IntegerField(default=0)
+    tasks_completed = models.IntegerField(default=0)
+    reward_points = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    COUNTER_FIELDS = (
+        "topics_count",
+        "posts_count",
+        "comments_count",
+        "topic_likes_received",
+        "post_likes_received",
+        "comment_likes_received",
+        "tasks_completed",
+        "reward_points",
+    )
+
+    def __str__(self):
+        return f"UserStats({self.user_id})"
+
+    @property
+    def likes_received(self) -> int:
+        return self.topic_likes_received + self.post_likes_received + self.comment_likes_received
+
+    @classmethod
+    def for_user(cls, user) -> "UserStats":
+        stats = cls.objects.filter(user=user).first()
+        if stats is None:
+            cls.rebuild([user.pk])
+            stats = cls.objects.get(user=user)
+        return stats
+
+    @classmethod
+    def rebuild(cls, user_ids=None, batch_size=500) -> int:
+        """Recompute counters from scratch; returns the number of users processed."""
+
+        def counted(queryset, user_field, aggregate=None):
+            aggregate = aggregate or Count("pk")
+            return Coalesce(
+                Subquery(
+                    queryset.filter(**{user_field: OuterRef("pk")})
+                    .order_by()
+                    .values(user_field)
+                    .annotate(value=aggregate)
+                    .values("value")
+                ),
+                0,
+            )
+
+        done_tasks = FamilyTask.objects.filter(status=FamilyTask.STATUS_DONE)
+        users = CustomUser.objects.order_by("pk").annotate(
+            topics_count_value=counted(Topic.objects.all(), "author"),
+            posts_count_value=counted(Post.objects.all(), "author"),
+            comments_count_value=counted(Comment.objects.all(), "author"),
+            topic_likes_received_value=counted(Topic.likes.through.objects.all(), "topic__author"),
+            post_likes_received_value=counted(Post.likes.through.objects.all(), "post__author"),
+            comment_likes_received_value=counted(CommentReaction.objects.filter(reaction_type="like"), "comment__author"),
+            tasks_completed_value=counted(done_tasks, "assignee"),
+            reward_points_value=counted(done_tasks, "assignee", Sum("reward_points")),
+        )
+        if user_ids is not None:
+            users = users.filter(pk__in=user_ids)
+
+        processed = 0
+        batch = []
+        for user in users.iterator(chunk_size=batch_size):
+            batch.append(cls(user_id=user.pk, **{field: getattr(user, f"{field}_value") for field in cls.COUNTER_FIELDS}))
+            if len(batch) >= batch_size:
+                processed += cls._save_batch(batch)
+                batch = []
+        if batch:
+            processed += cls._save_batch(batch)
+        return processed
+
+    @classmethod
+    @retry_on_busy
+    def _save_batch(cls, batch) -> int:
+        cls.objects.bulk_create(
+            batch,
+            update_conflicts=True,
+            unique_fields=["user"],
+            update_fields=[*cls.COUNTER_FIELDS, "updated_at"],
+        )
+        return len(batch)
+
+
+def _bump_stats(user_id, **deltas):
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not user_id or not deltas:
+        return
+    updated = UserStats.objects.filter(user_id=user_id).update(
+        **{field: F(field) + delta for field, delta in deltas.items()}
+    )
+    if not updated:
+        # No row yet (user predates the stats table): build it once the
+        # current write is committed so it counts the final state.
+        transaction.on_commit(lambda: UserStats.rebuild([user_id]))
+
+
+@receiver(post_save, sender=CustomUser)
+def create_user_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(pre_delete, sender=CustomUser)
+def uncount_likes_given(sender, instance, **kwargs):
+    # The user's like rows are cascaded without m2m_changed.
+    for model in (Topic, Post):
+        source = model.likes.field.m2m_field_name()
+        rows = model.likes.through.objects.filter(**{f"{model.likes.field.m2m_reverse_field_name()}_id": instance.pk})
+        for row in rows.order_by().values(f"{source}__author_id").annotate(likes=Count("pk")):
+            _bump_stats(row[f"{source}__author_id"], **{f"{source}_likes_received": -row["likes"]})
+
+
+@receiver(post_save, sender=Topic)
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Comment)
+def count_authored_content(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        _bump_stats(instance.author_id, **{f"{sender.__name__.lower()}s_count": 1})
+
+
+@receiver(pre_delete, sender=Topic)
+@receiver(pre_delete, sender=Post)
+def uncount_received_likes(sender, instance, **kwargs):
+    # Like rows go away with the object without m2m_changed firing.
+    _bump_stats(instance.author_id, **{f"{sender.__name__.lower()}_likes_received": -instance.likes.count()})
+
+
+@receiver(post_delete, sender=Topic)
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Comment)
+def uncount_authored_content(sender, instance, **kwargs):
+    _bump_stats(instance.author_id, **{f"{sender.__name__.lower()}s_count": -1})
+
+
+@receiver(m2m_changed, sender=Topic.likes.through)
+@receiver(m2m_changed, sender=Post.likes.through)
+def count_likes_received(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "pre_remove", "pre_clear"):
+        return
+    model = Topic if sender is Topic.likes.through else Post
+    field = model.likes.field
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    owner, other = (target, source) if reverse else (source, target)
+    rows = sender.objects.filter(**{f"{owner}_id": instance.pk})
+    if pk_set is not None:
+        rows = rows.filter(**{f"{other}_id__in": pk_set})
+    # post_add sees the rows just added, pre_remove/pre_clear the rows about
+    # to go (pk_set may name likes that do not exist).
+    sign = 1 if action == "post_add" else -1
+    for row in rows.order_by().values(f"{source}__author_id").annotate(likes=Count("pk")):
+        _bump_stats(row[f"{source}__author_id"], **{f"{source}_likes_received": sign * row["likes"]})
+
+
+@receiver(post_save, sender=CommentReaction)
+@receiver(post_delete, sender=CommentReaction)
+def count_comment_likes_received(sender, instance, created=None, raw=False, **kwargs):
+    if instance.reaction_type != "like" or raw or created is False:
+        return
+    author_id = Comment.objects.filter(pk=instance.comment_id).values_list("author_id", flat=True).first()
+    _bump_stats(author_id, comment_likes_received=1 if created else -1)
+
+
+def _task_contribution(status, reward_points):
+    if status != FamilyTask.STATUS_DONE:
+        return 0, 0
+    return 1, reward_points or 0
+
+
+@receiver(post_init, sender=FamilyTask)
+def remember_task_state(sender, instance, **kwargs):
+    # Read __dict__ so deferred fields are not loaded one query each.
+    state = instance.__dict__
+    instance._stats_state = (state.get("assignee_id"), state.get("status"), state.get("reward_points"))
+
+
+@receiver(post_save, sender=FamilyTask)
+def count_completed_tasks(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old_assignee, old_status, old_reward = (None, None, 0) if created else instance._stats_state
+    old_done, old_points = _task_contribution(old_status, old_reward)
+    new_done, new_points = _task_contribution(instance.status, instance.reward_points)
+    if old_assignee == instance.assignee_id:
+        _bump_stats(instance.assignee_id, tasks_completed=new_done - old_done, reward_points=new_points - old_points)
+    else:
+        _bump_stats(old_assignee, tasks_completed=-old_done, reward_points=-old_points)
+        _bump_stats(instance.assignee_id, tasks_completed=new_done, reward_points=new_points)
+    instance._stats_state = (instance.assignee_id, instance.status, instance.reward_points)
+
+
+@receiver(post_delete, sender=FamilyTask)
+def uncount_completed_tasks(sender, instance, **kwargs):
+    old_assignee, old_status, old_reward = instance._stats_state
+    done, points = _task_contribution(old_status, old_reward)
+    _bump_stats(old_assignee, tasks_completed=-done, reward_points=-points)
+
+
+class MediaBlob(models.Model):
+    """A content-addressed upload and how many model fields reference it."""
+
+    name = models.CharField(max_length=255, primary_key=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    @retry_on_busy
+    def recount(cls) -> int:
+        """Recompute every refcount from the model fields; returns the number of blobs."""
+        counts = {}
+        for model, field_names in MEDIA_FILE_FIELDS.items():
+            for field_name in field_names:
+                rows = (
+                    model.objects.filter(**{f"{field_name}__startswith": CAS_PREFIX})
+                    .order_by()
+                    .values_list(field_name)
+                    .annotate(references=Count("pk"))
+                )
+                for name, references in rows:
+                    counts[name] = counts.get(name, 0) + references
+        with transaction.atomic():
+            cls.objects.exclude(name__in=list(counts)).update(refcount=0)
+            for name, references in counts.items():
+                cls.objects.filter(name=name).update(refcount=references)
+        return len(counts)
+
+
+class UploadSession(models.Model):
+    """A resumable chunked upload (see main/uploads.py)."""
+
+    TARGET_MESSAGE_IMAGE = "message_image"
+    TARGET_MESSAGE_ATTACHMENT = "message_attachment"
+    TARGET_TASK_PROOF = "task_proof"
+    TARGET_CHOICES = (
+        (TARGET_MESSAGE_IMAGE, "Фото в ЛС"),
+        (TARGET_MESSAGE_ATTACHMENT, "Файл в ЛС"),
+        (TARGET_TASK_PROOF, "Подтверждение поручения"),
+    )
+
+    STATUS_OPEN = "open"
+    STATUS_COMPLETE = "complete"
+    STATUS_CHOICES = (
+        (STATUS_OPEN, "Загружается"),
+        (STATUS_COMPLETE, "Загружено"),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="upload_sessions")
+    target = models.CharField(max_length=32, choices=TARGET_CHOICES)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_OPEN)
+    name = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+# Every upload field; their files are reference-counted in MediaBlob.
+MEDIA_FILE_FIELDS = {
+    Profile: ("avatar", "cover_image"),
+    Topic: ("image",),
+    Post: ("image",),
+    Comment: ("image",),
+    Message: ("image", "attachment"),
+    FamilyTask: ("completion_proof",),
+}
+
+# Uploaded images that get resized WebP derivatives: model -> ((field, kind), ...).
+IMAGE_DERIVATIVE_FIELDS = {
+    Profile: (("avatar", "avatar"), ("cover_image", "content")),
+    Topic: (("image", "content"),),
+    Post: (("image", "content"),),
+    Comment: (("image", "content"),),
+    Message: (("image", "content"),),
+    FamilyTask: (("completion_proof", "content"),),
+}
+
+
+def _file_field_names(instance):
+    names = {}
+    for field_name in MEDIA_FILE_FIELDS[type(instance)]:
+        # __dict__ keeps the raw name (or FieldFile) without loading deferred fields.
+        value = instance.__dict__.get(field_name)
+        names[field_name] = getattr(value, "name", value) or ""
+    return names
+
+
+def _adjust_blob_refs(name, delta):
+    if is_content_addressed(name):
+        MediaBlob.objects.filter(name=name).update(refcount=F("refcount") + delta)
+
+
+def remember_file_names(sender, instance, **kwargs):
+    instance._file_names = _file_field_names(instance)
+
+
+def track_media_files(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, "_file_names", {})
+    current = _file_field_names(instance)
+    kinds = dict(IMAGE_DERIVATIVE_FIELDS.get(sender, ()))
+    for field_name, name in current.items():
+        old_name = previous.get(field_name, "")
+        if name == old_name:
+            continue
+        _adjust_blob_refs(old_name, -1)
+        _adjust_blob_refs(name, 1)
+        if name and field_name in kinds:
+            transaction.on_commit(lambda name=name, kind=kinds[field_name]: images.schedule_derivatives(name, kind))
+    instance._file_names = current
+
+
+def release_media_files(sender, instance, **kwargs):
+    for name in getattr(instance, "_file_names", {}).values():
+        _adjust_blob_refs(name, -1)
+
+
+for _model in MEDIA_FILE_FIELDS:
+    post_init.connect(remember_file_names, sender=_model, dispatch_uid=f"remember_file_names_{_model.__name__}")
+    post_save.connect(track_media_files, sender=_model, dispatch_uid=f"track_media_files_{_model.__name__}")
+    post_delete.connect(release_media_files, sender=_model, dispatch_uid=f"release_media_files_{_model.__name__}")
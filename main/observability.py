@@ -0,0 +1,143 @@
+"""Plumbing shared by the opt-in request instrumentation.
+
+``instrumentation``, ``tracing`` and ``slow_queries`` all need the same
+three things, kept here once:
+
+* ``observe_queries(observer)``: a single execute wrapper on every
+  connection times each statement once and hands ``(sql, many, context,
+  duration_ms, error)`` to every registered observer, however many of the
+  features are enabled; ``unobserve_queries(observer)`` removes one;
+* ``write_json_snapshot()``: write-then-rename of a per-process JSON file,
+  so readers never see half a file;
+* ``RequestHookMiddleware``: the sync/async middleware preamble; a
+  subclass only writes the ``around(request)`` generator.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+_observers = []
+_observers_lock = threading.Lock()
+_SKIP = object()
+
+
+def _execute(execute, sql, params, many, context):
+    if not _observers:
+        return execute(sql, params, many, context)
+    error = None
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    except Exception as exc:
+        error = exc
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        for observer in _observers:
+            observer(sql, many, context, duration_ms, error)
+
+
+def _install_on_connection(connection, **kwargs):
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute)
+
+
+def observe_queries(observer):
+    """Call ``observer`` after every SQL statement on every connection."""
+    with _observers_lock:
+        if observer in _observers:
+            return
+        if not _observers:
+            connection_created.connect(_install_on_connection, dispatch_uid="observability")
+            for alias in connections:
+                _install_on_connection(connections[alias])
+        # Copy-on-write: the wrapper iterates without taking the lock.
+        _observers[:] = [*_observers, observer]
+
+
+def unobserve_queries(observer):
+    """Stop calling ``observer``; the wrapper stays but is a no-op without observers."""
+    with _observers_lock:
+        _observers[:] = [registered for registered in _observers if registered != observer]
+
+
+def write_json_snapshot(directory, filename, data) -> str:
+    """Atomically replace ``directory/filename`` with ``data`` as JSON."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as f:
+        json.dump(data, f)
+    os.replace(f.name, path)
+    return path
+
+
+def _resume(method, value):
+    try:
+        method(value)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("around() must yield exactly once")
+
+
+class RequestHookMiddleware:
+    """Sync and async middleware that runs ``around(request)`` around the view.
+
+    ``around`` is a generator: the code before its single ``yield`` runs
+    before the view, the response is sent in at the ``yield`` (or the
+    view's exception raised there) and the generator returns the response
+    to pass on. Returning before the ``yield`` leaves the request alone.
+    ``install()`` runs once per middleware instance, and with
+    ``snapshot_interval`` set ``snapshot_due()`` turns true that often.
+    """
+
+    sync_capable = True
+    async_capable = True
+    snapshot_interval = None
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.install()
+        self._next_snapshot = time.monotonic() + (self.snapshot_interval or 0)
+
+    def install(self):
+        pass
+
+    def around(self, request):
+        raise NotImplementedError
+
+    def snapshot_due(self) -> bool:
+        if not self.snapshot_interval or time.monotonic() < self._next_snapshot:
+            return False
+        self._next_snapshot = time.monotonic() + self.snapshot_interval
+        return True
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        hooks = self.around(request)
+        if next(hooks, _SKIP) is _SKIP:
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        except BaseException as exc:
+            return _resume(hooks.throw, exc)
+        return _resume(hooks.send, response)
+
+    async def __acall__(self, request):
+        hooks = self.around(request)
+        if next(hooks, _SKIP) is _SKIP:
+            return await self.get_response(request)
+        try:
+            response = await self.get_response(request)
+        except BaseException as exc:
+            return _resume(hooks.throw, exc)
+        return _resume(hooks.send, response)
@@ -1,7 +1,13 @@
 from django.core.cache import cache
 from django.utils import timezone
 
-PRESENCE_KEY = "online_users_presence_map"
+# One key per online user, expiring with the presence window, and an index
+# of the user ids that may have one. Both live in the shared cache tier:
+# a worker's L1 copy would hide the other workers' users. The index is
+# only rewritten to add a missing id or drop expired ones; an id lost to a
+# concurrent rewrite comes back with that user's next activity mark.
+PRESENCE_KEY = "online_users_presence_ids"
+PRESENCE_USER_KEY = "online_users_presence:{}"
 PRESENCE_WINDOW_SECONDS = 5 * 60
 
 
@@ -9,25 +15,69 @@ def _now_ts() -> float:
     return timezone.now().timestamp()
 
 
-def _cleanup(data: dict, now_ts: float) -> dict:
-    return {
-        str(uid): payload
-        for uid, payload in (data or {}).items()
+def _store():
+    return getattr(cache, "shared", cache)
+
+
+def _user_key(user_id) -> str:
+    return PRESENCE_USER_KEY.format(user_id)
+
+
+def _usernames(entries: dict, now_ts: float) -> list[str]:
+    return sorted(
+        payload["username"]
+        for payload in entries.values()
         if isinstance(payload, dict) and now_ts - float(payload.get("ts", 0)) <= PRESENCE_WINDOW_SECONDS
-    }
+    )[:25]
+
+
+def _live_ids(ids, entries) -> list:
+    return [user_id for user_id in ids if _user_key(user_id) in entries]
 
 
 def mark_user_online(user) -> list[str]:
+    store = _store()
     now_ts = _now_ts()
-    data = cache.get(PRESENCE_KEY, {}) or {}
-    data = _cleanup(data, now_ts)
-    data[str(user.id)] = {"username": user.username, "ts": now_ts}
-    cache.set(PRESENCE_KEY, data, timeout=PRESENCE_WINDOW_SECONDS)
-    return sorted([v["username"] for v in data.values()])[:25]
+    store.set(_user_key(user.id), {"username": user.username, "ts": now_ts}, timeout=PRESENCE_WINDOW_SECONDS)
+    ids = store.get(PRESENCE_KEY) or []
+    entries = store.get_many([_user_key(user_id) for user_id in {*ids, user.id}])
+    live = _live_ids(ids, entries)
+    if user.id not in live:
+        live.append(user.id)
+    if live != ids:
+        store.set(PRESENCE_KEY, live, timeout=None)
+    return _usernames(entries, now_ts)
 
 
 def get_online_usernames() -> list[str]:
-    data = cache.get(PRESENCE_KEY, {}) or {}
-    data = _cleanup(data, _now_ts())
-    cache.set(PRESENCE_KEY, data, timeout=PRESENCE_WINDOW_SECONDS)
-    return sorted([v["username"] for v in data.values()])[:25]
+    store = _store()
+    ids = store.get(PRESENCE_KEY) or []
+    entries = store.get_many([_user_key(user_id) for user_id in ids])
+    live = _live_ids(ids, entries)
+    if live != ids:
+        store.set(PRESENCE_KEY, live, timeout=None)
+    return _usernames(entries, _now_ts())
+
+
+async def amark_user_online(user) -> list[str]:
+    store = _store()
+    now_ts = _now_ts()
+    await store.aset(_user_key(user.id), {"username": user.username, "ts": now_ts}, timeout=PRESENCE_WINDOW_SECONDS)
+    ids = await store.aget(PRESENCE_KEY) or []
+    entries = await store.aget_many([_user_key(user_id) for user_id in {*ids, user.id}])
+    live = _live_ids(ids, entries)
+    if user.id not in live:
+        live.append(user.id)
+    if live != ids:
+        await store.aset(PRESENCE_KEY, live, timeout=None)
+    return _usernames(entries, now_ts)
+
+
+async def aget_online_usernames() -> list[str]:
+    store = _store()
+    ids = await store.aget(PRESENCE_KEY) or []
+    entries = await store.aget_many([_user_key(user_id) for user_id in ids])
+    live = _live_ids(ids, entries)
+    if live != ids:
+        await store.aset(PRESENCE_KEY, live, timeout=None)
+    return _usernames(entries, _now_ts())
@@ -0,0 +1,202 @@
+"""On-demand cProfile capture of single requests (``PROFILING=1``).
+
+Staff create a signed token on ``/admin/profiles/`` and send it with the
+request to inspect, as the ``X-Profile-Token`` header or the ``_profile``
+query parameter. Everything below this middleware, including template
+rendering and context processors, then runs under cProfile. The stats are
+saved to ``PROFILING_DIR``, where only the newest ``PROFILING_KEEP``
+profiles are kept, and the response names them in ``X-Profile-Id``. The
+admin pages show them as pstats tables and offer the raw ``.prof`` file
+for snakeviz or ``python -m pstats``.
+
+cProfile only sees the thread it was enabled in. Under ASGI a profiled
+request is therefore driven through ``async_to_sync`` from the request's
+sync thread, so its sync views, templates and ORM calls run in the
+profiled thread; time spent in coroutines on the event loop is not
+broken down.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import secrets
+import time
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.http import FileResponse, Http404
+from django.shortcuts import render
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER = "X-Profile-Token"
+TOKEN_PARAM = "_profile"
+SORT_KEYS = ("cumulative", "tottime", "calls")
+STATS_LIMIT = 80
+_SALT = "main.profiling"
+
+
+def make_token(user) -> str:
+    return signing.TimestampSigner(salt=_SALT).sign(str(user.pk))
+
+
+def token_user(token):
+    """Active staff user the unexpired token was issued to, or None."""
+    max_age = getattr(settings, "PROFILING_TOKEN_MAX_AGE", 3600)
+    try:
+        user_id = signing.TimestampSigner(salt=_SALT).unsign(token, max_age=max_age)
+    except signing.BadSignature:
+        logger.warning("Rejected profiling token")
+        return None
+    return get_user_model().objects.filter(pk=user_id, is_staff=True, is_active=True).first()
+
+
+def _request_token(request) -> str:
+    return request.headers.get(TOKEN_HEADER) or request.GET.get(TOKEN_PARAM, "")
+
+
+def profiles_dir() -> str:
+    return str(getattr(settings, "PROFILING_DIR", os.path.join(settings.BASE_DIR, "profiles")))
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = _request_token(request)
+        user = token_user(token) if token else None
+        if user is None:
+            return self.get_response(request)
+        return self._profile(request, user, self.get_response, "sync")
+
+    async def __acall__(self, request):
+        token = _request_token(request)
+        user = await sync_to_async(token_user)(token) if token else None
+        if user is None:
+            return await self.get_response(request)
+        get_response = async_to_sync(self.get_response)
+        return await sync_to_async(self._profile)(request, user, get_response, "async")
+
+    def _profile(self, request, user, get_response, mode):
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = get_response(request)
+        finally:
+            profiler.disable()
+        duration_ms = (time.perf_counter() - started) * 1000
+        match = getattr(request, "resolver_match", None)
+        response["X-Profile-Id"] = save(profiler, {
+            "method": request.method,
+            "path": request.get_full_path(),
+            "view": match.view_name if match else "",
+            "status": response.status_code,
+            "duration_ms": round(duration_ms, 1),
+            "user": user.username,
+            "mode": mode,
+            "created_at": time.time(),
+        })
+        return response
+
+
+def save(profiler, meta, directory=None) -> str:
+    directory = directory or profiles_dir()
+    os.makedirs(directory, exist_ok=True)
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(4)}"
+    profiler.dump_stats(os.path.join(directory, f"{profile_id}.prof"))
+    with open(os.path.join(directory, f"{profile_id}.json"), "w") as f:
+        json.dump(dict(meta, id=profile_id), f)
+    rotate(directory, getattr(settings, "PROFILING_KEEP", 50))
+    return profile_id
+
+
+def rotate(directory, keep):
+    """Delete all but the newest ``keep`` profiles (ids start with a timestamp)."""
+    ids = sorted(name[:-5] for name in os.listdir(directory) if name.endswith(".prof"))
+    for profile_id in ids[:max(0, len(ids) - keep)]:
+        for suffix in (".prof", ".json"):
+            try:
+                os.remove(os.path.join(directory, profile_id + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory=None) -> list:
+    directory = directory or profiles_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return profiles
+
+
+def _profile_path(profile_id) -> str:
+    path = os.path.join(profiles_dir(), f"{profile_id}.prof")
+    if not os.path.isfile(path):
+        raise Http404("Профиль не найден.")
+    return path
+
+
+def stats_text(path, sort="cumulative", limit=STATS_LIMIT) -> str:
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+# Admin pages; forum/urls.py mounts them under /admin/profiles/ via admin_view.
+
+def profile_list(request):
+    token = make_token(request.user) if request.method == "POST" else None
+    return render(request, "admin/profiles/list.html", {
+        **admin.site.each_context(request),
+        "title": "Профили запросов",
+        "profiles": list_profiles(),
+        "token": token,
+        "token_header": TOKEN_HEADER,
+        "token_param": TOKEN_PARAM,
+        "token_minutes": getattr(settings, "PROFILING_TOKEN_MAX_AGE", 3600) // 60,
+        "enabled": "main.profiling.ProfilingMiddleware" in settings.MIDDLEWARE,
+    })
+
+
+def profile_detail(request, profile_id):
+    path = _profile_path(profile_id)
+    try:
+        with open(path[:-len(".prof")] + ".json") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {"id": profile_id}
+    sort = request.GET.get("sort") if request.GET.get("sort") in SORT_KEYS else SORT_KEYS[0]
+    return render(request, "admin/profiles/detail.html", {
+        **admin.site.each_context(request),
+        "title": f"Профиль {profile_id}",
+        "profile": meta,
+        "sort": sort,
+        "sort_keys": SORT_KEYS,
+        "stats": stats_text(path, sort),
+    })
+
+
+def profile_download(request, profile_id):
+    return FileResponse(open(_profile_path(profile_id), "rb"), as_attachment=True, filename=f"{profile_id}.prof")
@@ -0,0 +1,220 @@
+"""Prometheus text rendering of the runtime metrics (``/internal/metrics/prometheus/``).
+
+``render()`` turns the ``metrics.collect()`` dict into exposition format
+0.0.4. Values are per process, like the JSON endpoint: scrape every worker
+or aggregate with ``sum without (instance)``. Covered:
+
+* requests per URL name: rate, errors, latency histogram, SQL queries and
+  cache hits/misses (needs ``REQUEST_INSTRUMENTATION=1``);
+* open WebSocket connections per consumer class;
+* channel layer: group sizes by group kind (``site_global``, ``topic``,
+  ``dialog``, ...), group_send latency and fan-out, undelivered messages
+  in the shared tables and the local receive queues;
+* background publisher backlog (header counters, online users) and lag;
+* recipients per notification batch;
+* tiered cache: reads by result (L1 hit, L2 hit, miss), writes, L1 size,
+  evictions and cross-worker invalidations;
+* PostgreSQL pool usage.
+"""
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "m2f_"
+
+# channel_layer counters exported as Prometheus counters.
+LAYER_COUNTERS = (
+    "messages_sent",
+    "messages_received",
+    "messages_expired",
+    "messages_dropped",
+    "group_memberships_expired",
+)
+PUBLISHER_COUNTERS = ("enqueued", "sent", "coalesced", "dropped", "failed", "batches")
+POOL_GAUGES = ("pool_size", "pool_available", "in_use", "requests_waiting", "saturation")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+class _Exposition:
+    def __init__(self):
+        self.lines = []
+        self._families = set()
+
+    def family(self, name, kind, help_text):
+        if name in self._families:
+            return
+        self._families.add(name)
+        self.lines.append(f"# HELP {PREFIX}{name} {help_text}")
+        self.lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    def sample(self, name, value, labels=None):
+        label_text = ""
+        if labels:
+            label_text = "{" + ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items()) + "}"
+        self.lines.append(f"{PREFIX}{name}{label_text} {_number(value)}")
+
+    def histogram(self, name, help_text, snapshot, labels=None, scale=1.0):
+        """``snapshot`` as produced by ``metrics.Histogram.snapshot()``."""
+        self.family(name, "histogram", help_text)
+        labels = labels or {}
+        cumulative = 0
+        for bound, count in zip(snapshot["buckets"], snapshot["counts"]):
+            cumulative += count
+            self.sample(f"{name}_bucket", cumulative, {**labels, "le": _number(bound * scale)})
+        self.sample(f"{name}_bucket", snapshot["count"], {**labels, "le": "+Inf"})
+        self.sample(f"{name}_sum", snapshot["sum"] * scale, labels)
+        self.sample(f"{name}_count", snapshot["count"], labels)
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def _section(data, name):
+    section = data.get(name)
+    if not isinstance(section, dict) or "error" in section:
+        return None
+    return section
+
+
+def _requests(out, section):
+    views = sorted(section.get("views", {}).items())
+    bounds_ms = [bound for bound in section.get("buckets_ms", []) if bound != "+Inf"]
+    # Samples of one family must be contiguous, so loop over views per family.
+    out.family("http_requests_total", "counter", "Requests handled, by URL name.")
+    for view_name, view in views:
+        out.sample("http_requests_total", view["count"], {"view": view_name})
+    out.family("http_request_errors_total", "counter", "Responses with status 5xx, by URL name.")
+    for view_name, view in views:
+        out.sample("http_request_errors_total", view["errors"], {"view": view_name})
+    for view_name, view in views:
+        out.histogram(
+            "http_request_duration_seconds",
+            "Request latency, by URL name.",
+            {"buckets": bounds_ms, "counts": view["buckets"], "sum": view["total_ms"], "count": view["count"]},
+            {"view": view_name},
+            scale=0.001,
+        )
+    out.family("http_db_queries_total", "counter", "SQL queries run by requests, by URL name.")
+    for view_name, view in views:
+        out.sample("http_db_queries_total", view["queries"], {"view": view_name})
+    out.family("http_cache_reads_total", "counter", "Cache reads by requests, by URL name and result.")
+    for view_name, view in views:
+        out.sample("http_cache_reads_total", view["cache_hits"], {"view": view_name, "result": "hit"})
+        out.sample("http_cache_reads_total", view["cache_misses"], {"view": view_name, "result": "miss"})
+    hits = sum(view["cache_hits"] for _, view in views)
+    reads = hits + sum(view["cache_misses"] for _, view in views)
+    out.family("http_cache_hit_ratio", "gauge", "Share of cache reads by requests that hit, since process start.")
+    out.sample("http_cache_hit_ratio", hits / reads if reads else 0.0)
+
+
+def _websockets(out, section):
+    out.family("websocket_connections", "gauge", "Open WebSocket connections, by consumer class.")
+    for consumer, counts in sorted(section.items()):
+        out.sample("websocket_connections", counts["active"], {"consumer": consumer})
+    out.family("websocket_connections_accepted_total", "counter", "Accepted WebSocket connections, by consumer class.")
+    for consumer, counts in sorted(section.items()):
+        out.sample("websocket_connections_accepted_total", counts["accepted"], {"consumer": consumer})
+
+
+def _channel_layer(out, section):
+    backend = {"backend": section.get("backend", "")}
+    for name in LAYER_COUNTERS:
+        out.family(f"channel_layer_{name}_total", "counter", f"Channel layer {name.replace('_', ' ')}.")
+        out.sample(f"channel_layer_{name}_total", section.get(name, 0), backend)
+    for name, help_text in (
+        ("group_send_seconds_histogram", "group_send latency (members lookup and fan-out insert)."),
+        ("group_send_fanout_histogram", "Channels a group_send delivered to."),
+    ):
+        if name in section:
+            out.histogram(f"channel_layer_{name.removesuffix('_histogram')}", help_text, section[name], backend)
+    out.family("channel_layer_pending_messages", "gauge", "Undelivered messages in the shared layer tables, all workers.")
+    out.sample("channel_layer_pending_messages", section.get("pending_messages", 0), backend)
+    out.family("channel_layer_local_queue_depth", "gauge", "Messages waiting in this process's receive queues.")
+    out.sample("channel_layer_local_queue_depth", section.get("local_queue_depth", 0), backend)
+    groups = section.get("groups", {})
+    for metric, key, help_text in (
+        ("channel_groups", "groups", "Channel groups with members, by kind."),
+        ("channel_group_members", "members", "Group memberships, by group kind."),
+        ("channel_group_members_max", "max_members", "Members of the largest group of each kind."),
+    ):
+        out.family(metric, "gauge", help_text)
+        for kind, stats in sorted(groups.items()):
+            out.sample(metric, stats[key], {"kind": kind})
+
+
+def _publisher(out, section):
+    for name in PUBLISHER_COUNTERS:
+        out.family(f"realtime_publisher_{name}_total", "counter", f"Background publisher events {name}.")
+        out.sample(f"realtime_publisher_{name}_total", section.get(name, 0))
+    out.family("realtime_publisher_queue_depth", "gauge", "Events waiting in the background publisher queue.")
+    out.sample("realtime_publisher_queue_depth", section.get("queue_depth", 0))
+    out.family("realtime_publisher_queue_capacity", "gauge", "Background publisher queue size limit.")
+    out.sample("realtime_publisher_queue_capacity", section.get("queue_capacity", 0))
+    out.family("realtime_publisher_lag_seconds", "gauge", "Queue time of the oldest event in the last batch.")
+    out.sample("realtime_publisher_lag_seconds", section.get("lag_last_seconds", 0.0))
+
+
+def _notification_fanout(out, section):
+    for kind, snapshot in sorted(section.items()):
+        out.histogram("notification_fanout", "Recipients per notification batch, by kind.", snapshot, {"kind": kind})
+
+
+def _cache(out, section):
+    tiers = sorted(section.items())
+    out.family("cache_reads_total", "counter", "Tiered cache reads, by shared cache and result.")
+    for tier, stats in tiers:
+        for result, key in (("l1_hit", "l1_hits"), ("l2_hit", "l2_hits"), ("miss", "misses")):
+            out.sample("cache_reads_total", stats[key], {"cache": tier, "result": result})
+    out.family("cache_writes_total", "counter", "Tiered cache writes, by shared cache and operation.")
+    for tier, stats in tiers:
+        out.sample("cache_writes_total", stats["sets"], {"cache": tier, "op": "set"})
+        out.sample("cache_writes_total", stats["deletes"], {"cache": tier, "op": "delete"})
+    out.family("cache_hit_ratio", "gauge", "Share of tiered cache reads served by L1 or L2, since process start.")
+    for tier, stats in tiers:
+        out.sample("cache_hit_ratio", stats["hit_ratio"], {"cache": tier})
+    out.family("cache_l1_entries", "gauge", "Entries in this process's L1.")
+    for tier, stats in tiers:
+        out.sample("cache_l1_entries", stats["l1_entries"], {"cache": tier})
+    out.family("cache_l1_evictions_total", "counter", "L1 entries evicted to stay under the size limit.")
+    for tier, stats in tiers:
+        out.sample("cache_l1_evictions_total", stats["l1_evictions"], {"cache": tier})
+    out.family("cache_invalidations_total", "counter", "Invalidation messages sent to or received from other workers.")
+    for tier, stats in tiers:
+        out.sample("cache_invalidations_total", stats["invalidations_sent"], {"cache": tier, "direction": "sent"})
+        out.sample("cache_invalidations_total", stats["invalidations_received"], {"cache": tier, "direction": "received"})
+
+
+def _db_pool(out, section):
+    pools = [(alias, stats) for alias, stats in sorted(section.items()) if stats.get("opened", True)]
+    for name in POOL_GAUGES:
+        out.family(f"db_pool_{name}", "gauge", f"Database pool {name.replace('_', ' ')}.")
+        for alias, stats in pools:
+            out.sample(f"db_pool_{name}", stats.get(name, 0), {"alias": alias})
+
+
+_SECTIONS = (
+    ("requests", _requests),
+    ("websockets", _websockets),
+    ("channel_layer", _channel_layer),
+    ("realtime_publisher", _publisher),
+    ("notification_fanout", _notification_fanout),
+    ("cache", _cache),
+    ("db_pool", _db_pool),
+)
+
+
+def render(data: dict) -> str:
+    out = _Exposition()
+    for name, write in _SECTIONS:
+        section = _section(data, name)
+        if section is not None:
+            write(out, section)
+    return out.text()
@@ -0,0 +1,211 @@
+"""Non-blocking realtime publishing for sync views.
+
+Views and middleware hand events to ``enqueue()`` (``aenqueue()`` in async
+views) and return immediately.
+A daemon thread with its own event loop drains the bounded queue in
+batches and delivers them one by one, in queue order, with
+``realtime.apublish`` (which assigns the event-log seq), so slow channel
+layer delivery never adds latency to HTTP responses. When the queue is
+full the event is dropped and counted; a socket that misses it catches up
+through the event log on its next reconnect.
+
+With a layer that is not shared between processes
+(``CHANNEL_LAYER_BACKEND=memory``) events are published inline instead:
+``InMemoryChannelLayer``'s queues belong to the server's event loop and
+must not be touched from the publisher thread's loop.
+
+Counter snapshots (header badges, online users) can be published with a
+``coalesce`` key: of several queued snapshots with the same key only the
+newest in a batch is sent.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+
+from . import metrics as runtime_metrics
+from . import realtime, tracing
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BackgroundPublisher:
+    def __init__(self, maxsize: int = 1000, batch_size: int = 100):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "failed": 0,
+            "batches": 0,
+            "lag_last_seconds": 0.0,
+            "lag_max_seconds": 0.0,
+        }
+
+    def enqueue(self, groups, handler: str, payload: dict, coalesce=None) -> bool:
+        """Queue an event for delivery; returns False when it was dropped."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.monotonic(), groups, handler, payload, coalesce, tracing.current_context()))
+        except queue.Full:
+            self._incr("dropped")
+            return False
+        self._incr("enqueued")
+        return True
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until every queued event has been handled (tests, shutdown)."""
+        if self._queue is None or self._pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def metrics_snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self._stats)
+        data["queue_depth"] = self._queue.qsize() if self._queue is not None else 0
+        data["queue_capacity"] = self.maxsize
+        return data
+
+    def _incr(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            # A forked worker inherits the object but not the thread.
+            if self._pid == pid:
+                return
+            self._queue = queue.Queue(self.maxsize)
+            self._thread = threading.Thread(
+                target=self._run, args=(self._queue,), name="realtime-publisher", daemon=True
+            )
+            self._thread.start()
+            self._pid = pid
+
+    def _run(self, events):
+        # The blocking get stays on this thread: an executor thread parked
+        # in ``events.get()`` would keep the interpreter from exiting.
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                batch = [events.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(events.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = _STOP in batch
+                if stop:
+                    batch.remove(_STOP)
+                    events.task_done()
+                if batch:
+                    loop.run_until_complete(self._send_batch(batch, events))
+                if stop:
+                    return
+        finally:
+            loop.close()
+
+    async def _send_batch(self, batch, events):
+        latest = {}
+        for index, item in enumerate(batch):
+            if item[4] is not None:
+                latest[item[4]] = index
+        to_send = [item for index, item in enumerate(batch) if item[4] is None or latest[item[4]] == index]
+
+        # One at a time, in queue order: each publish takes its event-log seq,
+        # and clients rely on seqs and delivery following the order of events.
+        failed = []
+        for item in to_send:
+            try:
+                await self._publish(*item[1:4], item[5])
+            except Exception as exc:
+                failed.append(exc)
+                logger.warning("Realtime publish failed: %s", exc)
+        now = time.monotonic()
+        lag = now - min(item[0] for item in batch)
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["sent"] += len(to_send) - len(failed)
+            self._stats["failed"] += len(failed)
+            self._stats["coalesced"] += len(batch) - len(to_send)
+            self._stats["lag_last_seconds"] = lag
+            self._stats["lag_max_seconds"] = max(self._stats["lag_max_seconds"], lag)
+        for _ in batch:
+            events.task_done()
+
+    @staticmethod
+    async def _publish(groups, handler, payload, trace_context):
+        # Spans of the delivery join the trace of the request that queued it.
+        with tracing.continued(trace_context):
+            return await realtime.apublish(groups, handler, payload)
+
+    def stop(self, timeout: float = 2.0):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> BackgroundPublisher:
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = BackgroundPublisher(
+                maxsize=getattr(settings, "REALTIME_PUBLISH_QUEUE_SIZE", 1000),
+                batch_size=getattr(settings, "REALTIME_PUBLISH_BATCH_SIZE", 100),
+            )
+            runtime_metrics.register("realtime_publisher", _publisher.metrics_snapshot)
+            atexit.register(_publisher.stop)
+        return _publisher
+
+
+def publishes_inline() -> bool:
+    if not getattr(settings, "REALTIME_PUBLISH_IN_BACKGROUND", True):
+        return True
+    # Not thread-safe across event loops; see the module docstring.
+    return isinstance(get_channel_layer(), InMemoryChannelLayer)
+
+
+def enqueue(groups, handler: str, payload: dict, coalesce=None) -> bool:
+    """Publish without waiting for delivery (see ``realtime.publish`` for the blocking call)."""
+    if publishes_inline():
+        realtime.publish(groups, handler, payload)
+        return True
+    return get_publisher().enqueue(groups, handler, payload, coalesce)
+
+
+async def aenqueue(groups, handler: str, payload: dict, coalesce=None) -> bool:
+    """``enqueue`` for async views; queuing never blocks the event loop."""
+    if publishes_inline():
+        await realtime.apublish(groups, handler, payload)
+        return True
+    return get_publisher().enqueue(groups, handler, payload, coalesce)
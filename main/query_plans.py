@@ -0,0 +1,123 @@
+"""Query-plan regression check for the hot queries.
+
+``HOT_QUERIES`` mirrors the filters and orderings the views, the context
+processors and the realtime helpers run on every page. ``check_plans``
+seeds a few rows inside a transaction that is rolled back, runs EXPLAIN on
+each query and reports the tables it reads with a full scan. On
+PostgreSQL sequential scans are disabled for the session, so a
+``Seq Scan`` in the plan means no index can serve the query at all.
+"""
+import re
+
+from django.db import connection, transaction
+from django.db.models import Count
+
+from .models import (
+    Activity,
+    Category,
+    Comment,
+    CustomUser,
+    Dialog,
+    DialogParticipant,
+    FamilyTask,
+    Message,
+    Notification,
+    Post,
+    Topic,
+)
+
+# SQLite: "SCAN main_topic" reads the whole table, "SCAN main_topic USING
+# INDEX ..." walks an index in order and is fine for ORDER BY ... LIMIT.
+_SQLITE_FULL_SCAN = re.compile(r"\bSCAN (\w+)(?! USING)(?:\s|$)")
+_POSTGRES_FULL_SCAN = re.compile(r"Seq Scan on (\w+)")
+_SORT_MARKERS = ("USE TEMP B-TREE FOR ORDER BY", "Sort Key:")
+
+
+class PlanReport:
+    def __init__(self, label, plan, full_scans, sorts=False):
+        self.label = label
+        self.plan = plan
+        self.full_scans = full_scans
+        self.sorts = sorts
+
+    @property
+    def ok(self):
+        return not self.full_scans
+
+
+def _seed():
+    alice = CustomUser.objects.create_user(username="plan_alice", password=None)
+    bob = CustomUser.objects.create_user(username="plan_bob", password=None)
+    category = Category.objects.create(name="plan-category", slug="plan-category")
+    topic = Topic.objects.create(author=alice, category=category, title="plan")
+    post = Post.objects.create(topic=topic, author=alice, content="plan")
+    Comment.objects.create(topic=topic, author=bob, content="plan")
+    dialog = Dialog.objects.create()
+    DialogParticipant.objects.create(dialog=dialog, user=alice)
+    DialogParticipant.objects.create(dialog=dialog, user=bob)
+    Message.objects.create(dialog=dialog, author=bob, content="plan")
+    Notification.objects.create(recipient=alice, actor=bob, topic=topic, notification_type="like", message="plan")
+    Activity.objects.create(actor=bob, verb="plan", topic=topic, post=post)
+    FamilyTask.objects.create(title="plan", description="plan", created_by=alice, status=FamilyTask.STATUS_IN_PROGRESS)
+    return {"user": alice, "category": category, "topic": topic, "dialog": dialog}
+
+
+HOT_QUERIES = {
+    # context_processors.notifications_count / views._push_header_counters
+    "unread_notifications": lambda s: Notification.objects.filter(recipient=s["user"], is_read=False).order_by(),
+    # views.notifications_list
+    "notifications_list": lambda s: s["user"].notifications.select_related("topic", "actor")[:50],
+    # context_processors.notifications_count
+    "unread_messages": lambda s: (
+        Message.objects.filter(dialog__dialog_participants__user=s["user"])
+        .exclude(author=s["user"]).exclude(read_by__user=s["user"]).order_by()
+    ),
+    # views.dialog_detail
+    "dialog_messages": lambda s: s["dialog"].messages.select_related("author").order_by("created_at"),
+    # context_processors.notifications_count (sidebar)
+    "sidebar_active_tasks": lambda s: (
+        FamilyTask.objects.select_related("assignee")
+        .filter(status=FamilyTask.STATUS_IN_PROGRESS).order_by("due_at", "-created_at")[:5]
+    ),
+    # views.family_hq
+    "family_task_board": lambda s: FamilyTask.objects.order_by("status", "due_at", "-created_at")[:50],
+    # views.home
+    "home_topics": lambda s: Topic.objects.select_related("author", "category").order_by("-is_pinned", "-created_at")[:20],
+    "category_topics": lambda s: (
+        Topic.objects.select_related("author", "category")
+        .filter(category=s["category"]).order_by("-is_pinned", "-created_at")[:20]
+    ),
+    "topic_last_post": lambda s: s["topic"].posts.order_by("-created_at")[:1],
+    "recent_activity": lambda s: Activity.objects.select_related("actor", "topic", "post", "comment").order_by("-created_at")[:3],
+    # views.topic_detail
+    "topic_posts": lambda s: (
+        s["topic"].posts.select_related("author__profile")
+        .annotate(likes_total=Count("likes", distinct=True), comments_total=Count("comments", distinct=True))
+        .order_by("created_at")
+    ),
+    "topic_thread": lambda s: (
+        Comment.objects.filter(topic=s["topic"]).select_related("author__profile").order_by("created_at")
+    ),
+}
+
+
+def full_scans(plan: str, vendor=None) -> list:
+    vendor = vendor or connection.vendor
+    pattern = _POSTGRES_FULL_SCAN if vendor == "postgresql" else _SQLITE_FULL_SCAN
+    return sorted(set(pattern.findall(plan)))
+
+
+def check_plans(queries=None) -> list:
+    """EXPLAIN every hot query against seeded rows; nothing is left behind."""
+    reports = []
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        seeded = _seed()
+        for label, build in (queries or HOT_QUERIES).items():
+            plan = build(seeded).explain()
+            sorts = any(marker in plan for marker in _SORT_MARKERS)
+            reports.append(PlanReport(label, plan, full_scans(plan), sorts))
+        transaction.set_rollback(True)
+    return reports
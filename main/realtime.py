@@ -0,0 +1,230 @@
+"""Channel group names and publishing helpers for realtime events.
+
+Views publish each event only to the groups that care about it:
+``topic_<id>`` for a topic page, ``home`` for the topic list,
+``family_hq`` for the family page and ``dialog_list_<user>`` for a user's
+dialog list. ``site_global`` is kept for site-wide data such as the online
+users ticker.
+
+Each event is encoded to its wire frames once per publish (not once per
+socket): a JSON text frame for old pages plus binary frames for clients
+that negotiate a ``m2f.*`` subprotocol. A binary frame starts with one
+flag byte (``0x00`` raw, ``0x01`` zlib-deflated) followed by the encoded
+payload.
+
+``MultiplexConsumer`` carries several named streams over one socket. Its
+frames are the same pre-encoded frames wrapped with the stream name: JSON
+frames become ``{"stream": ..., "data": ...}`` by string concatenation and
+binary frames get flag ``0x02`` plus a length-prefixed stream name after
+the flag byte, so nothing is re-encoded per socket.
+
+Published events also carry a sequence number from ``main.event_log``.
+Multiplexed frames expose it as ``"seq"`` in JSON and, for binary frames,
+as flag ``0x04`` plus an 8-byte big-endian number after the stream name.
+"""
+import asyncio
+import functools
+import json
+import re
+import zlib
+
+import cbor2
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import tracing
+from .event_log import get_event_log
+
+SITE_GROUP = "site_global"
+HOME_GROUP = "home"
+FAMILY_HQ_GROUP = "family_hq"
+
+MAX_SCOPES_PER_SOCKET = 20
+
+FRAME_RAW = b"\x00"
+FRAME_DEFLATE = b"\x01"
+FRAME_STREAM = 0x02
+FRAME_SEQ = 0x04
+
+CONTROL_STREAM = "_control"
+
+# Subprotocol offered by the browser -> frame key sent to it.
+SUBPROTOCOL_FORMATS = {
+    "m2f.msgpack.deflate": "msgpack.deflate",
+    "m2f.msgpack": "msgpack",
+    "m2f.cbor.deflate": "cbor.deflate",
+    "m2f.cbor": "cbor",
+    "m2f.json": "json",
+}
+
+_BINARY_ENCODERS = {
+    "msgpack": lambda payload: msgpack.packb(payload, use_bin_type=True),
+    "cbor": cbor2.dumps,
+}
+
+# Ids are bounded so names fit the one-byte length in binary stream frames
+# and group names stay under the channel layer's 100 characters.
+_ID = r"[0-9]{1,18}"
+_SCOPE_RE = re.compile(rf"(home|family_hq|topic_(?P<topic_id>{_ID})|dialog_list_(?P<user_id>{_ID}))")
+_STREAM_RE = re.compile(
+    rf"(notifications|site|home|family_hq|dialog_list|topic:(?P<topic_id>{_ID})|dialog:(?P<dialog_id>{_ID}))"
+)
+
+
+def topic_group(topic_id) -> str:
+    return f"topic_{topic_id}"
+
+
+def dialog_group(dialog_id) -> str:
+    return f"dialog_{dialog_id}"
+
+
+def dialog_list_group(user_id) -> str:
+    return f"dialog_list_{user_id}"
+
+
+def notifications_group(user_id) -> str:
+    return f"notifications_{user_id}"
+
+
+def group_kind(group: str) -> str:
+    """Group name without its id suffix, for metrics: ``dialog_list_7`` -> ``dialog_list``."""
+    return re.sub(r"_\d+$", "", group)
+
+
+def scope_allowed(scope: str, user) -> bool:
+    """Return True when ``user`` may subscribe a site socket to ``scope``."""
+    match = _SCOPE_RE.fullmatch(scope or "")
+    if not match:
+        return False
+    if match.group("user_id"):
+        return int(match.group("user_id")) == user.id
+    return True
+
+
+def parse_names(raw: str) -> list[str]:
+    """Split a comma-separated ``?scopes=`` / ``?streams=`` value."""
+    return [name.strip() for name in (raw or "").split(",") if name.strip()][:MAX_SCOPES_PER_SOCKET]
+
+
+def stream_group(stream: str, user) -> str | None:
+    """Map a multiplexed stream name to its channel group for ``user``.
+
+    Returns None for unknown or malformed names. Dialog streams still
+    need a participant check by the caller.
+    """
+    match = _STREAM_RE.fullmatch(stream or "")
+    if not match:
+        return None
+    if match.group("topic_id"):
+        return topic_group(match.group("topic_id"))
+    if match.group("dialog_id"):
+        return dialog_group(match.group("dialog_id"))
+    return {
+        "notifications": notifications_group(user.id),
+        "site": SITE_GROUP,
+        "home": HOME_GROUP,
+        "family_hq": FAMILY_HQ_GROUP,
+        "dialog_list": dialog_list_group(user.id),
+    }[stream]
+
+
+def wrap_stream_frame(frame, stream: str, seq: int | None = None):
+    """Tag an already encoded frame with its stream name and sequence number."""
+    if isinstance(frame, str):
+        if seq is None:
+            return '{"stream":%s,"data":%s}' % (json.dumps(stream), frame)
+        return '{"stream":%s,"seq":%d,"data":%s}' % (json.dumps(stream), seq, frame)
+    name = stream.encode()
+    if seq is None:
+        return bytes([frame[0] | FRAME_STREAM, len(name)]) + name + frame[1:]
+    return bytes([frame[0] | FRAME_STREAM | FRAME_SEQ, len(name)]) + name + seq.to_bytes(8, "big") + frame[1:]
+
+
+def negotiate_subprotocol(offered) -> str | None:
+    """Pick the first subprotocol the client offered that we can speak.
+
+    Binary subprotocols are only accepted for formats in
+    ``REALTIME_BINARY_FORMATS``: those are the ones ``encode_frames``
+    pre-encodes, anything else would be re-encoded for every socket.
+    """
+    binary_formats = getattr(settings, "REALTIME_BINARY_FORMATS", ("msgpack",))
+    for subprotocol in offered or []:
+        fmt = SUBPROTOCOL_FORMATS.get(subprotocol)
+        if fmt == "json" or (fmt and fmt.removesuffix(".deflate") in binary_formats):
+            return subprotocol
+    return None
+
+
+def encode_frames(payload: dict) -> dict:
+    """Encode ``payload`` into every configured wire format."""
+    frames = {"json": json.dumps(payload, ensure_ascii=False, separators=(",", ":"))}
+    compress_min_bytes = getattr(settings, "REALTIME_COMPRESS_MIN_BYTES", 1024)
+    for fmt in getattr(settings, "REALTIME_BINARY_FORMATS", ("msgpack",)):
+        raw = _BINARY_ENCODERS[fmt](payload)
+        frames[fmt] = FRAME_RAW + raw
+        if len(raw) >= compress_min_bytes:
+            frames[f"{fmt}.deflate"] = FRAME_DEFLATE + zlib.compress(raw, 6)
+    return frames
+
+
+def encode_frame(payload: dict, fmt: str):
+    """Encode a one-off ``payload`` (e.g. a control message) for a single format."""
+    return frame_for({"frames": {"json": json.dumps(payload, ensure_ascii=False, separators=(",", ":"))}}, fmt)
+
+
+def frame_for(event: dict, fmt: str):
+    """Return the frame of ``event`` for ``fmt``: ``str`` for JSON, ``bytes`` otherwise."""
+    frames = event.get("frames")
+    if frames is None:
+        frames = {"json": json.dumps(event.get("payload", {}), ensure_ascii=False, separators=(",", ":"))}
+    if fmt in frames:
+        return frames[fmt]
+    base_fmt = fmt.removesuffix(".deflate")
+    if base_fmt in frames:
+        # Small payloads are not worth compressing; the flag byte says so.
+        return frames[base_fmt]
+    if base_fmt in _BINARY_ENCODERS:
+        return FRAME_RAW + _BINARY_ENCODERS[base_fmt](json.loads(frames["json"]))
+    return frames["json"]
+
+
+async def apublish(groups, handler: str, payload: dict) -> int | None:
+    """Send ``payload`` to the consumers' ``handler`` in every group of ``groups``.
+
+    Returns the event's sequence number. Inside a traced request the
+    payload gets the request's ``trace_id``.
+    """
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return None
+    if isinstance(groups, str):
+        groups = [groups]
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        return None
+    with tracing.span(f"publish {handler}", tracing.KIND_PRODUCER, {"messaging.destination.name": groups}) as span:
+        if span is not None:
+            payload = {**payload, "trace_id": span.context.trace_id}
+        frames = encode_frames(payload)
+        seq = await get_event_log(channel_layer).append_event(groups, handler, frames)
+        send = channel_layer.group_send if span is None else functools.partial(_traced_group_send, channel_layer)
+        # The group name travels with the event so a multiplexed socket knows
+        # which of its streams it belongs to.
+        await asyncio.gather(*(
+            send(group, {"type": handler, "group": group, "seq": seq, "frames": frames})
+            for group in groups
+        ))
+    return seq
+
+
+async def _traced_group_send(channel_layer, group, message):
+    with tracing.span(f"group_send {group_kind(group)}", tracing.KIND_PRODUCER, {"messaging.destination.name": group}):
+        await channel_layer.group_send(group, message)
+
+
+def publish(groups, handler: str, payload: dict) -> int | None:
+    """Synchronous ``apublish`` for views and middleware."""
+    return async_to_sync(apublish)(groups, handler, payload)
@@ -6,4 +6,5 @@ websocket_urlpatterns = [
     re_path(r'^ws/dialogs/(?P<dialog_id>\d+)/$', consumers.DialogConsumer.as_asgi()),
     re_path(r'^ws/notifications/$', consumers.NotificationsConsumer.as_asgi()),
     re_path(r'^ws/site/$', consumers.SiteRealtimeConsumer.as_asgi()),
+    re_path(r'^ws/stream/$', consumers.MultiplexConsumer.as_asgi()),
 ]
@@ -0,0 +1,291 @@
+"""Slow-query log and per-fingerprint SQL totals (``SLOW_QUERY_LOG=1``).
+
+An observer of the shared execute wrapper
+(``observability.observe_queries``, whose timing it reuses) reduces each
+statement to a fingerprint: literals and parameters become ``?``, ``IN (...)`` lists
+and multi-row ``VALUES`` collapse, whitespace is normalized. Per
+fingerprint it keeps the query count, total and max time, and which
+views ran it. Queries slower than ``SLOW_QUERY_THRESHOLD_MS`` are logged
+to ``main.slow_queries`` with the calling view and the innermost project
+frame (``main/views.py:123 in topic_detail``) and counted separately.
+
+The totals are rolling: the current window is retired after
+``SLOW_QUERY_WINDOW_SECONDS`` and reports cover the current and the
+previous window. Every worker writes them to ``SLOW_QUERY_DIR`` every
+``SLOW_QUERY_SNAPSHOT_SECONDS``; ``manage.py slow_queries`` merges the
+files and prints the top fingerprints. The current process's totals are
+also under ``slow_queries`` in ``/internal/metrics/``.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+from . import metrics as runtime_metrics
+from . import observability
+from .observability import RequestHookMiddleware, observe_queries, unobserve_queries, write_json_snapshot
+
+logger = logging.getLogger(__name__)
+
+NO_VIEW = "<none>"
+SORT_KEYS = ("total_ms", "count", "max_ms", "avg_ms", "slow")
+SQL_EXAMPLE_LENGTH = 2000
+# Views listed per fingerprint; later ones are only counted in the totals.
+MAX_VIEWS = 10
+
+_request = ContextVar("slow_query_request", default=None)
+
+_COMMENT = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.\"])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.I)
+_PARAM = re.compile(r"%s|%\(\w+\)s")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_ROWS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACE = re.compile(r"\s+")
+
+# Frames of these files and directories are skipped when locating the caller.
+_OWN_FILES = (__file__, observability.__file__)
+_LIBRARY_DIRS = tuple(
+    os.path.dirname(module.__file__) + os.sep
+    for module in map(sys.modules.get, ("django", "asgiref", "channels"))
+    if module is not None and getattr(module, "__file__", None)
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(sql: str) -> str:
+    """Normalized shape of ``sql``: same query with other values, same text."""
+    text = _COMMENT.sub(" ", sql)
+    text = _STRING.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    text = _PARAM.sub("?", text)
+    text = _LIST.sub("(...)", text)
+    text = _ROWS.sub("(...)", text)
+    return _SPACE.sub(" ", text).strip()
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint_id(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def caller_location() -> str:
+    """``path:line in function`` of the innermost frame in project code."""
+    base = str(settings.BASE_DIR) + os.sep
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if (
+            filename.startswith(base)
+            and filename not in _OWN_FILES
+            and not filename.startswith(_LIBRARY_DIRS)
+            and "site-packages" not in filename
+        ):
+            return f"{os.path.relpath(filename, base)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return ""
+
+
+def current_view() -> str:
+    request = _request.get()
+    match = getattr(request, "resolver_match", None) if request is not None else None
+    return (match.view_name if match else "") or NO_VIEW
+
+
+def _merge(into, entry):
+    """Add ``entry``'s totals to ``into`` (same fingerprint)."""
+    into["count"] += entry["count"]
+    into["total_ms"] += entry["total_ms"]
+    into["max_ms"] = max(into["max_ms"], entry["max_ms"])
+    into["slow"] += entry["slow"]
+    for view, count in entry["views"].items():
+        if view in into["views"] or len(into["views"]) < MAX_VIEWS:
+            into["views"][view] = into["views"].get(view, 0) + count
+    if entry["last_slow_at"] > into["last_slow_at"]:
+        for key in ("last_slow_at", "last_slow_ms", "last_slow_sql", "last_slow_view", "last_slow_location"):
+            into[key] = entry[key]
+
+
+def _new_entry(normalized) -> dict:
+    return {
+        "fingerprint": normalized, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0, "views": {},
+        "last_slow_at": 0.0, "last_slow_ms": 0.0, "last_slow_sql": "", "last_slow_view": "", "last_slow_location": "",
+    }
+
+
+def merge_entries(groups) -> dict:
+    """Combine ``{id: entry}`` dicts (windows or workers) into one."""
+    merged = {}
+    for entries in groups:
+        for key, entry in entries.items():
+            if key not in merged:
+                merged[key] = _new_entry(entry["fingerprint"])
+            _merge(merged[key], entry)
+    return merged
+
+
+def top(entries, sort="total_ms", limit=20) -> list:
+    rows = [dict(entry, id=key, avg_ms=entry["total_ms"] / entry["count"]) for key, entry in entries.items() if entry["count"]]
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return rows[:limit]
+
+
+class QueryStats:
+    """Rolling per-fingerprint totals for this process (two windows)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = {}
+        self._previous = {}
+        self._window_started = time.monotonic()
+        self.dropped = 0
+
+    def record(self, sql, duration_ms, view, slow_location=None):
+        normalized = fingerprint(sql)
+        key = fingerprint_id(normalized)
+        window = getattr(settings, "SLOW_QUERY_WINDOW_SECONDS", 3600)
+        with self._lock:
+            if time.monotonic() - self._window_started >= window:
+                self._previous, self._current = self._current, {}
+                self._window_started = time.monotonic()
+            entry = self._current.get(key)
+            if entry is None:
+                if len(self._current) >= getattr(settings, "SLOW_QUERY_MAX_FINGERPRINTS", 1000):
+                    self.dropped += 1
+                    return
+                entry = self._current[key] = _new_entry(normalized)
+            entry["count"] += 1
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            if view in entry["views"] or len(entry["views"]) < MAX_VIEWS:
+                entry["views"][view] = entry["views"].get(view, 0) + 1
+            if slow_location is not None:
+                entry["slow"] += 1
+                entry["last_slow_at"] = time.time()
+                entry["last_slow_ms"] = duration_ms
+                entry["last_slow_sql"] = sql[:SQL_EXAMPLE_LENGTH]
+                entry["last_slow_view"] = view
+                entry["last_slow_location"] = slow_location
+
+    def entries(self) -> dict:
+        with self._lock:
+            return merge_entries((self._previous, self._current))
+
+    def snapshot(self, limit=10) -> dict:
+        entries = self.entries()
+        return {
+            "threshold_ms": getattr(settings, "SLOW_QUERY_THRESHOLD_MS", 100),
+            "fingerprints": len(entries),
+            "queries": sum(entry["count"] for entry in entries.values()),
+            "slow": sum(entry["slow"] for entry in entries.values()),
+            "dropped": self.dropped,
+            "top": top(entries, limit=limit),
+        }
+
+    def reset(self):
+        with self._lock:
+            self._current.clear()
+            self._previous.clear()
+            self._window_started = time.monotonic()
+            self.dropped = 0
+
+
+stats = QueryStats()
+
+
+def _record_query(sql, many, context, duration_ms, error):
+    view = current_view()
+    location = None
+    if duration_ms >= getattr(settings, "SLOW_QUERY_THRESHOLD_MS", 100):
+        location = caller_location()
+        logger.warning(
+            "Slow query %.1f ms [%s] view=%s at %s: %s",
+            duration_ms, fingerprint_id(fingerprint(sql)), view, location or "?", sql[:SQL_EXAMPLE_LENGTH],
+        )
+    stats.record(sql, duration_ms, view, location)
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def install():
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        observe_queries(_record_query)
+        runtime_metrics.register("slow_queries", stats.snapshot)
+        _installed = True
+
+
+def uninstall():
+    """Undo ``install()``: stop observing queries and reporting metrics."""
+    global _installed
+    with _install_lock:
+        unobserve_queries(_record_query)
+        runtime_metrics.unregister("slow_queries", stats.snapshot)
+        _installed = False
+
+
+def snapshot_dir() -> str:
+    return str(getattr(settings, "SLOW_QUERY_DIR", os.path.join(settings.BASE_DIR, "slow_queries")))
+
+
+def write_snapshot(directory=None) -> str:
+    data = {"pid": os.getpid(), "written_at": time.time(), "entries": stats.entries()}
+    return write_json_snapshot(directory or snapshot_dir(), f"queries-{os.getpid()}.json", data)
+
+
+def read_snapshots(directory=None, max_age=None) -> tuple:
+    """Merged entries of all worker files and the number of files read.
+
+    Files older than ``max_age`` seconds (workers that are gone) are skipped.
+    """
+    directory = directory or snapshot_dir()
+    if not os.path.isdir(directory):
+        return {}, 0
+    groups = []
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("queries-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if max_age is not None and time.time() - data.get("written_at", 0) > max_age:
+            continue
+        groups.append(data.get("entries", {}))
+    return merge_entries(groups), len(groups)
+
+
+class SlowQueryMiddleware(RequestHookMiddleware):
+    """Makes the request visible to the query observer and writes snapshots."""
+
+    @property
+    def snapshot_interval(self):
+        return getattr(settings, "SLOW_QUERY_SNAPSHOT_SECONDS", 60)
+
+    def install(self):
+        install()
+
+    def around(self, request):
+        token = _request.set(request)
+        try:
+            return (yield)
+        finally:
+            _request.reset(token)
+            if self.snapshot_due():
+                try:
+                    write_snapshot()
+                except OSError:
+                    logger.exception("Could not write the slow query snapshot")
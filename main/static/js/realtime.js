@@ -0,0 +1,205 @@
+// Realtime sockets: negotiates compact binary frames with the server and
+// falls back to plain JSON. Binary frames are one flag byte (bit 1 = zlib
+// deflate, bit 2 = stream header, bit 3 = sequence number) followed, for
+// multiplexed sockets, by a length-prefixed stream name and an 8-byte
+// big-endian sequence number, then a MessagePack payload.
+(function (global) {
+  'use strict';
+
+  const utf8 = new TextDecoder();
+  // Seqs remembered for deduplication; larger than the server's REPLAY_OVERLAP.
+  const SEQ_WINDOW = 1000;
+
+  function decodeMsgpack(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let pos = 0;
+
+    function str(len) {
+      const value = utf8.decode(bytes.subarray(pos, pos + len));
+      pos += len;
+      return value;
+    }
+    function bin(len) {
+      const value = bytes.slice(pos, pos + len);
+      pos += len;
+      return value;
+    }
+    function array(len) {
+      const out = new Array(len);
+      for (let i = 0; i < len; i++) out[i] = read();
+      return out;
+    }
+    function map(len) {
+      const out = {};
+      for (let i = 0; i < len; i++) {
+        const key = read();
+        out[key] = read();
+      }
+      return out;
+    }
+    function u8() { return view.getUint8(pos++); }
+    function u16() { const v = view.getUint16(pos); pos += 2; return v; }
+    function u32() { const v = view.getUint32(pos); pos += 4; return v; }
+
+    function read() {
+      const type = u8();
+      if (type <= 0x7f) return type;
+      if (type <= 0x8f) return map(type & 0x0f);
+      if (type <= 0x9f) return array(type & 0x0f);
+      if (type <= 0xbf) return str(type & 0x1f);
+      if (type >= 0xe0) return type - 0x100;
+      switch (type) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: return bin(u8());
+        case 0xc5: return bin(u16());
+        case 0xc6: return bin(u32());
+        case 0xca: { const v = view.getFloat32(pos); pos += 4; return v; }
+        case 0xcb: { const v = view.getFloat64(pos); pos += 8; return v; }
+        case 0xcc: return u8();
+        case 0xcd: return u16();
+        case 0xce: return u32();
+        case 0xcf: { const v = Number(view.getBigUint64(pos)); pos += 8; return v; }
+        case 0xd0: { const v = view.getInt8(pos); pos += 1; return v; }
+        case 0xd1: { const v = view.getInt16(pos); pos += 2; return v; }
+        case 0xd2: { const v = view.getInt32(pos); pos += 4; return v; }
+        case 0xd3: { const v = Number(view.getBigInt64(pos)); pos += 8; return v; }
+        case 0xd9: return str(u8());
+        case 0xda: return str(u16());
+        case 0xdb: return str(u32());
+        case 0xdc: return array(u16());
+        case 0xdd: return array(u32());
+        case 0xde: return map(u16());
+        case 0xdf: return map(u32());
+        default: throw new Error(`Unsupported msgpack type 0x${type.toString(16)}`);
+      }
+    }
+
+    return read();
+  }
+
+  async function inflate(bytes) {
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+    return new Uint8Array(await new Response(stream).arrayBuffer());
+  }
+
+  async function decodeFrame(data) {
+    if (typeof data === 'string') return JSON.parse(data || '{}');
+    let bytes = new Uint8Array(data);
+    const flags = bytes[0];
+    let stream = null;
+    let seq = null;
+    bytes = bytes.subarray(1);
+    if (flags & 2) {
+      stream = utf8.decode(bytes.subarray(1, 1 + bytes[0]));
+      bytes = bytes.subarray(1 + bytes[0]);
+    }
+    if (flags & 4) {
+      seq = Number(new DataView(bytes.buffer, bytes.byteOffset, 8).getBigUint64(0));
+      bytes = bytes.subarray(8);
+    }
+    if (flags & 1) bytes = await inflate(bytes);
+    const payload = decodeMsgpack(bytes);
+    if (stream === null) return payload;
+    return seq === null ? { stream, data: payload } : { stream, seq, data: payload };
+  }
+
+  function subprotocols() {
+    const offered = [];
+    if (typeof DecompressionStream !== 'undefined') offered.push('m2f.msgpack.deflate');
+    offered.push('m2f.msgpack', 'm2f.json');
+    return offered;
+  }
+
+  function connect(url, onPayload) {
+    const ws = new WebSocket(url, subprotocols());
+    ws.binaryType = 'arraybuffer';
+    // Decoding is async (inflate), so chain frames to keep their order.
+    let queue = Promise.resolve();
+    ws.addEventListener('message', (event) => {
+      queue = queue
+        .then(() => decodeFrame(event.data))
+        .then(onPayload)
+        .catch((err) => console.warn('Realtime frame dropped', err));
+    });
+    return ws;
+  }
+
+  // One socket per tab: onFrame receives {stream, seq, data} for every
+  // stream. The socket reconnects with ?since=<highest seq> so missed
+  // events are replayed. Seqs can arrive out of order (several workers
+  // publish at once) and replays repeat a few seqs before the cursor, so
+  // frames are deduplicated against the last SEQ_WINDOW seqs seen rather
+  // than skipped because they are lower than the highest. Control frames arrive
+  // on the "_control" stream ({type: "hello" | "resync_required", seq},
+  // or {type: "error", error, stream} for a rejected subscription).
+  function multiplex(url, streams, onFrame) {
+    const current = new Set(streams);
+    const seen = new Set();
+    let lastSeq = null;
+    let retryDelay = 1000;
+    let ws = null;
+    let closed = false;
+
+    function handleFrame(frame) {
+      if (frame.stream === '_control') {
+        // Resync: the gap is gone, start counting from the server's position.
+        const type = frame.data.type;
+        if (type === 'resync_required') seen.clear();
+        if ((type === 'hello' && lastSeq === null) || type === 'resync_required') lastSeq = frame.data.seq;
+      } else if (frame.seq != null && !firstSighting(frame.seq)) {
+        return;
+      }
+      onFrame(frame);
+    }
+
+    function firstSighting(seq) {
+      // Older than the window: already delivered or replayed long ago.
+      if (seen.has(seq) || (lastSeq !== null && seq <= lastSeq - SEQ_WINDOW)) return false;
+      seen.add(seq);
+      // Sets iterate in insertion order: drop the earliest remembered seq.
+      if (seen.size > SEQ_WINDOW) seen.delete(seen.values().next().value);
+      if (lastSeq === null || seq > lastSeq) lastSeq = seq;
+      return true;
+    }
+
+    function open() {
+      const params = new URLSearchParams();
+      if (current.size) params.set('streams', Array.from(current).join(','));
+      if (lastSeq !== null) params.set('since', String(lastSeq));
+      const query = params.toString();
+      ws = connect(query ? `${url}?${query}` : url, handleFrame);
+      api.socket = ws;
+      ws.addEventListener('open', () => { retryDelay = 1000; });
+      ws.addEventListener('close', () => {
+        if (closed) return;
+        setTimeout(open, retryDelay);
+        retryDelay = Math.min(retryDelay * 2, 30000);
+      });
+    }
+
+    const whenOpen = (fn) => {
+      if (ws.readyState === WebSocket.OPEN) fn();
+      else ws.addEventListener('open', fn, { once: true });
+    };
+    const sendAction = (action) => whenOpen(() => ws.send(JSON.stringify(action)));
+    const api = {
+      socket: null,
+      subscribe: (names) => {
+        names.forEach((name) => current.add(name));
+        sendAction({ action: 'subscribe', streams: names });
+      },
+      unsubscribe: (names) => {
+        names.forEach((name) => current.delete(name));
+        sendAction({ action: 'unsubscribe', streams: names });
+      },
+      publish: (stream, data) => sendAction({ action: 'publish', stream, data }),
+      close: () => { closed = true; ws.close(); },
+    };
+    open();
+    return api;
+  }
+
+  global.ForumRealtime = { connect, multiplex, decodeFrame };
+})(window);
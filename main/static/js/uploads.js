@@ -0,0 +1,135 @@
+// Resumable chunked uploads (see main/uploads.py). A file is sent in
+// chunks of the size the server asks for, each with its sha256 when the
+// page runs in a secure context. The session id is remembered per file in
+// localStorage, so after a dropped connection or a reload the upload
+// continues from the offset the server reports instead of from zero.
+//
+// Forms opt in with data-chunked-upload; each file input with
+// data-upload-target is uploaded first and submitted as <name>_upload.
+(function (global) {
+  'use strict';
+
+  const RETRIES = 5;
+
+  function csrfToken() {
+    const match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+    return match ? decodeURIComponent(match[1]) : '';
+  }
+
+  function storageKey(file, target) {
+    return `chunked-upload:${target}:${file.name}:${file.size}:${file.lastModified}`;
+  }
+
+  async function request(url, options) {
+    const response = await fetch(url, Object.assign({ credentials: 'same-origin' }, options));
+    let data = {};
+    try { data = await response.json(); } catch (_) {}
+    return { response, data };
+  }
+
+  async function sha256Hex(blob) {
+    if (!global.crypto || !global.crypto.subtle) return '';
+    const digest = await global.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+  }
+
+  async function openSession(file, target) {
+    const key = storageKey(file, target);
+    const known = global.localStorage ? global.localStorage.getItem(key) : null;
+    if (known) {
+      const { response, data } = await request(`/uploads/${known}/`);
+      if (response.ok && data.upload) return data.upload;
+    }
+    const { response, data } = await request('/uploads/', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken() },
+      body: JSON.stringify({ target, filename: file.name, size: file.size }),
+    });
+    if (!response.ok) throw new Error(data.error || 'upload_failed');
+    if (global.localStorage) global.localStorage.setItem(key, data.upload.id);
+    return data.upload;
+  }
+
+  async function upload(file, target, options) {
+    const onProgress = (options && options.onProgress) || function () {};
+    let session = await openSession(file, target);
+    let failures = 0;
+
+    while (session.status === 'open' && session.received < session.size) {
+      const start = session.received;
+      const chunk = file.slice(start, Math.min(start + session.chunk_size, file.size));
+      const headers = { 'Content-Type': 'application/octet-stream', 'X-CSRFToken': csrfToken(), 'X-Upload-Offset': String(start) };
+      const checksum = await sha256Hex(chunk);
+      if (checksum) headers['X-Chunk-Sha256'] = checksum;
+      try {
+        const { response, data } = await request(`/uploads/${session.id}/chunk/`, { method: 'POST', headers, body: chunk });
+        if (response.ok) {
+          session = data.upload;
+          failures = 0;
+          onProgress(session.received, session.size);
+          continue;
+        }
+        if (typeof data.received === 'number') {
+          // Offset mismatch or a damaged chunk: resend from where the server is.
+          session.received = data.received;
+        } else if (response.status < 500) {
+          throw new Error(data.error || 'upload_failed');
+        }
+      } catch (err) {
+        // fetch() rejects with a TypeError when the connection drops: retry.
+        if (!(err instanceof TypeError)) throw err;
+      }
+      failures += 1;
+      if (failures > RETRIES) throw new Error('upload_failed');
+      await new Promise((resolve) => setTimeout(resolve, Math.min(1000 * 2 ** failures, 15000)));
+    }
+
+    if (session.status !== 'complete') {
+      const { response, data } = await request(`/uploads/${session.id}/complete/`, {
+        method: 'POST',
+        headers: { 'X-CSRFToken': csrfToken() },
+      });
+      if (!response.ok) {
+        if (global.localStorage) global.localStorage.removeItem(storageKey(file, target));
+        throw new Error(data.error || 'upload_failed');
+      }
+      session = data.upload;
+    }
+    if (global.localStorage) global.localStorage.removeItem(storageKey(file, target));
+    return session;
+  }
+
+  async function prepareForm(form, formData) {
+    const inputs = form.querySelectorAll('input[type="file"][data-upload-target]');
+    for (const input of inputs) {
+      const file = input.files && input.files[0];
+      if (!file) continue;
+      const session = await upload(file, input.dataset.uploadTarget);
+      if (formData) {
+        formData.delete(input.name);
+        formData.set(`${input.name}_upload`, session.id);
+      } else {
+        const hidden = document.createElement('input');
+        hidden.type = 'hidden';
+        hidden.name = `${input.name}_upload`;
+        hidden.value = session.id;
+        form.appendChild(hidden);
+        input.disabled = true;
+      }
+    }
+  }
+
+  document.addEventListener('submit', (evt) => {
+    const form = evt.target;
+    if (!(form instanceof HTMLFormElement) || !form.hasAttribute('data-chunked-upload') || evt.defaultPrevented) return;
+    if (form.dataset.chunkedAjax !== undefined) return;
+    const pending = Array.from(form.querySelectorAll('input[type="file"][data-upload-target]')).some((input) => input.files && input.files[0]);
+    if (!pending) return;
+    evt.preventDefault();
+    prepareForm(form, null)
+      .then(() => HTMLFormElement.prototype.submit.call(form))
+      .catch(() => { alert('Не удалось загрузить файл. Попробуйте ещё раз — загрузка продолжится с места обрыва.'); });
+  });
+
+  global.chunkedUpload = { upload, prepareForm };
+})(window);
@@ -0,0 +1,120 @@
+"""Content-addressed storage for uploads.
+
+Every upload is hashed while it is written and stored once under
+``cas/<first two hex digits>/<sha256><ext>``, whatever field or
+``upload_to`` it came from, so the same screenshot uploaded as a topic
+image, a post image and an avatar takes disk space once. ``MediaBlob``
+rows count how many model fields reference each blob; the counts are kept
+by signal receivers in ``models.py``.
+
+Blobs are shared, so ``delete()`` leaves content-addressed files alone:
+unreferenced blobs are removed by the media garbage collector after a
+grace period. Files stored before this backend (plain ``upload_to``
+names) are still served and deleted as before, and image derivatives
+(``derived/``) are plain files named after their blob.
+"""
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from .images import DERIVED_PREFIX
+
+CAS_PREFIX = "cas/"
+_HASH_CHUNK = 64 * 1024
+
+
+def is_content_addressed(name: str) -> bool:
+    return bool(name) and name.startswith(CAS_PREFIX)
+
+
+def blob_name(digest: str, ext: str) -> str:
+    return f"{CAS_PREFIX}{digest[:2]}/{digest}{ext.lower()}"
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        if name.startswith(DERIVED_PREFIX):
+            return super().get_available_name(name, max_length)
+        # The final name is only known after hashing; see _save().
+        return name
+
+    def _save(self, name, content):
+        if name.startswith(DERIVED_PREFIX):
+            return super()._save(name, content)
+        ext = posixpath.splitext(name)[1]
+        # Spool to a temporary file while hashing so large uploads are read once.
+        with tempfile.NamedTemporaryFile(dir=self._tmp_dir(), delete=False) as spool:
+            sha = hashlib.sha256()
+            size = 0
+            if hasattr(content, "seek"):
+                content.seek(0)
+            for chunk in content.chunks(_HASH_CHUNK):
+                sha.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+        target = blob_name(sha.hexdigest(), ext)
+        try:
+            if self.exists(target):
+                # Fresh mtime keeps the garbage collector's grace period for
+                # a blob that is about to get a new reference.
+                os.utime(self.path(target))
+            else:
+                os.makedirs(os.path.dirname(self.path(target)), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(spool.name, self.file_permissions_mode)
+                # Atomic on one filesystem: concurrent identical uploads race harmlessly.
+                os.replace(spool.name, self.path(target))
+        finally:
+            if os.path.exists(spool.name):
+                os.unlink(spool.name)
+        self._register_blob(target, sha.hexdigest(), size)
+        return target
+
+    def _tmp_dir(self):
+        path = os.path.join(self.location, CAS_PREFIX, "tmp")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _register_blob(self, name, digest, size):
+        from .models import MediaBlob
+
+        MediaBlob.objects.get_or_create(name=name, defaults={"sha256": digest, "size": size})
+
+    def delete(self, name):
+        if is_content_addressed(name):
+            return
+        super().delete(name)
+
+    def purge(self, name):
+        """Really remove a file, content-addressed or not (garbage collector only)."""
+        super().delete(name)
+
+    def adopt(self, path, name) -> str:
+        """Move a finished local file (e.g. an assembled chunked upload) into
+        storage without copying it; returns the blob name."""
+        sha = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+                sha.update(chunk)
+                size += len(chunk)
+        target = blob_name(sha.hexdigest(), posixpath.splitext(name)[1])
+        if self.exists(target):
+            os.utime(self.path(target))
+            os.unlink(path)
+        else:
+            os.makedirs(os.path.dirname(self.path(target)), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(path, self.file_permissions_mode)
+            os.replace(path, self.path(target))
+        self._register_blob(target, sha.hexdigest(), size)
+        return target
+
+    def store_existing(self, name) -> str:
+        """Move a legacy file into the content-addressed area; returns the blob name."""
+        with self.open(name, "rb") as legacy:
+            return self._save(name, File(legacy))
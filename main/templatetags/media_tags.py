@@ -0,0 +1,46 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html, format_html_join
+
+from main import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def srcset(file, kind="content", display=None, sizes="100vw"):
+    """
+    ``src``/``srcset`` attributes for an uploaded image.
+
+    Usage in template:
+      <img {% srcset comment.author.profile.avatar "avatar" display=45 %} alt="">
+      <img {% srcset post.image sizes="(max-width: 800px) 100vw, 800px" %} alt="">
+
+    Avatars get density descriptors for a ``display`` px box, content
+    images descriptors with the derivatives' real widths. Without derivatives only ``src`` (the
+    original) is emitted.
+    """
+    if not file:
+        return ""
+    name = file.name
+    widths = images.derivative_widths(name, kind)
+    if not widths:
+        return format_html('src="{}"', file.url)
+
+    def url_for(size):
+        return default_storage.url(images.derivative_name(name, size))
+
+    available = [size for size in images.sizes_for(kind) if size in widths]
+    if kind == "avatar":
+        display = int(display or available[0])
+        one_x = next((size for size in available if size >= display), available[-1])
+        two_x = next((size for size in available if size >= 2 * display), available[-1])
+        return format_html('src="{}" srcset="{} 1x, {} 2x"', url_for(one_x), url_for(one_x), url_for(two_x))
+
+    # Small originals are not upscaled: list each real width once, with
+    # the smallest file that has it.
+    by_width = {}
+    for size in available:
+        by_width.setdefault(widths[size], size)
+    entries = format_html_join(", ", "{} {}w", ((url_for(size), width) for width, size in by_width.items()))
+    return format_html('src="{}" srcset="{}" sizes="{}"', url_for(available[-1]), entries, sizes)
@@ -1,7 +1,91 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import pstats
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from unittest.mock import patch
+
+import cbor2
+import msgpack
+from PIL import Image as PILImage
+
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    modify_settings,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from .models import Category, Comment, CustomUser, Notification, Topic, TopicSubscription
+from . import (
+    consumers,
+    db_pool,
+    images,
+    instrumentation,
+    loadtest,
+    observability,
+    online_presence,
+    profiling,
+    prometheus,
+    publisher,
+    query_plans,
+    realtime,
+    slow_queries,
+    tiered_cache,
+    tracing,
+    uploads,
+    views,
+)
+from . import metrics as runtime_metrics
+from .channel_layers import SQLiteChannelLayer
+from .consumers import MultiplexConsumer, SiteRealtimeConsumer
+from .db_router import REPLICA_PIN_COOKIE, ReplicaRoutingMiddleware
+from .event_log import LocalEventLog
+from .media_gc import collect_orphaned_media
+from .models import (
+    Activity,
+    Category,
+    Comment,
+    CommentReaction,
+    CustomUser,
+    Dialog,
+    DialogParticipant,
+    FactionDossier,
+    FamilyOperation,
+    FamilyTask,
+    MediaBlob,
+    Message,
+    Notification,
+    Post,
+    Topic,
+    TopicSubscription,
+    UploadSession,
+    UserStats,
+)
+from .publisher import BackgroundPublisher
+from .sqlite import production_options, retry_on_busy
 
 
 class PublicProfileAndSocialFeaturesTests(TestCase):
@@ -29,12 +113,27 @@ class PublicProfileAndSocialFeaturesTests(TestCase):
         expected_url = reverse("public-profile", kwargs={"username": self.owner.username})
         self.assertContains(response, expected_url)
 
+    def test_home_counts_likes_and_comments_without_joining_them(self):
+        self.topic.likes.add(self.owner, self.viewer)
+        for text in ("a", "b", "c"):
+            Comment.objects.create(topic=self.topic, author=self.viewer, content=text)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home") + "?sort=popular")
+
+        topic = response.context["topics"][0]
+        self.assertEqual((topic.likes_total, topic.comments_total), (2, 3))
+        for query in queries:
+            self.assertFalse('JOIN "main_topic_likes"' in query["sql"] and 'JOIN "main_comment"' in query["sql"], query["sql"])
+
     def test_author_auto_subscribed_after_topic_create(self):
         self.client.login(username="owner", password="pass12345")
         response = self.client.post(reverse("create_topic_simple"), {
             "category": self.category.id,
             "title": "New Topic",
             "description": "text",
+            "prefix": Topic.PREFIX_DISCUSSION,
+            "status": Topic.STATUS_OPEN,
         })
         self.assertEqual(response.status_code, 302)
         created_topic = Topic.objects.get(title="New Topic")
@@ -87,11 +186,15 @@ class DirectMessageAndReactionNotificationsTests(TestCase):
 
     def test_chat_view_available_and_can_send_message(self):
         self.client.login(username="alice", password="pass12345")
-        send_url = reverse("chat-with-user", kwargs={"username": self.bob.username})
+        response = self.client.post(reverse("dialog-start", kwargs={"username": self.bob.username}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.get(response.url).status_code, 200)
 
-        response = self.client.post(send_url, {"content": "Привет"})
+        response = self.client.post(response.url, {"content": "Привет"})
         self.assertEqual(response.status_code, 302)
-        self.assertTrue(self.alice.sent_messages.filter(recipient=self.bob, content="Привет").exists())
+        self.assertTrue(
+            self.alice.messages.filter(dialog__dialog_participants__user=self.bob, content="Привет").exists()
+        )
 
     def test_like_topic_creates_notification_for_author(self):
         self.client.login(username="bob", password="pass12345")
@@ -108,8 +211,9 @@ class DirectMessageAndReactionNotificationsTests(TestCase):
             ).exists()
         )
 
-    def test_reply_comment_creates_reply_notification(self):
+    def test_reply_comment_notifies_topic_subscribers(self):
         parent = Comment.objects.create(author=self.alice, topic=self.topic, content="parent")
+        TopicSubscription.objects.create(user=self.alice, topic=self.topic)
         self.client.login(username="bob", password="pass12345")
 
         response = self.client.post(reverse("topic-detail", kwargs={"topic_id": self.topic.id}), {
@@ -123,6 +227,1587 @@ class DirectMessageAndReactionNotificationsTests(TestCase):
                 recipient=self.alice,
                 actor=self.bob,
                 topic=self.topic,
-                notification_type=Notification.TYPE_REPLY,
+                comment__parent=parent,
+                notification_type=Notification.TYPE_COMMENT,
             ).exists()
         )
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class AsyncEndpointsTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+        self.bob = CustomUser.objects.create_user(username="bob", password="pass12345")
+        self.category = Category.objects.create(name="Ивенты", slug="events")
+        self.topic = Topic.objects.create(author=self.alice, category=self.category, title="Topic", description="D")
+        self.dialog = Dialog.objects.create()
+        DialogParticipant.objects.create(dialog=self.dialog, user=self.alice)
+
+    async def test_topic_like_toggles_and_notifies_author(self):
+        await self.async_client.aforce_login(self.bob)
+        url = reverse("toggle-topic-like", kwargs={"topic_id": self.topic.id})
+
+        liked = await self.async_client.post(url)
+        unliked = await self.async_client.post(url)
+
+        self.assertEqual(liked.json(), {"liked": True, "likes": 1})
+        self.assertEqual(unliked.json(), {"liked": False, "likes": 0})
+        self.assertEqual(await Notification.objects.filter(recipient=self.alice, actor=self.bob).acount(), 1)
+
+    async def test_like_events_are_queued_not_published_inline(self):
+        await self.async_client.aforce_login(self.bob)
+        # As with a layer shared between processes.
+        with (
+            patch.object(publisher, "publishes_inline", return_value=False),
+            patch.object(realtime, "apublish") as apublish,
+            patch.object(publisher.get_publisher(), "enqueue") as enqueue,
+        ):
+            await self.async_client.post(reverse("toggle-topic-like", kwargs={"topic_id": self.topic.id}))
+
+        apublish.assert_not_called()
+        events = {call.args[2].get("type", call.args[1]) for call in enqueue.call_args_list}
+        self.assertLessEqual({"notify", "topic_liked"}, events)
+
+    async def test_in_memory_layer_is_published_on_the_server_loop(self):
+        await self.async_client.aforce_login(self.bob)
+        with patch.object(realtime, "apublish") as apublish, patch.object(publisher.get_publisher(), "enqueue") as enqueue:
+            await self.async_client.post(reverse("toggle-topic-like", kwargs={"topic_id": self.topic.id}))
+
+        enqueue.assert_not_called()
+        self.assertIn("topic_liked", {call.args[2].get("type", call.args[1]) for call in apublish.call_args_list})
+
+    async def test_typing_only_for_participants(self):
+        url = reverse("dialog-typing", kwargs={"dialog_id": self.dialog.id})
+        await self.async_client.aforce_login(self.bob)
+        self.assertEqual((await self.async_client.post(url)).status_code, 404)
+
+        await self.async_client.aforce_login(self.alice)
+        self.assertEqual((await self.async_client.post(url)).json(), {"ok": True})
+        participant = await DialogParticipant.objects.aget(dialog=self.dialog, user=self.alice)
+        self.assertIsNotNone(participant.last_typing_at)
+
+
+class UserStatsTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+        self.bob = CustomUser.objects.create_user(username="bob", password="pass12345")
+        self.category = Category.objects.create(name="Ивенты", slug="events")
+
+    def _counters(self, user):
+        stats = UserStats.objects.get(user=user)
+        return {field: getattr(stats, field) for field in UserStats.COUNTER_FIELDS}
+
+    def test_incremental_counters_match_rebuild(self):
+        topic = Topic.objects.create(author=self.alice, category=self.category, title="T", description="D")
+        post = Post.objects.create(topic=topic, author=self.alice, content="p")
+        comment = Comment.objects.create(topic=topic, author=self.alice, content="c")
+        topic.likes.add(self.bob)
+        self.bob.liked_posts.add(post)
+        CommentReaction.objects.create(comment=comment, user=self.bob, reaction_type="like")
+        task = FamilyTask.objects.create(title="T", description="D", assignee=self.alice, created_by=self.bob, reward_points=5)
+        task.status = FamilyTask.STATUS_DONE
+        task.save()
+        Post.objects.create(topic=topic, author=self.alice, content="p2").delete()
+        post.likes.remove(self.bob, self.alice)
+
+        incremental = self._counters(self.alice)
+        self.assertEqual(incremental, {
+            "topics_count": 1, "posts_count": 1, "comments_count": 1,
+            "topic_likes_received": 1, "post_likes_received": 0, "comment_likes_received": 1,
+            "tasks_completed": 1, "reward_points": 5,
+        })
+        call_command("rebuild_user_stats", stdout=io.StringIO())
+        self.assertEqual(self._counters(self.alice), incremental)
+
+        topic.delete()
+        self.assertEqual(self._counters(self.alice)["topic_likes_received"], 0)
+        self.assertEqual(self._counters(self.alice)["comment_likes_received"], 0)
+
+    def test_profile_stats_query_count_does_not_grow_with_content(self):
+        for i in range(5):
+            topic = Topic.objects.create(author=self.alice, category=self.category, title=f"T{i}", description="D")
+            topic.likes.add(self.bob)
+        self.client.force_login(self.bob)
+        url = reverse("public-profile", kwargs={"username": "alice"})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertContains(response, "Получено лайков")
+        self.assertEqual(response.context["stats"].likes_received, 5)
+        self.assertFalse([q for q in queries if "main_topic_likes" in q["sql"]])
+
+
+class ImageDerivativesTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+
+    def _png(self, size=(900, 600)):
+        out = io.BytesIO()
+        PILImage.new("RGB", size, (200, 30, 30)).save(out, "PNG")
+        return SimpleUploadedFile("shot.png", out.getvalue(), content_type="image/png")
+
+    def test_upload_builds_avatar_derivatives_and_srcset(self):
+        profile = self.alice.profile
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.avatar = self._png()
+            profile.save()
+        self.assertTrue(images.flush())
+
+        name = images.derivative_name(profile.avatar.name, 96)
+        with default_storage.open(name) as derived:
+            self.assertEqual(PILImage.open(derived).size, (96, 96))
+        html = Template('{% load media_tags %}<img {% srcset avatar "avatar" display=45 %}>').render(
+            Context({"avatar": profile.avatar})
+        )
+        self.assertIn("/96.webp 2x", html)
+        self.assertIn('src="/media/derived/', html)
+
+    def test_backfill_command_covers_existing_uploads(self):
+        category = Category.objects.create(name="Ивенты", slug="events")
+        name = default_storage.save("topics/old.png", self._png((500, 300)))
+        Topic.objects.create(author=self.alice, category=category, title="T", image=name)
+        cache.clear()
+
+        call_command("build_image_derivatives", stdout=io.StringIO())
+
+        with default_storage.open(images.derivative_name(name, 1280)) as derived:
+            self.assertEqual(PILImage.open(derived).size, (500, 300))
+
+    def test_srcset_lists_real_widths_of_small_originals(self):
+        category = Category.objects.create(name="Ивенты", slug="events")
+        name = default_storage.save("topics/small.png", self._png((500, 300)))
+        topic = Topic.objects.create(author=self.alice, category=category, title="T", image=name)
+        images.generate_derivatives(name, "content")
+        cache.clear()
+
+        html = Template("{% load media_tags %}<img {% srcset image %}>").render(Context({"image": topic.image}))
+        self.assertIn("/320.webp 320w", html)
+        self.assertIn("/640.webp 500w", html)
+        self.assertNotIn("1280", html.split("srcset=")[1].split('"')[1])
+        self.assertNotIn("640w", html)
+
+    def test_upload_does_not_build_derivatives_inline(self):
+        profile = self.alice.profile
+        with patch.object(images, "generate_derivatives") as generate:
+            with self.captureOnCommitCallbacks(execute=True):
+                profile.avatar = self._png()
+                profile.save()
+            generate.assert_not_called()
+            self.assertTrue(images.flush())
+        generate.assert_called_once_with(profile.avatar.name, "avatar")
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+        self.category = Category.objects.create(name="Ивенты", slug="events")
+        self.topic = Topic.objects.create(author=self.alice, category=self.category, title="T")
+
+    def _upload(self, name="Screenshot_20.png", data=b"same bytes"):
+        return SimpleUploadedFile(name, data, content_type="application/octet-stream")
+
+    def test_identical_uploads_share_one_counted_blob(self):
+        post = Post.objects.create(topic=self.topic, author=self.alice, content="p", image=self._upload())
+        comment = Comment.objects.create(topic=self.topic, author=self.alice, content="c", image=self._upload("copy.png"))
+
+        self.assertEqual(post.image.name, comment.image.name)
+        self.assertTrue(post.image.name.startswith("cas/"))
+        self.assertEqual(MediaBlob.objects.get(name=post.image.name).refcount, 2)
+
+        name = post.image.name
+        comment.delete()
+        post.image.delete(save=False)
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+
+    def test_dedupe_command_collapses_legacy_copies(self):
+        first = FileSystemStorage().save("posts/Screenshot_20.png", ContentFile(b"same bytes"))
+        second = FileSystemStorage().save("topic_images/Screenshot_20.png", ContentFile(b"same bytes"))
+        Post.objects.create(topic=self.topic, author=self.alice, content="p", image=first)
+        Topic.objects.filter(pk=self.topic.pk).update(image=second)
+
+        call_command("dedupe_media", stdout=io.StringIO())
+
+        post_image = Post.objects.get().image.name
+        self.assertEqual(post_image, Topic.objects.get(pk=self.topic.pk).image.name)
+        self.assertEqual(MediaBlob.objects.get(name=post_image).refcount, 2)
+        self.assertFalse(default_storage.exists(first))
+        self.assertFalse(default_storage.exists(second))
+
+
+class MediaGarbageCollectorTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+        topic = Topic.objects.create(author=alice, category=Category.objects.create(name="И", slug="i"), title="T")
+        self.kept = Post.objects.create(topic=topic, author=alice, content="p", image=ContentFile(b"kept", "a.png")).image.name
+        self.gone = Post.objects.create(topic=topic, author=alice, content="p", image=ContentFile(b"gone", "b.png"))
+        self.gone_name = self.gone.image.name
+        self.derived = default_storage.save(images.derivative_name(self.kept, 320), ContentFile(b"webp"))
+
+    def _age(self, name, seconds=7 * 24 * 3600):
+        past = time.time() - seconds
+        os.utime(default_storage.path(name), (past, past))
+
+    def test_deletes_only_old_unreferenced_files(self):
+        self.gone.delete()
+        fresh = FileSystemStorage().save("comments/fresh.png", ContentFile(b"fresh"))
+        for name in (self.kept, self.gone_name, self.derived):
+            self._age(name)
+
+        call_command("collect_media", "--dry-run", stdout=io.StringIO())
+        self.assertTrue(default_storage.exists(self.gone_name))
+
+        call_command("collect_media", stdout=io.StringIO())
+        self.assertFalse(default_storage.exists(self.gone_name))
+        self.assertFalse(MediaBlob.objects.filter(name=self.gone_name).exists())
+        for name in (self.kept, self.derived, fresh):
+            self.assertTrue(default_storage.exists(name), name)
+
+    def test_stale_upload_sessions_take_their_part_files(self):
+        session = UploadSession.objects.create(
+            user=CustomUser.objects.get(), target=UploadSession.TARGET_MESSAGE_ATTACHMENT, filename="a.txt", size=10,
+        )
+        UploadSession.objects.filter(pk=session.pk).update(updated_at=timezone.now() - timedelta(days=7))
+        with open(uploads.part_path(session), "wb") as part:
+            part.write(b"0123")
+
+        stats = collect_orphaned_media()
+
+        self.assertEqual(stats["stale_uploads"], 1)
+        self.assertFalse(os.path.exists(uploads.part_path(session)))
+
+
+class MediaServingTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root, MEDIA_OFFLOAD="")
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.blob = "cas/ab/" + "ab" * 32 + ".txt"
+        os.makedirs(os.path.join(self.media_root, "cas", "ab"))
+        with open(os.path.join(self.media_root, self.blob), "wb") as f:
+            f.write(b"0123456789")
+
+    def test_hashed_names_are_immutable_and_revalidate(self):
+        response = self.client.get(f"/media/{self.blob}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(response["ETag"], '"' + "ab" * 32 + '"')
+
+        response = self.client.get(f"/media/{self.blob}", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.client.get(f"/media/{self.blob}", HTTP_RANGE="bytes=2-4")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"234")
+        self.assertEqual(response["Content-Range"], "bytes 2-4/10")
+
+        response = self.client.get(f"/media/{self.blob}", HTTP_RANGE="bytes=-3")
+        self.assertEqual(b"".join(response.streaming_content), b"789")
+
+        response = self.client.get(f"/media/{self.blob}", HTTP_RANGE="bytes=20-")
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(f"/media/{self.blob}", HTTP_RANGE="bytes=2-4", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_offload_and_traversal(self):
+        with override_settings(MEDIA_OFFLOAD="x-accel-redirect", MEDIA_ACCEL_REDIRECT_LOCATION="/protected/"):
+            response = self.client.get(f"/media/{self.blob}")
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected/{self.blob}")
+        self.assertEqual(response.content, b"")
+        self.assertEqual(self.client.get("/media/../settings.py").status_code, 404)
+
+    def _write(self, name, data=b"data"):
+        os.makedirs(os.path.dirname(os.path.join(self.media_root, name)), exist_ok=True)
+        with open(os.path.join(self.media_root, name), "wb") as f:
+            f.write(data)
+
+    def test_only_raster_images_are_served_inline(self):
+        self._write("cas/cd/page.svg", b"<svg onload='alert(1)'/>")
+        self._write("cas/cd/pic.png")
+        response = self.client.get("/media/cas/cd/page.svg")
+        self.assertTrue(response["Content-Disposition"].startswith("attachment"))
+        self.assertEqual(response["Content-Security-Policy"], "sandbox")
+        self.assertEqual(response["X-Content-Type-Options"], "nosniff")
+
+        response = self.client.get("/media/cas/cd/pic.png")
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertFalse(response.has_header("Content-Security-Policy"))
+
+    def test_compressed_files_are_not_marked_content_encoded(self):
+        self._write("cas/cd/backup.tar.gz")
+        response = self.client.get("/media/cas/cd/backup.tar.gz")
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_upload_work_areas_are_not_served(self):
+        self._write("uploads/parts/abc.part")
+        self._write("cas/tmp/tmpx1")
+        self.assertEqual(self.client.get("/media/uploads/parts/abc.part").status_code, 404)
+        self.assertEqual(self.client.get("/media/cas/tmp/tmpx1").status_code, 404)
+
+    def test_attachments_are_served_to_dialog_participants_only(self):
+        alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+        bob = CustomUser.objects.create_user(username="bob", password="pass12345")
+        dialog = Dialog.objects.create()
+        DialogParticipant.objects.create(dialog=dialog, user=alice)
+        shared = Message.objects.create(dialog=dialog, author=alice)
+        legacy = Message.objects.create(dialog=dialog, author=alice)
+        Message.objects.filter(pk=shared.pk).update(attachment=self.blob)
+        Message.objects.filter(pk=legacy.pk).update(attachment="messages/files/old.pdf")
+        self._write("messages/files/old.pdf")
+        shared.refresh_from_db()
+        url = shared.attachment_url
+        self.assertEqual(url, reverse("message-attachment", args=[dialog.id, shared.id]))
+
+        # The blob name says nothing about privacy: the same blob may be a
+        # public image elsewhere, and serving it needs no lookup.
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(f"/media/{self.blob}").status_code, 200)
+        self.assertEqual(self.client.get("/media/messages/files/old.pdf").status_code, 404)
+        self.assertEqual(self.client.get("/media/cas/../messages/files/old.pdf").status_code, 404)
+
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(bob)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(alice)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+        self.assertTrue(response["Cache-Control"].startswith("private"))
+        legacy_url = reverse("message-attachment", args=[dialog.id, legacy.id])
+        self.assertEqual(self.client.get(legacy_url).status_code, 200)
+
+
+@override_settings(UPLOAD_CHUNK_SIZE=4)
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+        self.bob = CustomUser.objects.create_user(username="bob", password="pass12345")
+        self.client.login(username="alice", password="pass12345")
+
+    def _open(self, data, target=UploadSession.TARGET_MESSAGE_ATTACHMENT, filename="log.txt"):
+        response = self.client.post(
+            reverse("upload-create"),
+            {"target": target, "filename": filename, "size": len(data)},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()["upload"]["id"]
+
+    def _chunk(self, upload_id, offset, data, checksum=None):
+        return self.client.post(
+            reverse("upload-chunk", args=[upload_id]),
+            data,
+            content_type="application/octet-stream",
+            HTTP_X_UPLOAD_OFFSET=str(offset),
+            HTTP_X_CHUNK_SHA256=checksum or hashlib.sha256(data).hexdigest(),
+        )
+
+    def _upload(self, data, **kwargs):
+        upload_id = self._open(data, **kwargs)
+        for offset in range(0, len(data), 4):
+            self.assertEqual(self._chunk(upload_id, offset, data[offset:offset + 4]).status_code, 200)
+        self.assertEqual(self.client.post(reverse("upload-complete", args=[upload_id])).status_code, 200)
+        return upload_id
+
+    def test_chunks_are_checked_and_resumed_from_server_offset(self):
+        upload_id = self._open(b"0123456789")
+        self.assertEqual(self._chunk(upload_id, 0, b"0123").status_code, 200)
+
+        response = self._chunk(upload_id, 4, b"4567", checksum="0" * 64)
+        self.assertEqual(response.status_code, 422)
+        response = self._chunk(upload_id, 8, b"89")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["received"], 4)
+
+        status = self.client.get(reverse("upload-detail", args=[upload_id])).json()["upload"]
+        self.assertEqual(status["received"], 4)
+        self.assertEqual(self.client.post(reverse("upload-complete", args=[upload_id])).status_code, 409)
+
+        self._chunk(upload_id, 4, b"4567")
+        self._chunk(upload_id, 8, b"89")
+        response = self.client.post(reverse("upload-complete", args=[upload_id]))
+        self.assertEqual(response.status_code, 200)
+        name = UploadSession.objects.get(pk=upload_id).name
+        self.assertTrue(name.startswith("cas/"))
+        with default_storage.open(name) as f:
+            self.assertEqual(f.read(), b"0123456789")
+
+    def test_finished_upload_attaches_to_message_by_reference(self):
+        dialog = Dialog.objects.create()
+        DialogParticipant.objects.create(dialog=dialog, user=self.alice)
+        DialogParticipant.objects.create(dialog=dialog, user=self.bob)
+        upload_id = self._upload(b"attachment body")
+
+        response = self.client.post(
+            reverse("dialog-detail", args=[dialog.id]),
+            {"content": "", "attachment_upload": upload_id},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 200)
+        message = dialog.messages.get()
+        self.assertTrue(message.attachment.name.startswith("cas/"))
+        self.assertEqual(MediaBlob.objects.get(name=message.attachment.name).refcount, 1)
+        self.assertFalse(UploadSession.objects.filter(pk=upload_id).exists())
+
+    def test_image_targets_reject_non_images_and_other_users_sessions(self):
+        upload_id = self._open(b"not an image", target=UploadSession.TARGET_TASK_PROOF, filename="proof.png")
+        self._chunk(upload_id, 0, b"not ")
+        self._chunk(upload_id, 4, b"an i")
+        self._chunk(upload_id, 8, b"mage")
+        self.assertEqual(self.client.post(reverse("upload-complete", args=[upload_id])).json()["error"], "not_an_image")
+
+        self.client.login(username="bob", password="pass12345")
+        self.assertEqual(self.client.get(reverse("upload-detail", args=[upload_id])).status_code, 404)
+
+    def test_chunk_body_is_read_outside_the_transaction(self):
+        upload_id = self._open(b"0123")
+        depth = len(connection.atomic_blocks)
+        depths = []
+
+        class Body(io.BytesIO):
+            def read(self, size=-1):
+                depths.append(len(connection.atomic_blocks))
+                return super().read(size)
+
+        session = uploads.write_chunk(upload_id, self.alice, 0, Body(b"0123"), 4)
+        self.assertEqual(session.received, 4)
+        self.assertEqual(set(depths), {depth})
+        with open(uploads.part_path(session), "rb") as part:
+            self.assertEqual(part.read(), b"0123")
+        self.assertEqual(os.listdir(uploads.parts_dir()), [f"{upload_id}.part"])
+
+
+class QueryPlanTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        out = io.StringIO()
+        call_command("check_query_plans", stdout=out)
+        self.assertNotIn("SCAN ", out.getvalue())
+        self.assertFalse(Topic.objects.exists())
+
+    def test_unindexed_filter_is_reported(self):
+        reports = query_plans.check_plans({"by_title": lambda s: Topic.objects.filter(title="plan").order_by()})
+        self.assertEqual(reports[0].full_scans, ["main_topic"])
+
+
+class SQLiteProfileTests(SimpleTestCase):
+    def test_retry_on_busy_retries_only_lock_errors(self):
+        calls = []
+
+        @retry_on_busy(delay=0)
+        def write(error):
+            calls.append(error)
+            if len(calls) < 3:
+                raise OperationalError(error)
+            return "ok"
+
+        self.assertEqual(write("database is locked"), "ok")
+        self.assertEqual(len(calls), 3)
+
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            write("no such table: main_topic")
+        self.assertEqual(len(calls), 1)
+
+    def test_production_profile_connection_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, "db.sqlite3"))
+            for pragma in production_options()["init_command"].split(";"):
+                conn.execute(pragma)
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+            self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone()[0], 5000)
+            conn.close()
+
+
+# TransactionTestCase: inside TestCase's transaction every read is pinned
+# to the primary, as it would be in a real atomic() block.
+class ReplicaRouterTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # A second SQLite file stands in for a lagging replica. The alias is
+        # registered after setUpClass, so the test may query it.
+        cls.tmp = tempfile.TemporaryDirectory()
+        connections.settings["replica_test"] = {**connections.settings["default"], "NAME": os.path.join(cls.tmp.name, "replica.sqlite3")}
+        connections["replica_test"].connect()
+        with connections["replica_test"].schema_editor() as editor:
+            editor.create_model(Category)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections["replica_test"].close()
+        del connections["replica_test"]
+        connections.settings.pop("replica_test")
+        cls.tmp.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        # TransactionTestCase closes every connection after a test.
+        if connections["replica_test"].connection is None:
+            connections["replica_test"].connect()
+        with connections["replica_test"].cursor() as cursor:
+            cursor.execute("DELETE FROM main_category")
+        Category.objects.using("replica_test").create(name="Реплика", slug="replica")
+        Category.objects.create(name="Primary", slug="primary")
+
+    def _request(self, method="get", cookies=None, write=False):
+        def view(request):
+            if write:
+                Category.objects.create(name="Новая", slug="new")
+            return HttpResponse(",".join(Category.objects.order_by("slug").values_list("slug", flat=True)))
+
+        request = getattr(RequestFactory(), method)("/")
+        request.COOKIES.update(cookies or {})
+        return ReplicaRoutingMiddleware(view)(request)
+
+    @override_settings(DATABASE_REPLICAS=["replica_test"])
+    def test_reads_use_replica_until_the_request_writes(self):
+        self.assertEqual(self._request().content, b"replica")
+        self.assertEqual(self._request("post").content, b"primary")
+
+        response = self._request(write=True)
+        self.assertEqual(response.content, b"new,primary")
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(self._request(cookies={REPLICA_PIN_COOKIE: "1"}).content, b"new,primary")
+
+        # Outside a request (commands, background threads) reads stay on the primary.
+        self.assertEqual(list(Category.objects.order_by("slug").values_list("slug", flat=True)), ["new", "primary"])
+
+    def test_without_replicas_everything_uses_default(self):
+        response = self._request(write=True)
+        self.assertEqual(response.content, b"new,primary")
+        self.assertNotIn(REPLICA_PIN_COOKIE, response.cookies)
+
+
+class DatabasePoolMetricsTests(SimpleTestCase):
+    def test_summary_reports_saturation_and_wait(self):
+        stats = db_pool.summarize({
+            "pool_min": 2, "pool_max": 10, "pool_size": 8, "pool_available": 2,
+            "requests_num": 40, "requests_queued": 4, "requests_wait_ms": 200,
+        })
+        self.assertEqual(stats["in_use"], 6)
+        self.assertEqual(stats["saturation"], 0.6)
+        self.assertEqual(stats["wait_ms_avg"], 50.0)
+        self.assertEqual(stats["returns_bad"], 0)
+
+    def test_pool_options_check_connections_on_checkout(self):
+        options = db_pool.pool_options(max_size=4)
+        self.assertEqual(options["max_size"], 4)
+        self.assertIs(options["check"], db_pool.check_connection)
+        # SQLite has no pool to report.
+        self.assertEqual(db_pool.pool_stats(), {})
+
+
+class QueryBudgetTests(TestCase):
+    """Query counts of the main views: fixed upper bounds that must not grow with the data."""
+
+    def setUp(self):
+        self.me = CustomUser.objects.create_user(username="budget", password="pass12345", is_staff=True)
+        self.category = Category.objects.create(name="Бюджет", slug="budget")
+        self.topic = Topic.objects.create(author=self.me, category=self.category, title="Thread", description="D")
+        TopicSubscription.objects.create(user=self.me, topic=self.topic)
+        self.dialog = Dialog.objects.create()
+        DialogParticipant.objects.create(dialog=self.dialog, user=self.me)
+        self.rounds = 0
+        self.client.force_login(self.me)
+
+    def _seed(self, n):
+        """Add n users, each with a topic, a post, a deep reply chain, a dialog, notifications and tasks."""
+        self.rounds += 1
+        users = [
+            CustomUser.objects.create_user(username=f"member{self.rounds}x{i}", password="pass12345")
+            for i in range(n)
+        ]
+        parent = None
+        for user in users:
+            topic = Topic.objects.create(author=user, category=self.category, title=f"Topic {user.username}", description="D")
+            topic.likes.add(self.me)
+            Activity.objects.create(actor=user, verb="создал(а) тему", topic=topic)
+            post = Post.objects.create(topic=self.topic, author=user, content="post")
+            post.likes.add(self.me)
+            Comment.objects.create(topic=self.topic, post=post, author=user, content="on post")
+            parent = Comment.objects.create(topic=self.topic, parent=parent, author=user, content="reply")
+            CommentReaction.objects.create(comment=parent, user=self.me, reaction_type="like")
+            TopicSubscription.objects.create(user=user, topic=self.topic)
+            DialogParticipant.objects.create(dialog=self.dialog, user=user)
+            Message.objects.create(dialog=self.dialog, author=user, content="hi")
+            dialog = Dialog.objects.create()
+            DialogParticipant.objects.create(dialog=dialog, user=self.me)
+            DialogParticipant.objects.create(dialog=dialog, user=user)
+            Message.objects.create(dialog=dialog, author=user, content="hi")
+            Notification.objects.create(recipient=self.me, actor=user, topic=topic, notification_type=Notification.TYPE_LIKE, message="like")
+            FamilyTask.objects.create(title="task", description="d", assignee=self.me, created_by=user, status=FamilyTask.STATUS_IN_PROGRESS)
+            FamilyOperation.objects.create(title="op", objective="o", scheduled_for=timezone.now(), coordinator=user).participants.add(self.me)
+            FactionDossier.objects.create(target_name=user.username, notes="n", author=user)
+
+    def _count(self, method, url, **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400, url)
+        return len(ctx)
+
+    def assertQueryBudget(self, budget, url, **kwargs):
+        # The first request warms per-user caches (UserStats, presence).
+        self._seed(2)
+        self.client.get(url, **kwargs)
+        small = self._count("get", url, **kwargs)
+        self._seed(6)
+        large = self._count("get", url, **kwargs)
+        self.assertEqual(small, large, f"{url}: {small} queries with little data, {large} with more (N+1?)")
+        self.assertLessEqual(large, budget, url)
+
+    def test_home(self):
+        self.assertQueryBudget(16, reverse("home"))
+        self.assertQueryBudget(16, reverse("home") + "?sort=popular&category=budget&q=Topic")
+        self.assertQueryBudget(16, reverse("home") + "?sort=comments&prefix=discussion&status=open")
+
+    def test_topic_detail_with_deep_thread(self):
+        self.assertQueryBudget(20, reverse("topic-detail", kwargs={"topic_id": self.topic.id}))
+
+    def test_dialogs(self):
+        self.assertQueryBudget(14, reverse("dialogs"))
+        url = reverse("dialog-detail", kwargs={"dialog_id": self.dialog.id})
+        self.assertQueryBudget(14, url)
+        self.assertQueryBudget(9, url, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+    def test_profiles_family_and_notifications(self):
+        self.assertQueryBudget(14, reverse("profile"))
+        self.assertQueryBudget(16, reverse("public-profile", kwargs={"username": self.me.username}))
+        self.assertQueryBudget(14, reverse("family-hq"))
+        self.assertQueryBudget(10, reverse("notifications"))
+
+    def test_write_endpoints(self):
+        topic_url = reverse("topic-detail", kwargs={"topic_id": self.topic.id})
+        dialog_url = reverse("dialog-detail", kwargs={"dialog_id": self.dialog.id})
+        soldier = CustomUser.objects.create_user(username="soldier", password="pass12345")
+        writes = [
+            (18, "comment", topic_url, {"content": "@member1x0 ответ"}),
+            (12, "post", topic_url, {"content": "пост", "submit_post": "1"}),
+            (10, "message", dialog_url, {"content": "Привет"}),
+            (18, "topic", reverse("create_topic_simple"), {
+                "category": self.category.id, "title": "Новая", "description": "d",
+                "prefix": Topic.PREFIX_DISCUSSION, "status": Topic.STATUS_OPEN, "tags_input": "a, b",
+            }),
+            (12, "task", reverse("create-family-task"), {
+                "title": "t", "description": "d", "assignee": soldier.id, "status": FamilyTask.STATUS_OPEN, "reward_points": 5,
+            }),
+            (10, "topic like", reverse("toggle-topic-like", kwargs={"topic_id": self.topic.id}), {}),
+            (8, "mark read", reverse("notifications-mark-read"), {}),
+        ]
+        self._seed(2)
+        for _, _, url, data in writes:
+            self.client.post(url, data=data)
+        small = {name: self._count("post", url, data=data) for _, name, url, data in writes}
+        self._seed(6)
+        for budget, name, url, data in writes:
+            if name == "topic like":
+                # Toggle back so the like is measured in the same direction.
+                self.client.post(url, data=data)
+            large = self._count("post", url, data=data)
+            self.assertEqual(small[name], large, f"{name}: {small[name]} queries with little data, {large} with more (N+1?)")
+            self.assertLessEqual(large, budget, name)
+        self.assertEqual(FamilyTask.objects.filter(assignee=soldier).count(), 3)
+        self.assertTrue(Notification.objects.filter(recipient__username="member1x0", notification_type=Notification.TYPE_MENTION).exists())
+
+    def test_header_counters_for_many_users(self):
+        self._seed(3)
+        other = CustomUser.objects.get(username="member1x0")
+        with patch("main.views.publisher.enqueue") as enqueue, CaptureQueriesContext(connection) as ctx:
+            views._push_header_counters(self.me, other)
+        self.assertEqual(len(ctx), 1)
+        payloads = {call.args[0]: call.args[2] for call in enqueue.call_args_list}
+        self.assertEqual(payloads[realtime.notifications_group(self.me.id)], {
+            "unread_notifications_count": self.me.notifications.filter(is_read=False).count(),
+            "unread_messages_count": 6,
+        })
+        self.assertEqual(payloads[realtime.notifications_group(other.id)], {
+            "unread_notifications_count": 0,
+            "unread_messages_count": 2,
+        })
+
+
+@modify_settings(MIDDLEWARE={"prepend": "main.instrumentation.RequestInstrumentationMiddleware"})
+class RequestInstrumentationTests(TestCase):
+    def setUp(self):
+        instrumentation.stats.reset()
+        self.addCleanup(instrumentation.stats.reset)
+
+    def test_records_queries_and_latency_per_url_name(self):
+        Category.objects.create(name="Новости", slug="news")
+        response = self.client.get(reverse("home"))
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response["Server-Timing"], r'db;dur=[\d.]+;desc="\d+ queries".*total;dur=[\d.]+')
+
+        self.client.get(reverse("home"))
+        view = instrumentation.stats.snapshot()["views"]["home"]
+        self.assertEqual(view["count"], 2)
+        self.assertEqual(sum(view["buckets"]), 2)
+        self.assertGreater(view["queries"], 0)
+        self.assertEqual(view["errors"], 0)
+
+    def test_counts_cache_hits_and_misses(self):
+        def view(request):
+            cache.set("instrumentation-test", 1)
+            cache.get("instrumentation-test")
+            cache.get("instrumentation-missing")
+            cache.get_many(["instrumentation-test", "instrumentation-missing"])
+            return HttpResponse("ok")
+
+        instrumentation.install()
+        middleware = instrumentation.RequestInstrumentationMiddleware(view)
+        response = middleware(RequestFactory().get("/"))
+        self.assertIn('cache;desc="2 hits, 2 misses"', response["Server-Timing"])
+        self.assertEqual(instrumentation.stats.snapshot()["views"][instrumentation.UNRESOLVED]["cache_misses"], 2)
+        # Outside a request the wrapped cache behaves as before.
+        self.assertEqual(cache.get("instrumentation-missing", "default"), "default")
+
+    def test_snapshot_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.client.get(reverse("home"))
+        with open(instrumentation.write_snapshot(directory)) as f:
+            self.assertEqual(json.load(f)["views"]["home"]["count"], 1)
+
+
+class LoadTestToolsTests(TestCase):
+    def test_generate_forum_data(self):
+        out = io.StringIO()
+        call_command(
+            "generate_forum_data", "--scale", "0.001", "--users", "20000", "--comments", "400000",
+            "--max-depth", "4", "--prefix", "gen", stdout=out,
+        )
+        self.assertEqual(CustomUser.objects.filter(username__startswith="gen_").count(), 20)
+        self.assertEqual(Topic.objects.count(), 100)
+        self.assertEqual(Comment.objects.count(), 400)
+        self.assertTrue(Comment.objects.filter(parent__parent__isnull=False).exists())
+        self.assertFalse(Comment.objects.filter(parent__parent__parent__parent__parent__isnull=False).exists())
+        self.assertTrue(Message.objects.exists())
+        self.assertEqual(UserStats.objects.get(user__username="gen_0").comments_count,
+                         Comment.objects.filter(author__username="gen_0").count())
+        self.assertTrue(self.client.login(username="gen_3", password="loadtest12345"))
+        with self.assertRaises(CommandError):
+            call_command("generate_forum_data", "--scale", "0.001", "--prefix", "gen", stdout=out)
+
+    def test_latency_summary(self):
+        self.assertEqual(loadtest.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(loadtest.percentile([1, 2, 3, 4], 99), 4)
+        self.assertEqual(loadtest.percentile([], 95), 0.0)
+        stats = loadtest.LatencyStats()
+        for ms in range(1, 101):
+            stats.record("home", ms / 1000)
+        stats.record("home", 0, ok=False)
+        [row] = stats.summary(duration=10)
+        self.assertEqual(row, {
+            "endpoint": "home", "requests": 100, "errors": 1, "rps": 10.0,
+            "p50_ms": 50.0, "p95_ms": 95.0, "p99_ms": 99.0,
+        })
+
+    def test_websocket_frames_round_trip(self):
+        for payload in (b"hello", b"x" * 300, b"y" * 70000):
+            for mask in (True, False):
+                frame = io.BytesIO(loadtest.encode_frame(payload, opcode=0x1, mask=mask))
+                self.assertEqual(loadtest.decode_frame(frame.read), (0x1, payload))
+
+
+@modify_settings(MIDDLEWARE={"prepend": "main.profiling.ProfilingMiddleware"})
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        settings_override = override_settings(PROFILING_DIR=self.directory, PROFILING_KEEP=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.staff = CustomUser.objects.create_user(username="staff", password="pass12345", is_staff=True)
+        self.member = CustomUser.objects.create_user(username="member", password="pass12345")
+        self.token = profiling.make_token(self.staff)
+
+    def _functions(self, profile_id):
+        stats = pstats.Stats(os.path.join(self.directory, f"{profile_id}.prof"))
+        return {name for _, _, name in stats.stats}
+
+    def test_header_token_profiles_request_with_templates(self):
+        self.client.force_login(self.member)
+        response = self.client.get(reverse("home"), headers={"X-Profile-Token": self.token})
+        profile_id = response["X-Profile-Id"]
+        functions = self._functions(profile_id)
+        self.assertIn("render", functions)
+        self.assertIn("notifications_count", functions)
+        [meta] = profiling.list_profiles()
+        self.assertEqual((meta["id"], meta["view"], meta["user"], meta["mode"]), (profile_id, "home", "staff", "sync"))
+
+    async def test_query_flag_profiles_async_request(self):
+        response = await self.async_client.get(reverse("home"), {"_profile": self.token})
+        self.assertIn("render", self._functions(response["X-Profile-Id"]))
+
+    def test_invalid_tokens_are_ignored(self):
+        member_token = profiling.make_token(self.member)
+        with self.assertLogs("main.profiling", "WARNING"):
+            for token in (member_token, self.token + "x", "garbage"):
+                response = self.client.get(reverse("home"), {"_profile": token})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn("X-Profile-Id", response)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_keeps_newest_profiles(self):
+        ids = [self.client.get(reverse("home"), {"_profile": self.token})["X-Profile-Id"] for _ in range(3)]
+        self.assertEqual(sorted(p["id"] for p in profiling.list_profiles()), sorted(ids)[1:])
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def test_admin_pages(self):
+        profile_id = self.client.get(reverse("home"), {"_profile": self.token})["X-Profile-Id"]
+        self.client.force_login(self.member)
+        self.assertEqual(self.client.get(reverse("admin-profiles")).status_code, 302)
+
+        self.client.force_login(self.staff)
+        self.assertContains(self.client.get(reverse("admin-profiles")), profile_id)
+        response = self.client.post(reverse("admin-profiles"))
+        self.assertEqual(profiling.token_user(response.context["token"]), self.staff)
+        self.assertContains(self.client.get(reverse("admin-profile-detail", args=[profile_id]), {"sort": "tottime"}), "Ordered by: internal time")
+        download = self.client.get(reverse("admin-profile-download", args=[profile_id]))
+        self.assertIn("attachment", download["Content-Disposition"])
+        self.assertTrue(b"".join(download.streaming_content))
+        self.assertEqual(self.client.get(reverse("admin-profile-detail", args=["missing"])).status_code, 404)
+
+
+class PrometheusMetricsTests(TestCase):
+    def test_render(self):
+        histogram = runtime_metrics.Histogram((0.01, 0.1))
+        for seconds in (0.005, 0.05, 0.05, 3):
+            histogram.observe(seconds)
+        text = prometheus.render({
+            "pid": 1,
+            "requests": {"buckets_ms": [10, 100, "+Inf"], "views": {
+                "home": {"count": 3, "errors": 1, "total_ms": 160.0, "buckets": [1, 2, 0], "queries": 9,
+                         "cache_hits": 3, "cache_misses": 1},
+                "topic-detail": {"count": 1, "errors": 0, "total_ms": 5.0, "buckets": [1, 0, 0], "queries": 4,
+                                 "cache_hits": 0, "cache_misses": 0},
+            }},
+            "websockets": {"MultiplexConsumer": {"active": 2, "accepted": 5}},
+            "channel_layer": {"backend": "SQLiteChannelLayer", "messages_sent": 7, "pending_messages": 4,
+                              "group_send_seconds_histogram": histogram.snapshot(),
+                              "groups": {"site_global": {"groups": 1, "members": 40, "max_members": 40}}},
+            "realtime_publisher": {"error": "broken"},
+        })
+        lines = text.splitlines()
+        for line in (
+            'm2f_http_requests_total{view="home"} 3',
+            'm2f_http_request_duration_seconds_bucket{view="home",le="0.01"} 1',
+            'm2f_http_request_duration_seconds_bucket{view="home",le="0.1"} 3',
+            'm2f_http_request_duration_seconds_bucket{view="home",le="+Inf"} 3',
+            'm2f_http_request_duration_seconds_sum{view="home"} 0.16',
+            'm2f_http_cache_reads_total{view="home",result="miss"} 1',
+            "m2f_http_cache_hit_ratio 0.75",
+            'm2f_websocket_connections{consumer="MultiplexConsumer"} 2',
+            'm2f_channel_layer_group_send_seconds_bucket{backend="SQLiteChannelLayer",le="0.1"} 3',
+            'm2f_channel_layer_group_send_seconds_count{backend="SQLiteChannelLayer"} 4',
+            'm2f_channel_layer_pending_messages{backend="SQLiteChannelLayer"} 4',
+            'm2f_channel_group_members_max{kind="site_global"} 40',
+        ):
+            self.assertIn(line, lines)
+        self.assertNotIn("realtime_publisher", text)
+        # Every family is declared once and its samples follow the declaration.
+        families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+        self.assertEqual(len(families), len(set(families)))
+        current = None
+        for line in lines:
+            if line.startswith("# TYPE"):
+                current = line.split()[2]
+            elif not line.startswith("#"):
+                self.assertTrue(line.startswith(current), line)
+
+    async def test_counts_open_websockets_per_consumer(self):
+        user = await CustomUser.objects.acreate(username="socket")
+        before = consumers.connection_stats().get("MultiplexConsumer", {"active": 0, "accepted": 0})
+        communicator = WebsocketCommunicator(MultiplexConsumer.as_asgi(), "/ws/stream/?streams=site")
+        communicator.scope["user"] = user
+        await communicator.connect()
+        self.assertEqual(consumers.connection_stats()["MultiplexConsumer"]["active"], before["active"] + 1)
+        await communicator.disconnect()
+        self.assertEqual(consumers.connection_stats()["MultiplexConsumer"], {
+            "active": before["active"], "accepted": before["accepted"] + 1,
+        })
+
+    @override_settings(METRICS_TOKEN="scrape-token")
+    def test_endpoint(self):
+        url = reverse("runtime-metrics-prometheus")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer scrape-tokeü"}).status_code, 403)
+
+        author = CustomUser.objects.create_user(username="author", password="pass12345")
+        topic = Topic.objects.create(author=author, category=Category.objects.create(name="C", slug="c"), title="T", description="D")
+        for name in ("sub1", "sub2"):
+            TopicSubscription.objects.create(user=CustomUser.objects.create_user(username=name), topic=topic)
+        before = views.notification_fanout["subscribers"].snapshot()
+        self.client.force_login(author)
+        self.client.post(reverse("topic-detail", kwargs={"topic_id": topic.id}), {"content": "hi"})
+        self.assertEqual(views.notification_fanout["subscribers"].snapshot()["sum"], before["sum"] + 2)
+
+        self.client.logout()
+        response = self.client.get(url, headers={"Authorization": "Bearer scrape-token"})
+        self.assertEqual(response["Content-Type"], prometheus.CONTENT_TYPE)
+        text = response.content.decode()
+        self.assertIn('m2f_notification_fanout_count{kind="subscribers"}', text)
+        self.assertIn("# TYPE m2f_channel_layer_pending_messages gauge", text)
+
+
+@modify_settings(MIDDLEWARE={"prepend": "main.tracing.TracingMiddleware"})
+class TracingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.path = os.path.join(directory, "spans.jsonl")
+        settings_override = override_settings(TRACING_FILE=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.author = CustomUser.objects.create_user(username="author", password="pass12345")
+        self.reader = CustomUser.objects.create_user(username="reader", password="pass12345")
+        category = Category.objects.create(name="C", slug="c")
+        self.topic = Topic.objects.create(author=self.author, category=category, title="T", description="D")
+        TopicSubscription.objects.create(user=self.reader, topic=self.topic)
+
+    def _spans(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [
+                span
+                for line in f
+                for resource in json.loads(line)["resourceSpans"]
+                for scope in resource["scopeSpans"]
+                for span in scope["spans"]
+            ]
+
+    def test_comment_post_is_traced_through_helpers_sql_templates_and_publish(self):
+        self.client.force_login(self.author)
+        response = self.client.post(reverse("topic-detail", kwargs={"topic_id": self.topic.id}), {"content": "@reader hi"})
+        self.assertTrue(publisher.get_publisher().flush())
+
+        spans = self._spans()
+        by_id = {span["spanId"]: span for span in spans}
+        self.assertEqual({span["traceId"] for span in spans}, {response["X-Trace-Id"]})
+        [root] = [span for span in spans if not span["parentSpanId"]]
+        self.assertEqual((root["name"], root["kind"]), ("POST topic-detail", tracing.KIND_SERVER))
+        self.assertTrue(all(span["parentSpanId"] in by_id for span in spans if span is not root))
+
+        def children(name):
+            parents = [span["spanId"] for span in spans if span["name"] == name]
+            return {span["name"] for span in spans if span["parentSpanId"] in parents}
+
+        self.assertLessEqual(
+            {"_log_activity", "_notify_topic_subscribers", "_create_mention_notifications",
+             "render main/comments_recursive.html", "_broadcast_site_event"},
+            children("POST topic-detail"),
+        )
+        self.assertIn("SQL INSERT", children("_notify_topic_subscribers"))
+        # Delivery happens on the publisher thread but stays in the trace.
+        self.assertEqual(children("_broadcast_site_event"), {"publish site_event"})
+        self.assertLessEqual({"group_send topic", "group_send home"}, children("publish site_event"))
+
+    def test_incoming_traceparent_and_sampling(self):
+        parent = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+        response = self.client.get(reverse("home"), headers={"traceparent": parent})
+        self.assertEqual(response["X-Trace-Id"], "4bf92f3577b34da6a3ce929d0e0e4736")
+        [root] = [span for span in self._spans() if span["parentSpanId"] == "00f067aa0ba902b7"]
+        self.assertEqual(root["name"], "GET home")
+
+        with override_settings(TRACING_SAMPLE_RATE=0.0):
+            unsampled = self.client.get(reverse("home"))
+        self.assertNotIn("X-Trace-Id", unsampled)
+
+    def test_parse_traceparent(self):
+        self.assertIsNone(tracing.parse_traceparent("00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-00"))
+        self.assertIsNone(tracing.parse_traceparent("00-00000000000000000000000000000000-00f067aa0ba902b7-01"))
+        self.assertIsNone(tracing.parse_traceparent("00-xyz-00f067aa0ba902b7-01"))
+        self.assertIsNone(tracing.parse_traceparent(None))
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+    async def test_published_events_carry_trace_id(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(realtime.HOME_GROUP, channel)
+
+        await realtime.apublish(realtime.HOME_GROUP, "site_event", {"type": "untraced"})
+        self.assertNotIn("trace_id", json.loads((await layer.receive(channel))["frames"]["json"]))
+
+        with tracing.start_trace("test") as root:
+            await realtime.apublish(realtime.HOME_GROUP, "site_event", {"type": "traced"})
+        payload = json.loads((await layer.receive(channel))["frames"]["json"])
+        self.assertEqual(payload, {"type": "traced", "trace_id": root.context.trace_id})
+
+
+@modify_settings(MIDDLEWARE={"prepend": "main.slow_queries.SlowQueryMiddleware"})
+class SlowQueryLogTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        settings_override = override_settings(SLOW_QUERY_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        slow_queries.stats.reset()
+        self.addCleanup(slow_queries.stats.reset)
+        self.addCleanup(slow_queries.uninstall)
+
+    def test_fingerprint_ignores_values_and_list_lengths(self):
+        first = slow_queries.fingerprint(
+            "SELECT *  FROM main_topic WHERE id IN (1, 2, 3) AND title = 'a''b' LIMIT 21 /* hint */"
+        )
+        second = slow_queries.fingerprint("SELECT * FROM main_topic\nWHERE id IN (%s) AND title = %s LIMIT 5")
+        self.assertEqual(first, "SELECT * FROM main_topic WHERE id IN (...) AND title = ? LIMIT ?")
+        self.assertEqual(first, second)
+        self.assertEqual(
+            slow_queries.fingerprint('INSERT INTO "main_tag" ("name", "n2") VALUES (%s, %s), (%s, %s)'),
+            'INSERT INTO "main_tag" ("name", "n2") VALUES (...)',
+        )
+
+    def test_slow_queries_are_logged_aggregated_and_reported(self):
+        with self.assertLogs("main.slow_queries", "WARNING") as logs:
+            user = CustomUser.objects.create_user(username="reader", password="pass12345")
+            self.client.force_login(user)
+            with override_settings(SLOW_QUERY_THRESHOLD_MS=0):
+                self.client.get(reverse("home"))
+                self.client.get(reverse("home"))
+        self.assertTrue(any("view=home at main/" in line for line in logs.output))
+
+        entries = slow_queries.stats.entries()
+        home = [entry for entry in entries.values() if "home" in entry["views"]]
+        self.assertTrue(home)
+        self.assertTrue(all(entry["count"] == entry["slow"] for entry in home))
+        self.assertTrue(any(entry["views"]["home"] == 2 for entry in home))
+        self.assertTrue(all(entry["last_slow_location"].startswith("main/") for entry in home))
+
+        slow_queries.write_snapshot(self.directory)
+        merged, files = slow_queries.read_snapshots(self.directory)
+        self.assertEqual((merged, files), (entries, 1))
+        [heaviest] = slow_queries.top(entries, "total_ms", 1)
+        out = io.StringIO()
+        call_command("slow_queries", limit=3, stdout=out)
+        self.assertIn(heaviest["id"], out.getvalue())
+        self.assertIn("home", out.getvalue())
+
+    def test_totals_roll_over_to_previous_window(self):
+        stats = slow_queries.QueryStats()
+        stats.record("SELECT 1", 5.0, "a")
+        stats.record("SELECT 2", 7.0, "b")
+        self.assertEqual(stats.entries()[slow_queries.fingerprint_id("SELECT ?")]["count"], 2)
+        with override_settings(SLOW_QUERY_WINDOW_SECONDS=0):
+            stats.record("SELECT 3", 1.0, "a")
+            stats.record("SELECT 4", 1.0, "a")
+        # The first window has been dropped; the last two remain.
+        [entry] = stats.entries().values()
+        self.assertEqual((entry["count"], entry["total_ms"], entry["views"]), (2, 2.0, {"a": 2}))
+
+    def test_report_without_snapshots_fails(self):
+        with self.assertRaises(CommandError):
+            call_command("slow_queries", stdout=io.StringIO())
+
+    def test_uninstall_removes_the_observer(self):
+        slow_queries.install()
+        slow_queries.uninstall()
+        self.assertNotIn(slow_queries._record_query, observability._observers)
+        self.assertNotIn("slow_queries", runtime_metrics.collect())
+        with override_settings(SLOW_QUERY_THRESHOLD_MS=0), self.assertNoLogs("main.slow_queries"):
+            Category.objects.count()
+
+    def test_features_share_one_timed_execute_wrapper(self):
+        instrumentation.install()
+        tracing.install()
+        slow_queries.install()
+        connection.ensure_connection()
+        ours = [wrapper for wrapper in connection.execute_wrappers if wrapper.__module__.startswith("main.")]
+        self.assertEqual(ours, [observability._execute])
+
+        def failing_view(request):
+            Category.objects.count()
+            raise ZeroDivisionError
+
+        middleware = slow_queries.SlowQueryMiddleware(failing_view)
+        with (
+            patch.object(slow_queries.stats, "record") as record,
+            self.assertLogs("main.slow_queries", "WARNING"),
+            override_settings(SLOW_QUERY_THRESHOLD_MS=0),
+        ):
+            with self.assertRaises(ZeroDivisionError):
+                middleware(RequestFactory().get("/"))
+        record.assert_called_once()
+        self.assertIsNone(slow_queries._request.get())
+
+
+@override_settings(CACHES={
+    "default": {
+        "BACKEND": "main.tiered_cache.TieredCache",
+        "LOCATION": "tiered-test-shared",
+        "OPTIONS": {"L1_MAX_ENTRIES": 3, "CHANNEL_LAYER": None},
+    },
+    "tiered-test-shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "tiered-test"},
+})
+class TieredCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache, self.shared = caches["default"], caches["tiered-test-shared"]
+        self.cache.clear()
+        self.tier = self.cache.tier
+        self.tier.stats = dict.fromkeys(tiered_cache.STAT_NAMES, 0)
+
+    def test_reads_fill_l1_and_writes_go_through(self):
+        self.shared.set("a", {"users": ["x"]})
+        self.assertEqual(self.cache.get("a"), {"users": ["x"]})
+        value = self.cache.get("a")
+        value["users"].append("mutated")
+        self.assertEqual(self.cache.get("a"), {"users": ["x"]})
+        self.assertIsNone(self.cache.get("missing"))
+
+        self.cache.set_many({"b": 2, "c": 3})
+        self.assertEqual((self.shared.get("b"), self.shared.get("c")), (2, 3))
+        self.assertEqual(self.cache.get_many(["a", "b", "c", "missing"]), {"a": {"users": ["x"]}, "b": 2, "c": 3})
+        self.assertEqual(self.cache.incr("b"), 3)
+        self.assertEqual(self.cache.get("b"), 3)
+        self.cache.delete("c")
+        self.assertIsNone(self.cache.get("c"))
+        self.assertFalse(self.cache.add("a", "other"))
+
+        cache_stats = tiered_cache.cache_stats()
+        stats = cache_stats["tiered-test-shared"]
+        self.assertEqual((stats["l1_hits"], stats["l2_hits"], stats["misses"]), (5, 2, 3))
+        self.assertEqual(stats["hit_ratio"], 0.7)
+        self.assertIn(
+            'm2f_cache_reads_total{cache="tiered-test-shared",result="l1_hit"} 5',
+            prometheus.render({"cache": cache_stats}),
+        )
+
+    def test_l1_is_a_bounded_lru(self):
+        for key in "abcd":
+            self.cache.set(key, key)
+        self.cache.get("b")
+        self.cache.set("e", "e")
+        self.shared.clear()
+        self.assertEqual(self.cache.get_many("abcde"), {"b": "b", "d": "d", "e": "e"})
+        self.assertEqual(self.tier.snapshot()["l1_evictions"], 2)
+
+    def test_invalidation_drops_l1_and_wins_over_concurrent_reads(self):
+        self.cache.set("k", "old")
+        self.shared.set("k", "new")
+        self.assertEqual(self.cache.get("k"), "old")
+        local_key = self.cache.make_key("k")
+        self.tier.invalidate([local_key])
+        self.assertEqual(self.cache.get("k"), "new")
+
+        # A value read from L2 before an invalidation arrived is not kept.
+        generation = self.tier.generation
+        self.tier.invalidate(None)
+        self.tier.remember_if_current(local_key, "stale", 30, generation)
+        self.assertIs(self.tier.get(local_key), tiered_cache._MISSING)
+        self.assertEqual(self.tier.snapshot()["invalidations_received"], 2)
+
+    def test_presence_from_two_workers_meets_in_the_shared_tier(self):
+        alice, bob = CustomUser(id=1, username="alice"), CustomUser(id=2, username="bob")
+        online_presence.mark_user_online(alice)
+        # This worker's L1 now holds the index as it was before bob arrived.
+        self.cache.get(online_presence.PRESENCE_KEY)
+        with patch.object(self.cache, "tier", tiered_cache._LocalTier("other-worker", 3)):
+            self.assertEqual(online_presence.mark_user_online(bob), ["alice", "bob"])
+        self.assertEqual(online_presence.get_online_usernames(), ["alice", "bob"])
+
+        self.shared.delete(online_presence.PRESENCE_USER_KEY.format(alice.id))
+        self.assertEqual(online_presence.get_online_usernames(), ["bob"])
+        self.assertEqual(self.shared.get(online_presence.PRESENCE_KEY), [bob.id])
+
+    def test_invalidations_travel_over_the_channel_layer(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        layers = {"default": {
+            "BACKEND": "main.channel_layers.SQLiteChannelLayer",
+            "CONFIG": {"path": os.path.join(directory, "layer.sqlite3"), "poll_interval": 0.01},
+        }}
+        self.cache.set("k", "v")
+        with override_settings(CHANNEL_LAYERS=layers):
+            # Two "workers" in one process: each skips only its own messages.
+            receiver, sender = tiered_cache._Invalidator("default"), tiered_cache._Invalidator("default")
+        self.addCleanup(receiver.stop)
+        self.addCleanup(sender.stop)
+        deadline = time.monotonic() + 10
+        while self.tier.get(self.cache.make_key("k")) is not tiered_cache._MISSING and time.monotonic() < deadline:
+            sender.publish("tiered-test-shared", [self.cache.make_key("k")])
+            time.sleep(0.1)
+        self.assertIs(self.tier.get(self.cache.make_key("k")), tiered_cache._MISSING)
+        self.assertGreaterEqual(self.tier.snapshot()["invalidations_sent"], 1)
+
+
+class SQLiteChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "channels.sqlite3")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_group_send_reaches_channel_of_other_process(self):
+        worker_a = SQLiteChannelLayer(path=self.path)
+        worker_b = SQLiteChannelLayer(path=self.path)
+        channel = await worker_a.new_channel()
+        await worker_a.group_add("site_global", channel)
+
+        await worker_b.group_send("site_global", {"type": "site_event", "payload": {"type": "ping"}})
+
+        message = await worker_a.receive(channel)
+        self.assertEqual(message["payload"], {"type": "ping"})
+        self.assertEqual(worker_b.metrics.snapshot()["group_send_fanout_total"], 1)
+        await worker_a.close()
+
+    async def test_expired_group_membership_is_not_delivered(self):
+        layer = SQLiteChannelLayer(path=self.path, group_expiry=-1)
+        channel = await layer.new_channel()
+        await layer.group_add("site_global", channel)
+
+        await layer.group_send("site_global", {"type": "site_event", "payload": {}})
+
+        self.assertEqual(layer.metrics.snapshot()["group_send_fanout_total"], 0)
+
+    async def test_metrics_snapshot_reports_group_sizes_and_backlog(self):
+        layer = SQLiteChannelLayer(path=self.path)
+        for user_id in (1, 2):
+            await layer.group_add(realtime.notifications_group(user_id), await layer.new_channel())
+        channels = [await layer.new_channel() for _ in range(3)]
+        for channel in channels:
+            await layer.group_add(realtime.SITE_GROUP, channel)
+        await layer.group_add(realtime.topic_group(5), channels[0])
+
+        await layer.group_send(realtime.SITE_GROUP, {"type": "site_event", "payload": {}})
+
+        snapshot = await asyncio.to_thread(layer.metrics_snapshot)
+        self.assertEqual(snapshot["groups"], {
+            "notifications": {"groups": 2, "members": 2, "max_members": 1},
+            "site_global": {"groups": 1, "members": 3, "max_members": 3},
+            "topic": {"groups": 1, "members": 1, "max_members": 1},
+        })
+        self.assertEqual(snapshot["pending_messages"], 3)
+        self.assertEqual(snapshot["group_send_fanout_histogram"]["count"], 1)
+        self.assertEqual(snapshot["group_send_fanout_histogram"]["sum"], 3)
+
+    async def test_reader_survives_storage_errors(self):
+        layer = SQLiteChannelLayer(path=self.path, poll_interval=0.01)
+        channel = await layer.new_channel()
+        pop = layer._pop
+        failures = [OperationalError("database is locked")]
+
+        def flaky_pop(*args):
+            if failures:
+                raise failures.pop()
+            return pop(*args)
+
+        with patch.object(layer, "_pop", flaky_pop), patch("main.channel_layers.READ_RETRY_SECONDS", 0.01):
+            with self.assertLogs("main.channel_layers", "ERROR"):
+                receiving = asyncio.ensure_future(layer.receive(channel))
+                await layer.send(channel, {"type": "ping"})
+                self.assertEqual(await asyncio.wait_for(receiving, 5), {"type": "ping"})
+        await layer.close()
+
+    async def test_only_the_named_layer_provides_metrics(self):
+        previous = runtime_metrics._providers.get("channel_layer")
+        if previous is not None:
+            self.addCleanup(runtime_metrics.register, "channel_layer", previous)
+        runtime_metrics.unregister("channel_layer")
+        SQLiteChannelLayer(path=self.path)
+        self.assertNotIn("channel_layer", runtime_metrics.collect())
+
+        layer = SQLiteChannelLayer(path=self.path, metrics_name="channel_layer")
+        self.assertIn("channel_layer", await asyncio.to_thread(runtime_metrics.collect))
+        await layer.close()
+        self.assertNotIn("channel_layer", runtime_metrics.collect())
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ScopedRealtimeGroupsTests(SimpleTestCase):
+    class _User:
+        id = 7
+        is_anonymous = False
+
+    def test_dialog_list_scope_only_for_owner(self):
+        self.assertTrue(realtime.scope_allowed("dialog_list_7", self._User()))
+        self.assertFalse(realtime.scope_allowed("dialog_list_8", self._User()))
+        self.assertFalse(realtime.scope_allowed("notifications_7", self._User()))
+
+    async def test_socket_receives_only_subscribed_topic(self):
+        communicator = WebsocketCommunicator(SiteRealtimeConsumer.as_asgi(), "/ws/site/?scopes=topic_5")
+        communicator.scope["user"] = self._User()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        layer = get_channel_layer()
+        await layer.group_send(realtime.topic_group(6), {"type": "site_event", "payload": {"type": "other"}})
+        await layer.group_send(realtime.topic_group(5), {"type": "site_event", "payload": {"type": "mine"}})
+
+        self.assertEqual((await communicator.receive_json_from())["type"], "mine")
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_groups_per_socket_are_capped(self):
+        scopes = ",".join(f"topic_{n}" for n in range(1, 31))
+        communicator = WebsocketCommunicator(SiteRealtimeConsumer.as_asgi(), f"/ws/site/?scopes={scopes}")
+        communicator.scope["user"] = self._User()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        # The site group counts towards the cap.
+        layer = get_channel_layer()
+        last = realtime.MAX_SCOPES_PER_SOCKET - 1
+        await layer.group_send(realtime.topic_group(last + 1), {"type": "site_event", "payload": {"type": "over"}})
+        await layer.group_send(realtime.topic_group(last), {"type": "site_event", "payload": {"type": "last"}})
+
+        self.assertEqual((await communicator.receive_json_from())["type"], "last")
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+@override_settings(REALTIME_COMPRESS_MIN_BYTES=64)
+class RealtimeFramingTests(SimpleTestCase):
+    class _User:
+        id = 7
+        is_anonymous = False
+
+    def test_frames_decode_to_the_same_payload(self):
+        payload = {"type": "comment_created", "html": "<p>Привет</p>" * 20}
+        frames = realtime.encode_frames(payload)
+
+        self.assertEqual(msgpack.unpackb(frames["msgpack"][1:]), payload)
+        self.assertEqual(frames["msgpack.deflate"][:1], realtime.FRAME_DEFLATE)
+        self.assertEqual(msgpack.unpackb(zlib.decompress(frames["msgpack.deflate"][1:])), payload)
+        self.assertEqual(cbor2.loads(frames["cbor"][1:]), payload)
+        self.assertEqual(realtime.frame_for({"frames": frames}, "cbor.deflate"), frames["cbor.deflate"])
+
+    @override_settings(REALTIME_BINARY_FORMATS=("msgpack",))
+    def test_only_pre_encoded_formats_are_negotiated(self):
+        self.assertEqual(realtime.negotiate_subprotocol(["m2f.cbor.deflate", "m2f.json"]), "m2f.json")
+        self.assertEqual(realtime.negotiate_subprotocol(["m2f.cbor", "m2f.msgpack.deflate"]), "m2f.msgpack.deflate")
+        self.assertIsNone(realtime.negotiate_subprotocol(["m2f.cbor"]))
+
+    async def test_binary_subprotocol_negotiated(self):
+        communicator = WebsocketCommunicator(
+            SiteRealtimeConsumer.as_asgi(), "/ws/site/", subprotocols=["m2f.msgpack", "m2f.json"]
+        )
+        communicator.scope["user"] = self._User()
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, "m2f.msgpack")
+
+        await get_channel_layer().group_send(
+            realtime.SITE_GROUP, {"type": "site_event", "frames": realtime.encode_frames({"type": "ping"})}
+        )
+        frame = await communicator.receive_from()
+        self.assertEqual(msgpack.unpackb(frame[1:]), {"type": "ping"})
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class MultiplexConsumerTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(username="alice", password="pass12345")
+        self.bob = CustomUser.objects.create_user(username="bob", password="pass12345")
+        self.dialog = Dialog.objects.create()
+        DialogParticipant.objects.create(dialog=self.dialog, user=self.alice)
+
+    async def _connect(self, user, streams, since=None):
+        path = f"/ws/stream/?streams={streams}" + (f"&since={since}" if since is not None else "")
+        communicator = WebsocketCommunicator(MultiplexConsumer.as_asgi(), path)
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def _receive_until_control(self, communicator):
+        frames = []
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame["stream"] == realtime.CONTROL_STREAM:
+                return frames, frame["data"]
+            frames.append(frame)
+
+    async def test_streams_share_one_socket(self):
+        communicator = await self._connect(self.alice, f"notifications,topic:5,dialog:{self.dialog.id}")
+        await self._receive_until_control(communicator)
+        layer = get_channel_layer()
+
+        await layer.group_send(realtime.topic_group(5), {
+            "type": "site_event", "group": realtime.topic_group(5), "frames": realtime.encode_frames({"type": "post_liked"}),
+        })
+        await layer.group_send(realtime.notifications_group(self.alice.id), {
+            "type": "notify", "group": realtime.notifications_group(self.alice.id),
+            "frames": realtime.encode_frames({"unread_notifications_count": 2}),
+        })
+
+        self.assertEqual(await communicator.receive_json_from(), {"stream": "topic:5", "data": {"type": "post_liked"}})
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"stream": "notifications", "data": {"unread_notifications_count": 2}},
+        )
+        await communicator.disconnect()
+
+    async def test_dialog_stream_requires_participation(self):
+        participant = await self._connect(self.alice, f"dialog:{self.dialog.id}")
+        outsider = await self._connect(self.bob, f"dialog:{self.dialog.id}")
+        await self._receive_until_control(participant)
+        await self._receive_until_control(outsider)
+        await outsider.send_json_to({"action": "publish", "stream": f"dialog:{self.dialog.id}", "data": {"type": "x"}})
+
+        self.assertTrue(await participant.receive_nothing())
+        await participant.send_json_to({"action": "publish", "stream": f"dialog:{self.dialog.id}", "data": {"type": "typing"}})
+        frame = await participant.receive_json_from()
+        self.assertEqual(frame["stream"], f"dialog:{self.dialog.id}")
+        self.assertEqual(frame["data"], {"type": "typing"})
+        await participant.disconnect()
+        await outsider.disconnect()
+
+    async def test_malformed_stream_names_are_rejected(self):
+        communicator = await self._connect(self.alice, "site")
+        await self._receive_until_control(communicator)
+        long_topic = "topic:" + "9" * 300
+        await communicator.send_json_to({"action": "subscribe", "streams": [long_topic, "topic:٣", "topic:7"]})
+
+        errors = [await communicator.receive_json_from() for _ in range(2)]
+        self.assertEqual([frame["data"]["error"] for frame in errors], ["invalid_stream", "invalid_stream"])
+        self.assertEqual(errors[0]["data"]["stream"], long_topic[:100])
+        await get_channel_layer().group_send(realtime.topic_group(7), {
+            "type": "site_event", "group": realtime.topic_group(7), "frames": realtime.encode_frames({"type": "x"}),
+        })
+        self.assertEqual(await communicator.receive_json_from(), {"stream": "topic:7", "data": {"type": "x"}})
+        await communicator.disconnect()
+
+    async def test_reconnect_replays_missed_events(self):
+        first = await realtime.apublish(realtime.topic_group(5), "site_event", {"type": "post_liked"})
+        await realtime.apublish(realtime.topic_group(6), "site_event", {"type": "post_liked"})
+        await realtime.apublish(realtime.topic_group(5), "site_event", {"type": "post_created"})
+
+        communicator = await self._connect(self.alice, "topic:5", since=first + 1)
+        frames, control = await self._receive_until_control(communicator)
+
+        # Seqs just below the cursor are sent again in case they arrived late.
+        self.assertEqual(
+            [(frame["seq"], frame["data"]) for frame in frames],
+            [(first, {"type": "post_liked"}), (first + 2, {"type": "post_created"})],
+        )
+        self.assertEqual(control, {"type": "hello", "seq": first + 2})
+        await communicator.disconnect()
+
+    async def test_reconnect_after_evicted_gap_requires_resync(self):
+        communicator = await self._connect(self.alice, "topic:5", since=10**9)
+        frames, control = await self._receive_until_control(communicator)
+
+        self.assertEqual(frames, [])
+        self.assertEqual(control["type"], "resync_required")
+        await communicator.disconnect()
+
+
+class BackgroundPublisherTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+        async def fake_apublish(groups, handler, payload):
+            if payload.get("block"):
+                self.started.set()
+                await asyncio.to_thread(self.release.wait, 5)
+            await asyncio.sleep(payload.get("delay", 0))
+            self.sent.append(payload)
+
+        patcher = patch.object(realtime, "apublish", fake_apublish)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _start_blocked(self, bg):
+        bg.enqueue("home", "site_event", {"block": True})
+        self.assertTrue(self.started.wait(5))
+
+    def test_batch_is_delivered_in_queue_order(self):
+        bg = BackgroundPublisher(maxsize=10, batch_size=10)
+        self._start_blocked(bg)
+        for index, delay in enumerate((0.05, 0.02, 0)):
+            bg.enqueue("home", "site_event", {"index": index, "delay": delay})
+        self.release.set()
+        self.assertTrue(bg.flush())
+
+        self.assertEqual([payload.get("index") for payload in self.sent], [None, 0, 1, 2])
+        bg.stop()
+
+    def test_snapshots_with_same_key_are_coalesced(self):
+        bg = BackgroundPublisher(maxsize=10, batch_size=10)
+        self._start_blocked(bg)
+        for count in (1, 2, 3):
+            bg.enqueue(realtime.notifications_group(1), "notify", {"count": count}, coalesce=("notify", 1))
+        self.release.set()
+        self.assertTrue(bg.flush())
+
+        self.assertEqual(self.sent, [{"block": True}, {"count": 3}])
+        stats = bg.metrics_snapshot()
+        self.assertEqual((stats["sent"], stats["coalesced"], stats["queue_depth"]), (2, 2, 0))
+        bg.stop()
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        bg = BackgroundPublisher(maxsize=1)
+        self._start_blocked(bg)
+        self.assertTrue(bg.enqueue("home", "site_event", {"n": 1}))
+        self.assertFalse(bg.enqueue("home", "site_event", {"n": 2}))
+        self.release.set()
+        self.assertTrue(bg.flush())
+
+        self.assertEqual(self.sent, [{"block": True}, {"n": 1}])
+        self.assertEqual(bg.metrics_snapshot()["dropped"], 1)
+        bg.stop()
+
+
+class EventLogTests(SimpleTestCase):
+    async def test_local_log_replays_gap_or_requires_resync(self):
+        log = LocalEventLog(size=3)
+        for i in range(5):
+            await log.append_event(["home", realtime.topic_group(i)], "site_event", {"json": str(i)})
+
+        events = await log.events_since(3, {"home"})
+        self.assertEqual([(event["seq"], event["frames"]["json"]) for event in events], [(4, "3"), (5, "4")])
+        self.assertEqual(await log.events_since(5, {"home"}), [])
+        # The overlap repeats retained seqs before the cursor but does not change the gap check.
+        overlapping = await log.events_since(4, {"home"}, overlap=10)
+        self.assertEqual([event["seq"] for event in overlapping], [3, 4, 5])
+        self.assertIsNone(await log.events_since(1, {"home"}))
+        self.assertIsNone(await log.events_since(6, {"home"}))
+
+    async def test_shared_layer_numbers_events_across_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "channels.sqlite3")
+            writer = SQLiteChannelLayer(path=path, event_log_size=2)
+            reader = SQLiteChannelLayer(path=path, event_log_size=2)
+            first = await writer.append_event(["home"], "site_event", {"json": "{}"})
+            second = await writer.append_event(["topic_1"], "site_event", {"json": "{}"})
+
+            self.assertEqual(second, first + 1)
+            self.assertEqual(await reader.last_event_seq(), second)
+            events = await reader.events_since(first, ["topic_1"])
+            self.assertEqual([(event["seq"], event["group"], event["type"]) for event in events], [(second, "topic_1", "site_event")])
+            events = await reader.events_since(second, ["home", "topic_1"], overlap=1)
+            self.assertEqual([event["seq"] for event in events], [second])
+            await writer.close()
+            await reader.close()
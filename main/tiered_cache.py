@@ -0,0 +1,423 @@
+"""Two-tier cache backend: a process-local LRU (L1) in front of a shared cache (L2).
+
+``TieredCache`` is configured as the ``default`` cache, with ``LOCATION``
+naming the shared cache alias (``shared`` in settings: a file
+directory, the database cache table or Redis). Reads try L1 first, then L2,
+and keep what L2 returned in L1 for at most ``L1_TIMEOUT`` seconds. Writes
+go to L2 and update the writer's L1 in place.
+
+Other workers learn about writes through the channel layer: every process
+runs one ``cache-invalidation`` thread that sends the changed keys, batched,
+to the ``cache_invalidation`` group and drops the keys other workers report
+from its L1. A value read from L2 while an invalidation was being applied
+is not kept, so a worker cannot re-cache what was just invalidated. If
+messages are lost (worker restart, layer outage), ``L1_TIMEOUT`` bounds how
+long an L1 entry can be stale. With the in-memory channel layer there are
+no other workers to tell and the thread is not started.
+
+Per-tier hits, misses, evictions and invalidations are reported under
+``cache`` in the runtime metrics.
+"""
+import asyncio
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.module_loading import import_string
+
+from . import metrics as runtime_metrics
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_GROUP = "cache_invalidation"
+# Keys per invalidation message and how long the sender waits to batch them.
+INVALIDATION_BATCH_SIZE = 500
+INVALIDATION_BATCH_DELAY = 0.01
+# Group memberships expire on the layer; the listener renews its own.
+REJOIN_SECONDS = 3600
+RETRY_SECONDS = 5
+STAT_NAMES = (
+    "l1_hits", "l2_hits", "misses", "sets", "deletes", "l1_evictions",
+    "invalidations_sent", "invalidations_received", "keys_invalidated",
+)
+
+_MISSING = object()
+
+
+class _LocalTier:
+    """L1 for one shared alias, common to all threads of the process."""
+
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bumped by every applied invalidation; see remember_if_current().
+        self.generation = 0
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+        return pickle.loads(entry[0])
+
+    def set(self, key, value, timeout):
+        if timeout is not None and timeout <= 0:
+            self.delete_many([key])
+            return
+        # Stored pickled, like LocMemCache, so callers cannot mutate cached values.
+        entry = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.monotonic() + timeout)
+        with self._lock:
+            self._store(key, entry)
+
+    def remember_if_current(self, key, value, timeout, generation):
+        """Keep a value read from L2 unless an invalidation arrived meanwhile."""
+        entry = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.monotonic() + timeout)
+        with self._lock:
+            if self.generation == generation:
+                self._store(key, entry)
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["l1_evictions"] += 1
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def invalidate(self, keys):
+        """Apply another worker's invalidation; ``None`` clears everything."""
+        with self._lock:
+            self.generation += 1
+            self.stats["invalidations_received"] += 1
+            if keys is None:
+                self.stats["keys_invalidated"] += len(self._entries)
+                self._entries.clear()
+                return
+            for key in keys:
+                self.stats["keys_invalidated"] += self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats, l1_entries=len(self._entries), l1_max_entries=self.max_entries)
+        reads = stats["l1_hits"] + stats["l2_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["l1_hits"] + stats["l2_hits"]) / reads, 4) if reads else 0.0
+        stats["l1_hit_ratio"] = round(stats["l1_hits"] / reads, 4) if reads else 0.0
+        return stats
+
+
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+def _local_tier(name, max_entries) -> _LocalTier:
+    with _tiers_lock:
+        if name not in _tiers:
+            _tiers[name] = _LocalTier(name, max_entries)
+        return _tiers[name]
+
+
+def cache_stats() -> dict:
+    with _tiers_lock:
+        tiers = list(_tiers.values())
+    return {tier.name: tier.snapshot() for tier in tiers}
+
+
+runtime_metrics.register("cache", cache_stats)
+
+
+class _Invalidator:
+    """Sends this process's invalidations and applies everyone else's."""
+
+    def __init__(self, layer_alias):
+        self.layer_alias = layer_alias
+        self.origin = uuid.uuid4().hex
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._loop = None
+        self._wake = None
+        self._task = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation", daemon=True)
+        self._thread.start()
+        self._started.wait(timeout=1)
+
+    def publish(self, tier, keys):
+        """Queue ``keys`` of ``tier`` (``None``: all of them) for the other workers."""
+        with self._lock:
+            if keys is None:
+                self._pending[tier] = None
+            elif self._pending.get(tier, ()) is not None:
+                self._pending.setdefault(tier, set()).update(keys)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _take_pending(self) -> dict:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def stop(self, timeout=5):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            asyncio.run(self._main())
+        except asyncio.CancelledError:
+            pass
+
+    async def _main(self):
+        self._task = asyncio.current_task()
+        self._wake = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._started.set()
+        while True:
+            layer = None
+            try:
+                layer = _private_layer(self.layer_alias)
+                channel = await layer.new_channel("cache")
+                await asyncio.gather(
+                    self._send_loop(layer),
+                    self._receive_loop(layer, channel),
+                    self._join_loop(layer, channel),
+                )
+            except Exception:
+                logger.exception("Cache invalidation listener failed; retrying in %s s", RETRY_SECONDS)
+            finally:
+                if layer is not None:
+                    await layer.close()
+            await asyncio.sleep(RETRY_SECONDS)
+
+    async def _join_loop(self, layer, channel):
+        while True:
+            await layer.group_add(INVALIDATION_GROUP, channel)
+            await asyncio.sleep(REJOIN_SECONDS)
+
+    async def _send_loop(self, layer):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            await asyncio.sleep(INVALIDATION_BATCH_DELAY)
+            for tier, keys in self._take_pending().items():
+                if keys is None:
+                    batches = [None]
+                else:
+                    keys = sorted(keys)
+                    batches = [keys[i:i + INVALIDATION_BATCH_SIZE] for i in range(0, len(keys), INVALIDATION_BATCH_SIZE)]
+                for batch in batches:
+                    await layer.group_send(INVALIDATION_GROUP, {
+                        "type": "cache.invalidate",
+                        "origin": self.origin,
+                        "tier": tier,
+                        "keys": batch,
+                    })
+                    _tiers[tier].incr("invalidations_sent")
+
+    async def _receive_loop(self, layer, channel):
+        while True:
+            message = await layer.receive(channel)
+            if message.get("type") != "cache.invalidate" or message.get("origin") == self.origin:
+                continue
+            tier = _tiers.get(message.get("tier"))
+            if tier is not None:
+                tier.invalidate(message.get("keys"))
+
+
+def _private_layer(alias):
+    """A channel layer instance owned by the listener thread and its event loop."""
+    config = channel_layers.configs[alias]
+    layer_class = import_string(config["BACKEND"])
+    options = dict(config.get("CONFIG", {}))
+    from .channel_layers import _SharedChannelLayer
+
+    if issubclass(layer_class, _SharedChannelLayer):
+        # A copy of the default alias's config: keep the "channel_layer"
+        # metrics pointing at the process's main layer.
+        options["metrics_name"] = None
+    return layer_class(**options)
+
+
+_invalidators = {}
+_invalidators_lock = threading.Lock()
+
+
+def _invalidator(layer_alias):
+    """The process's invalidator, or None when other workers cannot be reached."""
+    invalidator = _invalidators.get(layer_alias)
+    if invalidator is not None and invalidator.pid == os.getpid():
+        return invalidator
+    with _invalidators_lock:
+        invalidator = _invalidators.get(layer_alias)
+        # Forked workers start their own thread.
+        if invalidator is None or invalidator.pid != os.getpid():
+            config = channel_layers.configs.get(layer_alias)
+            if not config or issubclass(import_string(config["BACKEND"]), InMemoryChannelLayer):
+                return None
+            invalidator = _invalidators[layer_alias] = _Invalidator(layer_alias)
+        return invalidator
+
+
+class TieredCache(BaseCache):
+    """``LOCATION``: alias of the shared cache. ``OPTIONS``: ``L1_MAX_ENTRIES``,
+    ``L1_TIMEOUT`` (seconds) and ``CHANNEL_LAYER`` (``None`` disables
+    cross-worker invalidation)."""
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.shared_alias = location or "shared"
+        self.l1_timeout = options.get("L1_TIMEOUT", 30)
+        self.layer_alias = options.get("CHANNEL_LAYER", "default")
+        self.tier = _local_tier(self.shared_alias, options.get("L1_MAX_ENTRIES", 1000))
+
+    @property
+    def shared(self) -> BaseCache:
+        return caches[self.shared_alias]
+
+    def _l1_timeout(self, timeout):
+        timeout = self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+        return self.l1_timeout if timeout is None else min(timeout, self.l1_timeout)
+
+    def _publish(self, keys):
+        if self.layer_alias is None:
+            return
+        invalidator = _invalidator(self.layer_alias)
+        if invalidator is not None:
+            invalidator.publish(self.shared_alias, keys)
+
+    def _remember(self, key, value, generation):
+        # Start listening before anything is cached.
+        if self.layer_alias is not None:
+            _invalidator(self.layer_alias)
+        self.tier.remember_if_current(key, value, self.l1_timeout, generation)
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        value = self.tier.get(local_key)
+        if value is not _MISSING:
+            self.tier.incr("l1_hits")
+            return value
+        generation = self.tier.generation
+        value = self.shared.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self.tier.incr("misses")
+            return default
+        self.tier.incr("l2_hits")
+        self._remember(local_key, value, generation)
+        return value
+
+    def get_many(self, keys, version=None):
+        found, missing = {}, []
+        for key in keys:
+            value = self.tier.get(self.make_and_validate_key(key, version))
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        self.tier.incr("l1_hits", len(found))
+        if missing:
+            generation = self.tier.generation
+            shared = self.shared.get_many(missing, version=version)
+            self.tier.incr("l2_hits", len(shared))
+            self.tier.incr("misses", len(missing) - len(shared))
+            for key, value in shared.items():
+                self._remember(self.make_and_validate_key(key, version), value, generation)
+            found.update(shared)
+        return found
+
+    def has_key(self, key, version=None):
+        if self.tier.get(self.make_and_validate_key(key, version)) is not _MISSING:
+            return True
+        return self.shared.has_key(key, version=version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        self.shared.set(key, value, timeout, version=version)
+        self.tier.set(local_key, value, self._l1_timeout(timeout))
+        self.tier.incr("sets")
+        self._publish([local_key])
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        if not self.shared.add(key, value, timeout, version=version):
+            return False
+        self.tier.set(local_key, value, self._l1_timeout(timeout))
+        self.tier.incr("sets")
+        self._publish([local_key])
+        return True
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout, version=version)
+        local_keys = []
+        for key, value in data.items():
+            local_key = self.make_and_validate_key(key, version)
+            local_keys.append(local_key)
+            if key in failed:
+                self.tier.delete_many([local_key])
+            else:
+                self.tier.set(local_key, value, self._l1_timeout(timeout))
+        self.tier.incr("sets", len(data) - len(failed))
+        self._publish(local_keys)
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        # The new expiry is only known to L2; drop the local copy.
+        self.tier.delete_many([self.make_and_validate_key(key, version)])
+        return self.shared.touch(key, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        value = self.shared.incr(key, delta, version=version)
+        self.tier.delete_many([local_key])
+        self._publish([local_key])
+        return value
+
+    def delete(self, key, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        deleted = self.shared.delete(key, version=version)
+        self.tier.delete_many([local_key])
+        self.tier.incr("deletes")
+        self._publish([local_key])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        local_keys = [self.make_and_validate_key(key, version) for key in keys]
+        self.shared.delete_many(keys, version=version)
+        self.tier.delete_many(local_keys)
+        self.tier.incr("deletes", len(keys))
+        self._publish(local_keys)
+
+    def clear(self):
+        self.shared.clear()
+        self.tier.clear()
+        self._publish(None)
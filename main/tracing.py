@@ -0,0 +1,358 @@
+"""Request tracing with nested spans (``TRACING=1``).
+
+``TracingMiddleware`` opens a server span per sampled request (continuing
+an incoming W3C ``traceparent``) and answers with ``X-Trace-Id``. Within
+it, spans are recorded for every SQL query, cache call, template render,
+``@traced`` helper and realtime publish; each ``group_send`` gets its own
+span. Events published during a traced request carry ``trace_id`` in
+their payload, so a WebSocket frame can be matched to the request that
+caused it. The background publisher re-activates the request's context
+when it delivers, and those spans are exported as a separate batch of the
+same trace.
+
+Finished spans are appended to ``TRACING_FILE`` as OTLP/JSON lines (one
+``ExportTraceServiceRequest`` per request or publish), which the
+OpenTelemetry collector's ``otlpjsonfile`` receiver and most trace
+viewers read. The file is rotated to ``.1`` at ``TRACING_FILE_MAX_BYTES``.
+Outside a traced request all hooks cost one context variable lookup.
+"""
+import functools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+
+from .observability import RequestHookMiddleware, observe_queries
+
+SERVICE_NAME = "mafia2forum"
+SQL_MAX_LENGTH = 2000
+CACHE_METHODS = ("get", "get_many", "set", "set_many", "add", "delete", "delete_many", "incr", "touch")
+
+# OTLP SpanKind and StatusCode values.
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT, KIND_PRODUCER = 1, 2, 3, 4
+STATUS_ERROR = 2
+
+# The active Span, or a SpanContext from another thread/process to continue.
+_current = ContextVar("tracing_span", default=None)
+
+
+class SpanContext:
+    __slots__ = ("trace_id", "span_id")
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+def parse_traceparent(value):
+    """SpanContext from a sampled W3C ``traceparent`` header, else None."""
+    parts = (value or "").strip().lower().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        trace_id, span_id, flags = (int(part, 16) for part in parts[1:])
+    except ValueError:
+        return None
+    if not trace_id or not span_id or not flags & 1:
+        return None
+    return SpanContext(parts[1], parts[2])
+
+
+class Span:
+    __slots__ = ("name", "context", "parent_id", "kind", "attributes", "start_ns", "end_ns", "status", "_batch")
+
+    def __init__(self, name, context, parent_id, kind, attributes, batch):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = None
+        self._batch = batch
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, exc):
+        self.status = {"code": STATUS_ERROR, "message": f"{type(exc).__name__}: {exc}"[:500]}
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self._batch.finished(self)
+
+
+class _Batch:
+    """Spans of one local root; exported together when the root ends."""
+
+    def __init__(self):
+        self.root = None
+        self.spans = []
+
+    def finished(self, span):
+        self.spans.append(span)
+        if span is self.root:
+            export(self.spans)
+
+
+def _new_id(nbytes) -> str:
+    return random.getrandbits(nbytes * 8).to_bytes(nbytes, "big").hex()
+
+
+def current_context():
+    """SpanContext of the active span (for propagation), or None outside a trace."""
+    current = _current.get()
+    return current.context if isinstance(current, Span) else current
+
+
+def _child(current, name, kind, attributes) -> Span:
+    if isinstance(current, Span):
+        batch, trace_id, parent_id = current._batch, current.context.trace_id, current.context.span_id
+    else:
+        batch, trace_id, parent_id = _Batch(), current.trace_id, current.span_id
+    new = Span(name, SpanContext(trace_id, _new_id(8)), parent_id, kind, dict(attributes or {}), batch)
+    if batch.root is None:
+        batch.root = new
+    return new
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, attributes=None, parent=None):
+    """Record a child of the active span; does nothing outside a trace.
+
+    ``parent`` (a SpanContext) starts a new local batch under a remote parent.
+    """
+    current = parent or _current.get()
+    if current is None:
+        yield None
+        return
+    new = _child(current, name, kind, attributes)
+    token = _current.set(new)
+    try:
+        yield new
+    except BaseException as exc:
+        new.record_error(exc)
+        raise
+    finally:
+        _current.reset(token)
+        new.end()
+
+
+@contextmanager
+def continued(context):
+    """Make ``context`` the parent of spans started inside (e.g. in another thread)."""
+    if context is None:
+        yield
+        return
+    token = _current.set(context)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def traced(name=None):
+    """Decorator: run the function inside a span named after it."""
+
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_trace(name, kind=KIND_SERVER, attributes=None, parent=None):
+    """Span context manager for a new trace root (or a continuation of ``parent``)."""
+    return span(name, kind, attributes, parent or SpanContext(_new_id(16), None))
+
+
+# Export
+
+def _attribute(key, value) -> dict:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    elif isinstance(value, (list, tuple)):
+        typed = {"arrayValue": {"values": [{"stringValue": str(item)} for item in value]}}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def otlp_payload(spans) -> dict:
+    """OTLP/JSON ``ExportTraceServiceRequest`` for ``spans``."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            _attribute("service.name", SERVICE_NAME),
+            _attribute("process.pid", os.getpid()),
+        ]},
+        "scopeSpans": [{
+            "scope": {"name": __name__},
+            "spans": [{
+                "traceId": s.context.trace_id,
+                "spanId": s.context.span_id,
+                "parentSpanId": s.parent_id or "",
+                "name": s.name,
+                "kind": s.kind,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": [_attribute(key, value) for key, value in s.attributes.items()],
+                **({"status": s.status} if s.status else {}),
+            } for s in spans],
+        }],
+    }]}
+
+
+_export_lock = threading.Lock()
+
+
+def export(spans):
+    path = str(getattr(settings, "TRACING_FILE", os.path.join(settings.BASE_DIR, "traces", "spans.jsonl")))
+    max_bytes = getattr(settings, "TRACING_FILE_MAX_BYTES", 50 * 1024 * 1024)
+    line = json.dumps(otlp_payload(spans), separators=(",", ":")) + "\n"
+    with _export_lock:
+        try:
+            if os.path.getsize(path) + len(line) > max_bytes:
+                os.replace(path, path + ".1")
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+# Hooks
+
+def _trace_query(sql, many, context, duration_ms, error):
+    current = _current.get()
+    if current is None:
+        return
+    connection = context["connection"]
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "SQL"
+    # Recorded after the fact from the shared wrapper's timing.
+    query = _child(current, f"SQL {operation}", KIND_CLIENT, {
+        "db.system": connection.vendor,
+        "db.name": connection.alias,
+        "db.statement": sql[:SQL_MAX_LENGTH],
+        "db.executemany": many,
+    })
+    query.start_ns -= int(duration_ms * 1_000_000)
+    if error is not None:
+        query.record_error(error)
+    query.end()
+
+
+def _wrap_cache_method(cls, name):
+    original = getattr(cls, name)
+
+    @functools.wraps(original)
+    def method(self, *args, **kwargs):
+        current = _current.get()
+        # BaseCache.get_many() calls get(); only the outer call is a span.
+        if current is None or (isinstance(current, Span) and current.name.startswith("cache ")):
+            return original(self, *args, **kwargs)
+        with span(f"cache {name}", KIND_CLIENT, {"cache.backend": type(self).__name__}):
+            return original(self, *args, **kwargs)
+
+    setattr(cls, name, method)
+
+
+def _wrap_template_render():
+    from django.template.base import Template
+
+    original = Template.render
+
+    @functools.wraps(original)
+    def render(self, context):
+        if _current.get() is None:
+            return original(self, context)
+        with span(f"render {self.name or 'template'}", attributes={"template.name": self.name or ""}):
+            return original(self, context)
+
+    Template.render = render
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def install():
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        observe_queries(_trace_query)
+        for cls in {type(caches[alias]) for alias in settings.CACHES}:
+            for name in CACHE_METHODS:
+                _wrap_cache_method(cls, name)
+        _wrap_template_render()
+        _installed = True
+
+
+class TracingMiddleware(RequestHookMiddleware):
+    def install(self):
+        install()
+
+    def around(self, request):
+        parent = self._parent(request)
+        if parent is False:
+            return
+        with self._root(request, parent) as root:
+            response = yield
+            self._finish(request, response, root)
+        return response
+
+    def _parent(self, request):
+        """Incoming context, None for a new trace, or False when not sampled."""
+        parent = parse_traceparent(request.headers.get("traceparent"))
+        if parent is None and random.random() >= getattr(settings, "TRACING_SAMPLE_RATE", 1.0):
+            return False
+        return parent
+
+    def _root(self, request, parent):
+        return start_trace(f"{request.method} {request.path}", KIND_SERVER, {
+            "http.request.method": request.method,
+            "url.path": request.path,
+        }, parent)
+
+    def _finish(self, request, response, root):
+        match = getattr(request, "resolver_match", None)
+        if match:
+            root.name = f"{request.method} {match.view_name or match.route}"
+            root.set_attribute("http.route", match.route)
+        root.set_attribute("http.response.status_code", response.status_code)
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            root.set_attribute("enduser.id", str(user.pk))
+        if response.status_code >= 500:
+            root.status = {"code": STATUS_ERROR, "message": str(response.status_code)}
+        response["X-Trace-Id"] = root.context.trace_id
@@ -0,0 +1,232 @@
+"""Resumable chunked uploads for dialog attachments and task proofs.
+
+A client opens a session (``create_session``), sends the file in chunks at
+the offset the server reports (``write_chunk``), optionally with the
+chunk's sha256, and finishes it (``complete``). A chunk is spooled to a
+temporary file under ``MEDIA_ROOT/uploads/parts`` as it is read from the
+request, so a worker never holds more than one read buffer, and only then
+appended to the session's part file under a short row lock; a slow client
+never holds the database write lock. A dropped connection only costs the
+current chunk: the client asks for the session, gets ``received`` back and
+continues from there.
+
+The finished file is moved into storage as is (a content-addressed blob)
+and later attached to a ``Message`` or ``FamilyTask`` by its session id
+(``claim``) instead of being posted again.
+"""
+import glob
+import hashlib
+import os
+import posixpath
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, UnidentifiedImageError
+
+from .models import FamilyTask, Message, UploadSession
+from .sqlite import retry_on_busy
+from .storage import is_content_addressed
+
+PARTS_DIR = os.path.join("uploads", "parts")
+_READ_CHUNK = 64 * 1024
+_COPY_CHUNK = 1024 * 1024
+
+# Session target -> (model, field) the finished file is attached to.
+TARGET_FIELDS = {
+    UploadSession.TARGET_MESSAGE_IMAGE: (Message, "image"),
+    UploadSession.TARGET_MESSAGE_ATTACHMENT: (Message, "attachment"),
+    UploadSession.TARGET_TASK_PROOF: (FamilyTask, "completion_proof"),
+}
+IMAGE_TARGETS = {UploadSession.TARGET_MESSAGE_IMAGE, UploadSession.TARGET_TASK_PROOF}
+
+
+class UploadError(Exception):
+    def __init__(self, code, status=400, **extra):
+        super().__init__(code)
+        self.code = code
+        self.status = status
+        self.extra = extra
+
+
+def chunk_size() -> int:
+    return getattr(settings, "UPLOAD_CHUNK_SIZE", 4 * 1024 * 1024)
+
+
+def max_size() -> int:
+    return getattr(settings, "UPLOAD_MAX_SIZE", 200 * 1024 * 1024)
+
+
+def parts_dir() -> str:
+    directory = os.path.join(settings.MEDIA_ROOT, PARTS_DIR)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def part_path(session) -> str:
+    return os.path.join(parts_dir(), f"{session.id}.part")
+
+
+def discard_parts(upload_id):
+    """Remove the part file and any chunk spools of a session."""
+    for path in glob.glob(os.path.join(settings.MEDIA_ROOT, PARTS_DIR, f"{upload_id}.*")):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def describe(session) -> dict:
+    data = {
+        "id": str(session.id),
+        "target": session.target,
+        "filename": session.filename,
+        "size": session.size,
+        "received": session.received,
+        "status": session.status,
+        "chunk_size": chunk_size(),
+    }
+    if session.status == UploadSession.STATUS_COMPLETE:
+        data["url"] = default_storage.url(session.name)
+    return data
+
+
+def create_session(user, target, filename, size, sha256="") -> UploadSession:
+    if target not in TARGET_FIELDS:
+        raise UploadError("bad_target")
+    filename = posixpath.basename(str(filename or "").replace("\\", "/")).strip()[:255]
+    if not filename:
+        raise UploadError("bad_filename")
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("bad_size")
+    if size <= 0:
+        raise UploadError("bad_size")
+    if size > max_size():
+        raise UploadError("too_large", status=413, max_size=max_size())
+    return UploadSession.objects.create(
+        user=user, target=target, filename=filename, size=size, sha256=str(sha256 or "").lower()[:64],
+    )
+
+
+def _locked_session(upload_id, user):
+    try:
+        return UploadSession.objects.select_for_update().get(id=upload_id, user=user)
+    except (UploadSession.DoesNotExist, ValueError):
+        raise UploadError("not_found", status=404)
+
+
+def _check_chunk(session, offset, length):
+    if session.status != UploadSession.STATUS_OPEN:
+        raise UploadError("already_complete", status=409)
+    if offset != session.received:
+        # Lost response or a concurrent retry: the client resumes from here.
+        raise UploadError("offset_mismatch", status=409, received=session.received)
+    if length <= 0 or offset + length > session.size:
+        raise UploadError("bad_chunk")
+    if length > chunk_size():
+        raise UploadError("chunk_too_large", status=413, chunk_size=chunk_size())
+
+
+def write_chunk(upload_id, user, offset, stream, length, checksum=None) -> UploadSession:
+    """Append ``length`` bytes read from ``stream`` at ``offset``."""
+    try:
+        session = UploadSession.objects.get(id=upload_id, user=user)
+    except (UploadSession.DoesNotExist, ValueError):
+        raise UploadError("not_found", status=404)
+    _check_chunk(session, offset, length)
+
+    sha = hashlib.sha256()
+    written = 0
+    with tempfile.NamedTemporaryFile(dir=parts_dir(), prefix=f"{session.id}.", suffix=".chunk") as spool:
+        while written < length:
+            data = stream.read(min(_READ_CHUNK, length - written))
+            if not data:
+                break
+            sha.update(data)
+            spool.write(data)
+            written += len(data)
+        if written != length:
+            raise UploadError("incomplete_chunk", received=offset)
+        if checksum and sha.hexdigest() != checksum.strip().lower():
+            raise UploadError("checksum_mismatch", status=422, received=offset)
+        spool.flush()
+        return _append_chunk(upload_id, user, offset, length, spool)
+
+
+@retry_on_busy
+def _append_chunk(upload_id, user, offset, length, spool) -> UploadSession:
+    with transaction.atomic():
+        session = _locked_session(upload_id, user)
+        # Another request may have written this offset while we were reading.
+        _check_chunk(session, offset, length)
+        spool.seek(0)
+        with open(part_path(session), "a+b") as part:
+            # Drop whatever a failed earlier attempt left past the offset.
+            part.truncate(offset)
+            part.seek(offset)
+            shutil.copyfileobj(spool, part, _COPY_CHUNK)
+        session.received = offset + length
+        session.save(update_fields=["received", "updated_at"])
+    return session
+
+
+def _verify_image(path):
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise UploadError("not_an_image")
+
+
+@retry_on_busy
+def complete(upload_id, user) -> UploadSession:
+    """Move the assembled file into storage; repeating it is harmless."""
+    with transaction.atomic():
+        session = _locked_session(upload_id, user)
+        if session.status == UploadSession.STATUS_COMPLETE:
+            return session
+        if session.received != session.size:
+            raise UploadError("incomplete", status=409, received=session.received)
+        path = part_path(session)
+        if session.target in IMAGE_TARGETS:
+            _verify_image(path)
+
+        model, field_name = TARGET_FIELDS[session.target]
+        name = model._meta.get_field(field_name).generate_filename(None, session.filename)
+        if hasattr(default_storage, "adopt"):
+            name = default_storage.adopt(path, name)
+        else:
+            with open(path, "rb") as f:
+                name = default_storage.save(name, File(f))
+            os.unlink(path)
+
+        digest = posixpath.splitext(posixpath.basename(name))[0] if is_content_addressed(name) else None
+        if session.sha256 and digest and digest != session.sha256:
+            # Start over; the blob may be shared, so it is left to the garbage collector.
+            session.received = 0
+            session.save(update_fields=["received", "updated_at"])
+        else:
+            session.status = UploadSession.STATUS_COMPLETE
+            session.name = name
+            session.save(update_fields=["status", "name", "updated_at"])
+    if session.status != UploadSession.STATUS_COMPLETE:
+        raise UploadError("checksum_mismatch", status=422, received=0)
+    return session
+
+
+@retry_on_busy
+def claim(upload_id, user, target) -> str:
+    """Consume a finished upload and return its storage name for ``target``."""
+    with transaction.atomic():
+        session = _locked_session(upload_id, user)
+        if session.target != target or session.status != UploadSession.STATUS_COMPLETE:
+            raise UploadError("not_ready", status=409)
+        name = session.name
+        session.delete()
+    return name
+
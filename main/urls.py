@@ -1,8 +1,6 @@
-from django.conf import settings
-from django.conf.urls.static import static
 from django.urls import path
 
-from . import views
+from . import media, views
 
 urlpatterns = [
     path("", views.home, name="home"),
@@ -19,6 +17,8 @@ urlpatterns = [
     path("notifications/mark-read/", views.notifications_mark_read, name="notifications-mark-read"),
     path("dialogs/", views.dialogs_list, name="dialogs"),
     path("online-users/", views.online_users_json, name="online-users"),
+    path("internal/metrics/", views.runtime_metrics_json, name="runtime-metrics"),
+    path("internal/metrics/prometheus/", views.runtime_metrics_prometheus, name="runtime-metrics-prometheus"),
     path("family/operations/create/", views.create_family_operation, name="create-family-operation"),
     path("family/dossiers/create/", views.create_faction_dossier, name="create-faction-dossier"),
     path("family/tasks/create/", views.create_family_task, name="create-family-task"),
@@ -27,6 +27,15 @@ urlpatterns = [
     path("dialogs/start/<str:username>/", views.start_dialog, name="dialog-start"),
     path("dialogs/<int:dialog_id>/", views.dialog_detail, name="dialog-detail"),
     path("dialogs/<int:dialog_id>/typing/", views.dialog_typing, name="dialog-typing"),
+    path(
+        "dialogs/<int:dialog_id>/messages/<int:message_id>/attachment/",
+        media.serve_attachment,
+        name="message-attachment",
+    ),
+    path("uploads/", views.upload_create, name="upload-create"),
+    path("uploads/<uuid:upload_id>/", views.upload_detail, name="upload-detail"),
+    path("uploads/<uuid:upload_id>/chunk/", views.upload_chunk, name="upload-chunk"),
+    path("uploads/<uuid:upload_id>/complete/", views.upload_complete, name="upload-complete"),
     path("topic/<int:topic_id>/", views.topic_detail, name="topic-detail"),
     path("topic/create/", views.create_topic_simple, name="create_topic_simple"),
     path("topic/<int:pk>/delete/", views.topic_delete, name="topic-delete"),
@@ -40,6 +49,3 @@ urlpatterns = [
     path("toggle_comment_like/<int:comment_id>/", views.toggle_comment_like, name="toggle-comment-like"),
     path("comment/<int:comment_id>/delete/", views.delete_comment, name="comment-delete"),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,14 +1,17 @@
+import hmac
+import json
 import re
 
-from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model, login, logout, update_session_auth_hash
 from django.contrib.auth.decorators import login_required
 from django.db import OperationalError, ProgrammingError, connection
 from django.core.paginator import Paginator
-from django.db.models import Count, Q
-from django.http import HttpResponseForbidden, JsonResponse
+from django.db.models import Count, Exists, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -45,17 +48,37 @@ from .models import (
     Topic,
     TopicSubscription,
     Tag,
+    UploadSession,
+    UserStats,
 )
-from .online_presence import get_online_usernames
+from . import metrics as runtime_metrics
+from . import prometheus, publisher, realtime, tracing, uploads
+from .online_presence import aget_online_usernames
 
 User = get_user_model()
 MENTION_RE = re.compile(r"(?<!\w)@([A-Za-z0-9_]{3,150})")
 
+# Recipients per notification batch, reported as "notification_fanout".
+notification_fanout = {
+    "subscribers": runtime_metrics.Histogram(runtime_metrics.FANOUT_BUCKETS),
+    "mentions": runtime_metrics.Histogram(runtime_metrics.FANOUT_BUCKETS),
+}
+runtime_metrics.register(
+    "notification_fanout", lambda: {kind: histogram.snapshot() for kind, histogram in notification_fanout.items()}
+)
+
+
 
 
+# Positive schema checks are remembered for the life of the process: a
+# migrated database stays migrated, and introspection costs a dozen queries.
+_schema_ready_cache = set()
+
 
 def _forum_schema_ready() -> bool:
     """Return True when DB has new forum columns/tables used by current code."""
+    if "forum" in _schema_ready_cache:
+        return True
     try:
         with connection.cursor() as cursor:
             topic_columns = {c.name for c in connection.introspection.get_table_description(cursor, Topic._meta.db_table)}
@@ -66,66 +89,97 @@ def _forum_schema_ready() -> bool:
             tables = set(connection.introspection.table_names(cursor))
             tag_table = Tag._meta.db_table
             topic_tags_table = Topic.tags.through._meta.db_table
-            return tag_table in tables and topic_tags_table in tables
+            ready = tag_table in tables and topic_tags_table in tables
     except Exception:
         return False
+    if ready:
+        _schema_ready_cache.add("forum")
+    return ready
 
 
 
 def _family_task_proof_ready() -> bool:
+    if "family_task_proof" in _schema_ready_cache:
+        return True
     try:
         with connection.cursor() as cursor:
             task_columns = {c.name for c in connection.introspection.get_table_description(cursor, FamilyTask._meta.db_table)}
-            return {"completion_proof", "completed_at"}.issubset(task_columns)
+            ready = {"completion_proof", "completed_at"}.issubset(task_columns)
     except Exception:
         return False
+    if ready:
+        _schema_ready_cache.add("family_task_proof")
+    return ready
 
+@tracing.traced()
 def _log_activity(actor, verb, topic=None, post=None, comment=None):
     Activity.objects.create(actor=actor, verb=verb, topic=topic, post=post, comment=comment)
 
 
-def _broadcast_site_event(event_type: str, payload: dict):
-    channel_layer = get_channel_layer()
-    if not channel_layer:
-        return
-    async_to_sync(channel_layer.group_send)(
-        "site_global",
-        {
-            "type": "site_event",
-            "payload": {
-                "type": event_type,
-                **payload,
-            },
-        },
-    )
+@tracing.traced()
+def _broadcast_site_event(event_type: str, payload: dict, groups):
+    publisher.enqueue(groups, "site_event", {"type": event_type, **payload})
 
 
-def _push_header_counters(user):
-    channel_layer = get_channel_layer()
-    if not channel_layer:
-        return
-    unread_notifications_count = user.notifications.filter(is_read=False).count()
-    unread_messages_count = Message.objects.filter(dialog__dialog_participants__user=user).exclude(author=user).exclude(read_by__user=user).count()
-    async_to_sync(channel_layer.group_send)(
-        f"notifications_{user.id}",
-        {
-            "type": "notify",
-            "payload": {
+@tracing.traced()
+def _push_header_counters(*users):
+    """Publish unread counters to each user's header, in one query for all of them."""
+    unread_notifications = (
+        Notification.objects.filter(recipient=OuterRef("pk"), is_read=False)
+        .order_by().values("recipient").annotate(total=Count("pk")).values("total")
+    )
+    unread_messages = (
+        Message.objects.filter(dialog__dialog_participants__user=OuterRef("pk"))
+        .exclude(author=OuterRef("pk"))
+        .filter(~Exists(MessageRead.objects.filter(message=OuterRef("pk"), user=OuterRef(OuterRef("pk")))))
+        .order_by().values("dialog__dialog_participants__user").annotate(total=Count("pk")).values("total")
+    )
+    counters = User.objects.filter(id__in={user.id for user in users}).annotate(
+        unread_notifications_count=Coalesce(Subquery(unread_notifications), 0),
+        unread_messages_count=Coalesce(Subquery(unread_messages), 0),
+    ).values_list("id", "unread_notifications_count", "unread_messages_count")
+    for user_id, unread_notifications_count, unread_messages_count in counters:
+        publisher.enqueue(
+            realtime.notifications_group(user_id),
+            "notify",
+            {
                 "unread_notifications_count": unread_notifications_count,
                 "unread_messages_count": unread_messages_count,
             },
+            coalesce=("notify", user_id),
+        )
+
+
+async def _apush_header_counters(user_id):
+    unread_notifications_count = await Notification.objects.filter(recipient_id=user_id, is_read=False).acount()
+    unread_messages_count = await Message.objects.filter(dialog__dialog_participants__user_id=user_id).exclude(author_id=user_id).exclude(read_by__user_id=user_id).acount()
+    await publisher.aenqueue(
+        realtime.notifications_group(user_id),
+        "notify",
+        {
+            "unread_notifications_count": unread_notifications_count,
+            "unread_messages_count": unread_messages_count,
         },
+        coalesce=("notify", user_id),
     )
 
 
+async def _aget_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f"No {queryset.model._meta.object_name} matches the given query.")
+
+
+@tracing.traced()
 def _create_mention_notifications(comment: Comment):
     usernames = set(MENTION_RE.findall(comment.content or ""))
     if not usernames:
         return
 
-    mentioned_users = User.objects.filter(username__in=usernames).exclude(id=comment.author_id)
-    for mentioned_user in mentioned_users:
-        Notification.objects.create(
+    mentioned_users = list(User.objects.filter(username__in=usernames).exclude(id=comment.author_id))
+    Notification.objects.bulk_create([
+        Notification(
             recipient=mentioned_user,
             actor=comment.author,
             topic=comment.topic,
@@ -134,14 +188,19 @@ def _create_mention_notifications(comment: Comment):
             notification_type=Notification.TYPE_MENTION,
             message=f"{comment.author.username} упомянул(а) вас в комментарии.",
         )
-        _push_header_counters(mentioned_user)
+        for mentioned_user in mentioned_users
+    ])
+    notification_fanout["mentions"].observe(len(mentioned_users))
+    if mentioned_users:
+        _push_header_counters(*mentioned_users)
 
 
+@tracing.traced()
 def _notify_topic_subscribers(topic: Topic, actor: User, message: str, post: Post | None = None, comment: Comment | None = None, notification_type: str = Notification.TYPE_TOPIC):
-    subscriptions = TopicSubscription.objects.select_related("user").filter(topic=topic).exclude(user=actor)
-    for subscription in subscriptions:
-        Notification.objects.create(
-            recipient=subscription.user,
+    subscribers = [subscription.user for subscription in TopicSubscription.objects.select_related("user").filter(topic=topic).exclude(user=actor)]
+    Notification.objects.bulk_create([
+        Notification(
+            recipient=subscriber,
             actor=actor,
             topic=topic,
             post=post,
@@ -149,22 +208,26 @@ def _notify_topic_subscribers(topic: Topic, actor: User, message: str, post: Pos
             notification_type=notification_type,
             message=message,
         )
-        _push_header_counters(subscription.user)
+        for subscriber in subscribers
+    ])
+    notification_fanout["subscribers"].observe(len(subscribers))
+    if subscribers:
+        _push_header_counters(*subscribers)
 
 
-def _create_like_notification(*, actor: User, recipient: User, message: str, topic: Topic | None = None, post: Post | None = None, comment: Comment | None = None):
-    if actor == recipient:
+async def _acreate_like_notification(*, actor: User, recipient_id: int, message: str, topic_id=None, post_id=None, comment_id=None):
+    if actor.id == recipient_id:
         return
-    Notification.objects.create(
-        recipient=recipient,
+    await Notification.objects.acreate(
+        recipient_id=recipient_id,
         actor=actor,
-        topic=topic,
-        post=post,
-        comment=comment,
+        topic_id=topic_id,
+        post_id=post_id,
+        comment_id=comment_id,
         notification_type=Notification.TYPE_LIKE,
         message=message,
     )
-    _push_header_counters(recipient)
+    await _apush_header_counters(recipient_id)
 
 
 def _create_task_notification(*, actor: User, recipient: User, message: str):
@@ -191,13 +254,10 @@ def _build_profile_context(user_obj: User, is_own_profile: bool):
     except (OperationalError, ProgrammingError):
         received_tasks = []
         active_tasks = []
-    stats = {
-        "topics_count": user_obj.topics.count(),
-        "posts_count": user_obj.posts.count(),
-        "comments_count": user_obj.comments.count(),
-        "received_topic_likes": sum(topic.likes.count() for topic in user_obj.topics.all()),
-        "received_post_likes": sum(post.likes.count() for post in user_obj.posts.all()),
-    }
+    try:
+        stats = UserStats.for_user(user_obj)
+    except (OperationalError, ProgrammingError):
+        stats = None
     online_threshold = timezone.now() - timezone.timedelta(minutes=5)
     is_online = bool(user_obj.last_login and user_obj.last_login >= online_threshold)
     return {
@@ -214,9 +274,23 @@ def _build_profile_context(user_obj: User, is_own_profile: bool):
 
 def home(request):
     schema_ready = _forum_schema_ready()
-    topics_qs = Topic.objects.select_related("author", "category")
+    # Correlated counts: joining likes and comments in one GROUP BY would
+    # multiply their rows before counting, for the page and the paginator.
+    likes_total = (
+        Topic.likes.through.objects.filter(topic=OuterRef("pk"))
+        .order_by().values("topic").annotate(total=Count("pk")).values("total")
+    )
+    comments_total = (
+        Comment.objects.filter(topic=OuterRef("pk"))
+        .order_by().values("topic").annotate(total=Count("pk")).values("total")
+    )
+    topics_qs = Topic.objects.select_related("author__profile", "category").annotate(
+        likes_total=Coalesce(Subquery(likes_total), 0),
+        comments_total=Coalesce(Subquery(comments_total), 0),
+        last_post_id=Subquery(Post.objects.filter(topic=OuterRef("pk")).order_by("-created_at").values("id")[:1]),
+    )
     if schema_ready:
-        topics_qs = topics_qs.prefetch_related("tags", "comments")
+        topics_qs = topics_qs.prefetch_related("tags")
     else:
         topics_qs = topics_qs.defer("prefix", "status", "is_pinned")
 
@@ -245,28 +319,29 @@ def home(request):
             topics_qs = topics_qs.filter(tags__slug=tag)
 
         if sort == "popular":
-            topics_qs = topics_qs.annotate(likes_total=Count("likes", distinct=True)).order_by("-is_pinned", "-likes_total", "-created_at")
+            topics_qs = topics_qs.order_by("-is_pinned", "-likes_total", "-created_at")
         elif sort == "comments":
-            topics_qs = topics_qs.annotate(comments_total=Count("comments", distinct=True)).order_by("-is_pinned", "-comments_total", "-created_at")
+            topics_qs = topics_qs.order_by("-is_pinned", "-comments_total", "-created_at")
         elif sort == "old":
             topics_qs = topics_qs.order_by("-is_pinned", "created_at")
         else:
             topics_qs = topics_qs.order_by("-is_pinned", "-created_at")
     else:
         if sort == "popular":
-            topics_qs = topics_qs.annotate(likes_total=Count("likes", distinct=True)).order_by("-likes_total", "-created_at")
+            topics_qs = topics_qs.order_by("-likes_total", "-created_at")
         elif sort == "comments":
-            topics_qs = topics_qs.annotate(comments_total=Count("comments", distinct=True)).order_by("-comments_total", "-created_at")
+            topics_qs = topics_qs.order_by("-comments_total", "-created_at")
         elif sort == "old":
             topics_qs = topics_qs.order_by("created_at")
         else:
             topics_qs = topics_qs.order_by("-created_at")
 
-    paginator = Paginator(topics_qs.distinct(), 10)
+    paginator = Paginator(topics_qs, 10)
     page_obj = paginator.get_page(request.GET.get("page"))
     topics = page_obj.object_list
 
-    last_posts = {t.id: t.posts.order_by("-created_at").first() for t in topics if t.posts.exists()}
+    posts_by_id = Post.objects.in_bulk([t.last_post_id for t in topics if t.last_post_id])
+    last_posts = {t.id: posts_by_id[t.last_post_id] for t in topics if t.last_post_id in posts_by_id}
     activities = Activity.objects.select_related("actor", "topic", "post", "comment").order_by("-created_at")[:3]
 
 
@@ -424,7 +499,7 @@ def create_topic_simple(request):
             form.save_tags_for_topic(topic)
             TopicSubscription.objects.get_or_create(user=request.user, topic=topic)
             _log_activity(request.user, "создал(а) тему", topic=topic)
-            _broadcast_site_event("topic_created", {"topic_id": topic.id, "actor_id": request.user.id})
+            _broadcast_site_event("topic_created", {"topic_id": topic.id, "actor_id": request.user.id}, realtime.HOME_GROUP)
             messages.success(request, "Тема создана! Вы автоматически подписаны на обновления.")
             return redirect("topic-detail", topic_id=topic.id)
     else:
@@ -438,37 +513,7 @@ def topic_detail(request, topic_id):
         messages.error(request, "База данных не обновлена. Выполните: python manage.py migrate")
         return redirect("home")
 
-    topic = get_object_or_404(Topic, id=topic_id)
-    posts = topic.posts.all().order_by("created_at")
-    comments = Comment.objects.filter(topic=topic, post__isnull=True, parent__isnull=True).order_by("created_at")
-
-    post_form = PostCreateForm()
-    comment_form = CommentForm()
-
-    all_comment_ids = list(Comment.objects.filter(topic=topic).values_list("id", flat=True))
-    comment_total = len(all_comment_ids)
-
-    liked_comment_ids = set()
-    if request.user.is_authenticated and all_comment_ids:
-        liked_comment_ids = set(
-            CommentReaction.objects.filter(
-                user=request.user,
-                reaction_type="like",
-                comment_id__in=all_comment_ids
-            ).values_list("comment_id", flat=True)
-        )
-
-    comment_like_counts = {}
-    if all_comment_ids:
-        for cid in CommentReaction.objects.filter(
-            comment_id__in=all_comment_ids,
-            reaction_type="like"
-        ).values_list("comment_id", flat=True):
-            comment_like_counts[cid] = comment_like_counts.get(cid, 0) + 1
-
-    is_subscribed = False
-    if request.user.is_authenticated:
-        is_subscribed = TopicSubscription.objects.filter(topic=topic, user=request.user).exists()
+    topic = get_object_or_404(Topic.objects.select_related("author__profile"), id=topic_id)
 
     if request.method == "POST":
         if not request.user.is_authenticated:
@@ -489,7 +534,7 @@ def topic_detail(request, topic_id):
                     notification_type=Notification.TYPE_TOPIC,
                     message=f"{request.user.username} опубликовал(а) новый пост в теме «{topic.title}»."
                 )
-                _broadcast_site_event("post_created", {"topic_id": topic.id, "post_id": p.id, "actor_id": request.user.id})
+                _broadcast_site_event("post_created", {"topic_id": topic.id, "post_id": p.id, "actor_id": request.user.id}, realtime.topic_group(topic.id))
             return redirect("topic-detail", topic_id=topic.id)
 
         content = (request.POST.get("content") or "").strip()
@@ -543,14 +588,15 @@ def topic_detail(request, topic_id):
             },
             request=request,
         )
+        comment_event = {"topic_id": topic.id, "comment_id": created_comment.id, "actor_id": request.user.id}
         _broadcast_site_event("comment_created", {
-            "topic_id": topic.id,
-            "comment_id": created_comment.id,
+            **comment_event,
             "parent_id": int(parent_id) if parent_id else None,
             "post_id": int(post_id) if post_id else None,
-            "actor_id": request.user.id,
             "html": rendered_comment_html,
-        })
+        }, realtime.topic_group(topic.id))
+        # The topic list only bumps a counter, so it does not need the HTML.
+        _broadcast_site_event("comment_created", comment_event, realtime.HOME_GROUP)
 
         if request.headers.get("x-requested-with") == "XMLHttpRequest":
             return JsonResponse({
@@ -562,6 +608,59 @@ def topic_detail(request, topic_id):
 
         return redirect("topic-detail", topic_id=topic.id)
 
+    posts = list(
+        topic.posts.select_related("author__profile")
+        .annotate(likes_total=Count("likes", distinct=True), comments_total=Count("comments", distinct=True))
+        .order_by("created_at")
+    )
+
+    post_form = PostCreateForm()
+    comment_form = CommentForm()
+
+    # The whole thread in one query; replies are attached in Python instead
+    # of a query per comment in comments_recursive.html.
+    thread = list(Comment.objects.filter(topic=topic).select_related("author__profile").order_by("created_at"))
+    replies, post_comments = {}, {}
+    for comment in thread:
+        replies.setdefault(comment.parent_id, []).append(comment)
+        if comment.post_id:
+            post_comments.setdefault(comment.post_id, []).append(comment)
+    for comment in thread:
+        comment.thread_replies = replies.get(comment.id, [])
+    for post in posts:
+        post.thread_comments = post_comments.get(post.id, [])
+    comments = [c for c in replies.get(None, []) if c.post_id is None]
+
+    all_comment_ids = [comment.id for comment in thread]
+    comment_total = len(all_comment_ids)
+
+    liked_comment_ids = set()
+    if request.user.is_authenticated and all_comment_ids:
+        liked_comment_ids = set(
+            CommentReaction.objects.filter(
+                user=request.user,
+                reaction_type="like",
+                comment_id__in=all_comment_ids
+            ).values_list("comment_id", flat=True)
+        )
+
+    comment_like_counts = {}
+    if all_comment_ids:
+        comment_like_counts = dict(
+            CommentReaction.objects.filter(
+                comment_id__in=all_comment_ids,
+                reaction_type="like"
+            ).values("comment_id").annotate(total=Count("pk")).values_list("comment_id", "total")
+        )
+
+    is_subscribed = False
+    liked_post_ids = set()
+    if request.user.is_authenticated:
+        is_subscribed = TopicSubscription.objects.filter(topic=topic, user=request.user).exists()
+        liked_post_ids = set(
+            Post.likes.through.objects.filter(post__topic=topic, customuser=request.user).values_list("post_id", flat=True)
+        )
+
     return render(request, "main/topic_detail.html", {
         "topic": topic,
         "posts": posts,
@@ -571,6 +670,7 @@ def topic_detail(request, topic_id):
         "liked_comment_ids": liked_comment_ids,
         "comment_like_counts": comment_like_counts,
         "comment_total": comment_total,
+        "liked_post_ids": liked_post_ids,
         "is_subscribed": is_subscribed,
         "subscriber_count": topic.subscriptions.count(),
     })
@@ -600,9 +700,10 @@ def notifications_view(request):
 
 @login_required
 @require_POST
-def notifications_mark_read(request):
-    request.user.notifications.filter(is_read=False).update(is_read=True)
-    _push_header_counters(request.user)
+async def notifications_mark_read(request):
+    user = await request.auser()
+    await user.notifications.filter(is_read=False).aupdate(is_read=True)
+    await _apush_header_counters(user.id)
     messages.success(request, "Все уведомления отмечены как прочитанные.")
     return redirect("notifications")
 
@@ -668,52 +769,66 @@ def privacy(request):
     return render(request, "main/privacy.html")
 
 
+# The like toggles, typing ping, mark-read and online list are async views:
+# they are hit on every click, so they use the async ORM and cache instead
+# of holding a worker thread each, and queue their realtime events for the
+# background publisher like the sync views.
 @login_required
 @require_POST
-def toggle_post_like(request, post_id):
-    post = get_object_or_404(Post, id=post_id)
+async def toggle_post_like(request, post_id):
+    user = await request.auser()
+    post = await _aget_or_404(Post.objects.only("id", "author_id", "topic_id"), id=post_id)
 
-    if request.user in post.likes.all():
-        post.likes.remove(request.user)
+    if await post.likes.filter(pk=user.pk).aexists():
+        await post.likes.aremove(user)
         liked = False
     else:
-        post.likes.add(request.user)
+        await post.likes.aadd(user)
         liked = True
-        _create_like_notification(
-            actor=request.user,
-            recipient=post.author,
-            post=post,
-            topic=post.topic,
-            message=f"{request.user.username} поставил(а) лайк вашему посту.",
+        await _acreate_like_notification(
+            actor=user,
+            recipient_id=post.author_id,
+            post_id=post.id,
+            topic_id=post.topic_id,
+            message=f"{user.username} поставил(а) лайк вашему посту.",
         )
-        _log_activity(request.user, "поставил(а) лайк посту", topic=post.topic, post=post)
+        await Activity.objects.acreate(actor=user, verb="поставил(а) лайк посту", topic_id=post.topic_id, post=post)
 
-    likes_count = post.likes.count()
-    _broadcast_site_event("post_liked", {"topic_id": post.topic_id, "post_id": post.id, "likes": likes_count, "actor_id": request.user.id})
+    likes_count = await post.likes.acount()
+    await publisher.aenqueue(
+        realtime.topic_group(post.topic_id),
+        "site_event",
+        {"type": "post_liked", "topic_id": post.topic_id, "post_id": post.id, "likes": likes_count, "actor_id": user.id},
+    )
     return JsonResponse({"liked": liked, "likes": likes_count})
 
 
 @login_required
 @require_POST
-def toggle_topic_like(request, topic_id):
-    topic = get_object_or_404(Topic, id=topic_id)
+async def toggle_topic_like(request, topic_id):
+    user = await request.auser()
+    topic = await _aget_or_404(Topic.objects.only("id", "author_id"), id=topic_id)
 
-    if request.user in topic.likes.all():
-        topic.likes.remove(request.user)
+    if await topic.likes.filter(pk=user.pk).aexists():
+        await topic.likes.aremove(user)
         liked = False
     else:
-        topic.likes.add(request.user)
+        await topic.likes.aadd(user)
         liked = True
-        _create_like_notification(
-            actor=request.user,
-            recipient=topic.author,
-            topic=topic,
-            message=f"{request.user.username} поставил(а) лайк вашей теме.",
+        await _acreate_like_notification(
+            actor=user,
+            recipient_id=topic.author_id,
+            topic_id=topic.id,
+            message=f"{user.username} поставил(а) лайк вашей теме.",
         )
-        _log_activity(request.user, "поставил(а) лайк теме", topic=topic)
+        await Activity.objects.acreate(actor=user, verb="поставил(а) лайк теме", topic=topic)
 
-    likes_count = topic.likes.count()
-    _broadcast_site_event("topic_liked", {"topic_id": topic.id, "likes": likes_count, "actor_id": request.user.id})
+    likes_count = await topic.likes.acount()
+    await publisher.aenqueue(
+        [realtime.topic_group(topic.id), realtime.HOME_GROUP],
+        "site_event",
+        {"type": "topic_liked", "topic_id": topic.id, "likes": likes_count, "actor_id": user.id},
+    )
     return JsonResponse({"liked": liked, "likes": likes_count})
 
 
@@ -728,7 +843,12 @@ def delete_comment(request, comment_id):
     topic_id = comment.topic_id or (comment.post.topic_id if comment.post_id else None)
 
     comment.delete()
-    _broadcast_site_event("comment_deleted", {"topic_id": topic_id, "comment_id": comment_id, "actor_id": request.user.id})
+    if topic_id:
+        _broadcast_site_event(
+            "comment_deleted",
+            {"topic_id": topic_id, "comment_id": comment_id, "actor_id": request.user.id},
+            [realtime.topic_group(topic_id), realtime.HOME_GROUP],
+        )
     if request.headers.get("x-requested-with") == "XMLHttpRequest":
         return JsonResponse({"ok": True, "comment_id": comment_id})
     if topic_id:
@@ -738,56 +858,99 @@ def delete_comment(request, comment_id):
 
 @login_required
 @require_POST
-def toggle_comment_like(request, comment_id):
+async def toggle_comment_like(request, comment_id):
     is_ajax = request.headers.get("x-requested-with") == "XMLHttpRequest"
     if not is_ajax:
         return HttpResponseForbidden()
 
-    comment = get_object_or_404(Comment, id=comment_id)
+    user = await request.auser()
+    comment = await _aget_or_404(Comment.objects.only("id", "author_id", "topic_id", "post_id"), id=comment_id)
 
-    existing = CommentReaction.objects.filter(
+    deleted, _ = await CommentReaction.objects.filter(
         comment=comment,
-        user=request.user,
+        user=user,
         reaction_type="like"
-    ).first()
+    ).adelete()
 
-    if existing:
-        existing.delete()
+    if deleted:
         liked = False
     else:
-        CommentReaction.objects.create(
+        await CommentReaction.objects.acreate(
             comment=comment,
-            user=request.user,
+            user=user,
             reaction_type="like"
         )
         liked = True
-        _create_like_notification(
-            actor=request.user,
-            recipient=comment.author,
-            comment=comment,
-            topic=comment.topic,
-            post=comment.post,
-            message=f"{request.user.username} поставил(а) лайк вашему комментарию.",
+        await _acreate_like_notification(
+            actor=user,
+            recipient_id=comment.author_id,
+            comment_id=comment.id,
+            topic_id=comment.topic_id,
+            post_id=comment.post_id,
+            message=f"{user.username} поставил(а) лайк вашему комментарию.",
         )
 
-    likes = CommentReaction.objects.filter(comment=comment, reaction_type="like").count()
-    _broadcast_site_event("comment_liked", {"topic_id": comment.topic_id, "comment_id": comment.id, "likes": likes, "actor_id": request.user.id})
+    likes = await CommentReaction.objects.filter(comment=comment, reaction_type="like").acount()
+    if comment.topic_id:
+        await publisher.aenqueue(
+            realtime.topic_group(comment.topic_id),
+            "site_event",
+            {"type": "comment_liked", "topic_id": comment.topic_id, "comment_id": comment.id, "likes": likes, "actor_id": user.id},
+        )
     return JsonResponse({"liked": liked, "likes": likes})
 
 
 @login_required
-def online_users_json(request):
-    return JsonResponse({"users": get_online_usernames()})
+async def online_users_json(request):
+    return JsonResponse({"users": await aget_online_usernames()})
+
+
+def _metrics_access_allowed(request) -> bool:
+    token = getattr(settings, "METRICS_TOKEN", "")
+    # Bytes: compare_digest() rejects non-ASCII str, and headers are client input.
+    supplied = request.headers.get("Authorization", "").encode()
+    if token and hmac.compare_digest(supplied, f"Bearer {token}".encode()):
+        return True
+    return request.user.is_authenticated and request.user.is_staff
+
+
+def runtime_metrics_json(request):
+    if not _metrics_access_allowed(request):
+        return HttpResponseForbidden("Недостаточно прав.")
+    return JsonResponse(runtime_metrics.collect())
+
+
+def runtime_metrics_prometheus(request):
+    if not _metrics_access_allowed(request):
+        return HttpResponseForbidden("Недостаточно прав.")
+    # The channel layer registers its metrics when it is first created.
+    get_channel_layer()
+    return HttpResponse(prometheus.render(runtime_metrics.collect()), content_type=prometheus.CONTENT_TYPE)
 
 
 @login_required
 def dialogs_list(request):
     users_for_new_dialog = User.objects.exclude(id=request.user.id).order_by("username")
+    unread_qs = (
+        Message.objects.filter(dialog=OuterRef("pk"))
+        .exclude(author=request.user)
+        .exclude(read_by__user=request.user)
+    )
     try:
         dialogs = (
             Dialog.objects.filter(dialog_participants__user=request.user)
             .prefetch_related("dialog_participants__user")
-            .annotate(last_message_time=Count("messages"))
+            .annotate(
+                last_message_time=Count("messages"),
+                unread_count=Coalesce(
+                    Subquery(unread_qs.order_by().values("dialog").annotate(total=Count("pk")).values("total")),
+                    0,
+                ),
+                unread_author=Coalesce(
+                    Subquery(unread_qs.order_by("-created_at").values("author__username")[:1]),
+                    Value(""),
+                ),
+            )
             .distinct()
             .order_by("-updated_at")
         )
@@ -797,17 +960,6 @@ def dialogs_list(request):
         dialogs = []
         dialogs_count = 0
 
-    try:
-        for dialog in dialogs:
-            unread_qs = dialog.messages.exclude(author=request.user).exclude(read_by__user=request.user)
-            last_unread = unread_qs.select_related("author").order_by("-created_at").first()
-            dialog.unread_author = last_unread.author.username if last_unread else ""
-            dialog.unread_count = unread_qs.count() if last_unread else 0
-    except (OperationalError, ProgrammingError):
-        for dialog in dialogs:
-            dialog.unread_author = ""
-            dialog.unread_count = 0
-
     return render(request, "main/dialogs.html", {
         "dialogs": dialogs,
         "dialogs_count": dialogs_count,
@@ -851,18 +1003,31 @@ def dialog_detail(request, dialog_id):
     if request.method == "POST":
         form = MessageForm(request.POST, request.FILES)
         is_ajax = request.headers.get("x-requested-with") == "XMLHttpRequest"
-        if form.is_valid() and (form.cleaned_data.get("content", "").strip() or form.cleaned_data.get("image") or form.cleaned_data.get("attachment")):
+        # Files sent through the chunked upload API arrive as session ids.
+        upload_ids = {
+            field: request.POST.get(f"{field}_upload")
+            for field in ("image", "attachment")
+            if request.POST.get(f"{field}_upload")
+        }
+        if form.is_valid() and (form.cleaned_data.get("content", "").strip() or form.cleaned_data.get("image") or form.cleaned_data.get("attachment") or upload_ids):
             try:
                 msg = form.save(commit=False)
+                for field, upload_id in upload_ids.items():
+                    target = UploadSession.TARGET_MESSAGE_IMAGE if field == "image" else UploadSession.TARGET_MESSAGE_ATTACHMENT
+                    setattr(msg, field, uploads.claim(upload_id, request.user, target))
                 msg.dialog = dialog
                 msg.author = request.user
                 msg.content = (msg.content or "").strip()
                 msg.save()
                 dialog.updated_at = timezone.now()
                 dialog.save(update_fields=["updated_at"])
-                for participant in dialog.dialog_participants.select_related("user"):
-                    _push_header_counters(participant.user)
-                _broadcast_site_event("dialog_message_created", {"dialog_id": dialog.id, "actor_id": request.user.id})
+                participants = list(dialog.dialog_participants.select_related("user"))
+                _push_header_counters(*(participant.user for participant in participants))
+                _broadcast_site_event(
+                    "dialog_message_created",
+                    {"dialog_id": dialog.id, "actor_id": request.user.id},
+                    [realtime.dialog_list_group(participant.user_id) for participant in participants],
+                )
                 if is_ajax:
                     return JsonResponse({
                         "ok": True,
@@ -871,10 +1036,14 @@ def dialog_detail(request, dialog_id):
                             "author": msg.author.username,
                             "content": msg.content,
                             "image": msg.image.url if msg.image else "",
-                            "attachment": msg.attachment.url if msg.attachment else "",
+                            "attachment": msg.attachment_url,
                             "created_at": msg.created_at.strftime("%d.%m.%Y %H:%M"),
                         },
                     })
+            except uploads.UploadError as exc:
+                if is_ajax:
+                    return _upload_error_response(exc)
+                messages.error(request, "Загрузка файла не завершена. Прикрепите файл заново.")
             except (OperationalError, ProgrammingError):
                 if is_ajax:
                     return JsonResponse({"ok": False, "error": "db_error"}, status=503)
@@ -886,7 +1055,9 @@ def dialog_detail(request, dialog_id):
         form = MessageForm()
 
     try:
-        messages_qs = dialog.messages.select_related("author").order_by("created_at")
+        messages_qs = dialog.messages.select_related("author").annotate(
+            is_read=Exists(MessageRead.objects.filter(message=OuterRef("pk")).exclude(user=OuterRef("author")))
+        ).order_by("created_at")
         participants = dialog.dialog_participants.select_related("user")
         MessageRead.objects.bulk_create(
             [MessageRead(message=m, user=request.user) for m in messages_qs if m.author_id != request.user.id],
@@ -905,9 +1076,9 @@ def dialog_detail(request, dialog_id):
                 "is_own": m.author_id == request.user.id,
                 "content": m.content,
                 "image": m.image.url if m.image else "",
-                "attachment": m.attachment.url if m.attachment else "",
+                "attachment": m.attachment_url,
                 "created_at": m.created_at.strftime("%d.%m.%Y %H:%M"),
-                "is_read": m.read_by.exclude(user=m.author).exists(),
+                "is_read": m.is_read,
             }
             for m in messages_qs
         ]
@@ -918,20 +1089,72 @@ def dialog_detail(request, dialog_id):
         "messages_qs": messages_qs,
         "participants": participants,
         "form": form,
-        "ws_url": f"/ws/dialogs/{dialog.id}/",
     })
 
 
 @login_required
 @require_POST
-def dialog_typing(request, dialog_id):
+async def dialog_typing(request, dialog_id):
+    user = await request.auser()
     try:
-        participant = get_object_or_404(DialogParticipant, dialog_id=dialog_id, user=request.user)
-        participant.last_typing_at = timezone.now()
-        participant.save(update_fields=["last_typing_at"])
-        return JsonResponse({"ok": True})
+        updated = await DialogParticipant.objects.filter(dialog_id=dialog_id, user=user).aupdate(last_typing_at=timezone.now())
     except (OperationalError, ProgrammingError):
         return JsonResponse({"ok": False}, status=503)
+    if not updated:
+        raise Http404("No DialogParticipant matches the given query.")
+    return JsonResponse({"ok": True})
+
+
+def _upload_error_response(exc):
+    return JsonResponse({"ok": False, "error": exc.code, **exc.extra}, status=exc.status)
+
+
+@login_required
+@require_POST
+def upload_create(request):
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"ok": False, "error": "bad_json"}, status=400)
+    try:
+        session = uploads.create_session(
+            request.user, data.get("target"), data.get("filename"), data.get("size"), data.get("sha256", ""),
+        )
+    except uploads.UploadError as exc:
+        return _upload_error_response(exc)
+    return JsonResponse({"ok": True, "upload": uploads.describe(session)}, status=201)
+
+
+@login_required
+def upload_detail(request, upload_id):
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.user)
+    return JsonResponse({"ok": True, "upload": uploads.describe(session)})
+
+
+@login_required
+@require_POST
+def upload_chunk(request, upload_id):
+    try:
+        offset = int(request.headers.get("X-Upload-Offset", ""))
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        return JsonResponse({"ok": False, "error": "bad_offset"}, status=400)
+    try:
+        # The request is read as a stream: the chunk never sits in memory whole.
+        session = uploads.write_chunk(upload_id, request.user, offset, request, length, request.headers.get("X-Chunk-Sha256"))
+    except uploads.UploadError as exc:
+        return _upload_error_response(exc)
+    return JsonResponse({"ok": True, "upload": uploads.describe(session)})
+
+
+@login_required
+@require_POST
+def upload_complete(request, upload_id):
+    try:
+        session = uploads.complete(upload_id, request.user)
+    except uploads.UploadError as exc:
+        return _upload_error_response(exc)
+    return JsonResponse({"ok": True, "upload": uploads.describe(session)})
 
 
 
@@ -971,7 +1194,7 @@ def create_family_operation(request):
         operation.coordinator = request.user
         operation.save()
         form.save_m2m()
-        _broadcast_site_event("family_operation_updated", {"operation_id": operation.id})
+        _broadcast_site_event("family_operation_updated", {"operation_id": operation.id}, realtime.FAMILY_HQ_GROUP)
         messages.success(request, "Операция добавлена.")
     else:
         messages.error(request, "Не удалось создать операцию. Проверьте поля формы.")
@@ -989,7 +1212,7 @@ def create_faction_dossier(request):
         dossier = form.save(commit=False)
         dossier.author = request.user
         dossier.save()
-        _broadcast_site_event("family_dossier_updated", {"dossier_id": dossier.id})
+        _broadcast_site_event("family_dossier_updated", {"dossier_id": dossier.id}, realtime.FAMILY_HQ_GROUP)
         messages.success(request, "Досье сохранено.")
     else:
         messages.error(request, "Не удалось сохранить досье. Проверьте поля формы.")
@@ -1014,7 +1237,7 @@ def create_family_task(request):
                 recipient=assignee,
                 message=f"Вам выдали поручение: «{task.title}».",
             )
-        _broadcast_site_event("family_task_updated", {"task_id": task.id, "assignee_id": task.assignee_id})
+        _broadcast_site_event("family_task_updated", {"task_id": task.id, "assignee_id": task.assignee_id}, realtime.FAMILY_HQ_GROUP)
         messages.success(request, "Поручение создано.")
     else:
         messages.error(request, "Не удалось создать поручение. Проверьте поля формы.")
@@ -1048,7 +1271,7 @@ def claim_family_task(request, task_id):
             message=f"{request.user.username} взял(а) поручение: «{task.title}».",
         )
 
-    _broadcast_site_event("family_task_updated", {"task_id": task.id, "assignee_id": task.assignee_id})
+    _broadcast_site_event("family_task_updated", {"task_id": task.id, "assignee_id": task.assignee_id}, realtime.FAMILY_HQ_GROUP)
     messages.success(request, "Вы взяли поручение в работу.")
     return redirect("family-hq")
 
@@ -1069,6 +1292,13 @@ def complete_family_task(request, task_id):
         return redirect("family-hq")
 
     completion_proof = request.FILES.get("completion_proof")
+    proof_upload = request.POST.get("completion_proof_upload")
+    if proof_upload:
+        try:
+            completion_proof = uploads.claim(proof_upload, request.user, UploadSession.TARGET_TASK_PROOF)
+        except uploads.UploadError:
+            messages.error(request, "Загрузка подтверждения не завершена. Приложите файл заново.")
+            return redirect("family-hq")
     if not completion_proof and not task.completion_proof:
         messages.error(request, "Для закрытия поручения приложите фото/скрин подтверждения.")
         return redirect("family-hq")
@@ -1088,6 +1318,6 @@ def complete_family_task(request, task_id):
             message=f"Поручение «{task.title}» отмечено как выполненное.",
         )
 
-    _broadcast_site_event("family_task_updated", {"task_id": task.id, "assignee_id": task.assignee_id})
+    _broadcast_site_event("family_task_updated", {"task_id": task.id, "assignee_id": task.assignee_id}, realtime.FAMILY_HQ_GROUP)
     messages.success(request, "Поручение закрыто.")
     return redirect("family-hq")